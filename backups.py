@@ -0,0 +1,170 @@
+import os
+import re
+import shutil
+import datetime
+import threading
+from collections import namedtuple
+
+from extract_cache import file_sha256
+
+# --- Workbook Backups ---
+# Before an update, the workbook is copied into the '.old' folder as
+# '<name>_<timestamp>_<hash>.xlsx', where <hash> is the start of its SHA-256.
+# A workbook that has not changed since its last backup is hardlinked to it
+# instead of copied again, and old backups are pruned by a retention policy.
+
+# Default settings, overridden by the "backups" section of config.json
+DEFAULT_BACKUP_SETTINGS = {
+    "enabled": True,
+    # The most recent backups, always kept
+    "keep_last": 10,
+    # Plus the newest backup of each of the last days / weeks that have one
+    "keep_daily": 7,
+    "keep_weekly": 4,
+}
+
+BACKUP_FOLDER = ".old"
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H%M%S"
+# Hex digits of the SHA-256 kept in the name
+HASH_LENGTH = 12
+
+# One backup of a workbook ('digest' is None for the ones made before they were hashed)
+Backup = namedtuple("Backup", ["path", "timestamp", "digest"])
+
+def get_backup_settings(config):
+    """Returns the backup settings from the config, filled in with the defaults."""
+    settings = dict(DEFAULT_BACKUP_SETTINGS)
+    settings.update(config.get("backups", {}))
+    for name in ("keep_last", "keep_daily", "keep_weekly"):
+        value = settings[name]
+        minimum = 1 if name == "keep_last" else 0
+        if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+            print(f"Warning: Invalid '{name}' in the backup settings. Using {DEFAULT_BACKUP_SETTINGS[name]}.")
+            settings[name] = DEFAULT_BACKUP_SETTINGS[name]
+    return settings
+
+def _backup_pattern(output_filename):
+    """Matches the backups of output_filename, e.g. 'datos_2025-11-17_223228.xlsx' or with '_<hash>'."""
+    base_name, extension = os.path.splitext(os.path.basename(output_filename))
+    return re.compile(rf"^{re.escape(base_name)}_(\d{{4}}-\d{{2}}-\d{{2}}_\d{{6}})(?:_([0-9a-f]{{{HASH_LENGTH}}}))?"
+                      rf"{re.escape(extension)}$")
+
+def get_backup_dir(output_filename):
+    """Returns the folder that holds the backups of output_filename: '.old' in the working directory."""
+    return BACKUP_FOLDER
+
+def list_backups(output_filename):
+    """Returns the backups of output_filename, oldest first."""
+    backup_dir = get_backup_dir(output_filename)
+    if not os.path.isdir(backup_dir):
+        return []
+    pattern = _backup_pattern(output_filename)
+    backups = []
+    for name in os.listdir(backup_dir):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        try:
+            timestamp = datetime.datetime.strptime(match.group(1), TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+        backups.append(Backup(os.path.join(backup_dir, name), timestamp, match.group(2)))
+    backups.sort(key=lambda backup: (backup.timestamp, backup.path))
+    return backups
+
+def select_backups_to_keep(backups, settings):
+    """
+    Applies the retention policy to a list of backups (oldest first): the last
+    'keep_last' ones, plus the newest one of each of the last 'keep_daily'
+    days and 'keep_weekly' ISO weeks that have a backup.
+    Returns the set of paths to keep.
+    """
+    keep = {backup.path for backup in backups[-settings["keep_last"]:]}
+    for period, count in ((lambda timestamp: timestamp.date(), settings["keep_daily"]),
+                          (lambda timestamp: timestamp.isocalendar()[:2], settings["keep_weekly"])):
+        newest = {}
+        for backup in backups:
+            newest[period(backup.timestamp)] = backup.path
+        if count:
+            keep.update(newest[key] for key in sorted(newest)[-count:])
+    return keep
+
+def prune_backups(output_filename, settings):
+    """Deletes the backups of output_filename that the retention policy does not keep."""
+    backups = list_backups(output_filename)
+    keep = select_backups_to_keep(backups, settings)
+    removed = 0
+    for backup in backups:
+        if backup.path in keep:
+            continue
+        try:
+            os.remove(backup.path)
+            removed += 1
+        except OSError as e:
+            print(f"Warning: Could not remove the old backup '{backup.path}'. Error: {e}")
+    if removed:
+        print(f"Removed {removed} old backup(s) of '{output_filename}'.")
+
+def backup_workbook(output_filename, settings=None):
+    """
+    Backs the workbook up into the '.old' folder, then prunes the old
+    backups. Returns the path of the backup, or None if there is none.
+    A failed backup only prints a warning.
+    """
+    settings = settings if settings is not None else DEFAULT_BACKUP_SETTINGS
+    if not settings["enabled"]:
+        return None
+    try:
+        backup_dir = get_backup_dir(output_filename)
+        os.makedirs(backup_dir, exist_ok=True)
+
+        digest = file_sha256(output_filename)[:HASH_LENGTH]
+        timestamp = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+        base_name, extension = os.path.splitext(os.path.basename(output_filename))
+        backup_path = os.path.join(backup_dir, f"{base_name}_{timestamp}_{digest}{extension}")
+
+        same_contents = [backup for backup in list_backups(output_filename) if backup.digest == digest]
+        if same_contents:
+            # Unchanged since that backup: no need to copy it again
+            previous = same_contents[-1].path
+            if previous == backup_path:
+                return backup_path
+            try:
+                os.link(previous, backup_path)
+                print(f"'{output_filename}' has not changed since '{previous}'. Linked the backup to it.")
+            except OSError:
+                print(f"'{output_filename}' has not changed since '{previous}'. No new backup needed.")
+                backup_path = previous
+        else:
+            # Through a temporary name, so a copy cut short never looks like a backup
+            temp_path = backup_path + ".tmp"
+            shutil.copy(output_filename, temp_path)
+            os.replace(temp_path, backup_path)
+            print(f"Created backup of '{output_filename}' at '{backup_path}'")
+
+        prune_backups(output_filename, settings)
+        return backup_path
+
+    except Exception as e:
+        print(f"Warning: Could not create backup for '{output_filename}'. Error: {e}")
+        # Continue execution even if backup fails.
+        return None
+
+class BackupJob:
+    """
+    Runs backup_workbook on a background thread, so the copy overlaps with the
+    extraction. wait() must be called before the workbook is overwritten.
+    """
+
+    def __init__(self, output_filename, settings=None):
+        self.backup_path = None
+        self._thread = threading.Thread(target=self._run, args=(output_filename, settings), daemon=True)
+        self._thread.start()
+
+    def _run(self, output_filename, settings):
+        self.backup_path = backup_workbook(output_filename, settings)
+
+    def wait(self):
+        """Waits for the backup to finish. Returns its path, or None if there is none."""
+        self._thread.join()
+        return self.backup_path
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import argparse
+import datetime
+import traceback
+import multiprocessing
+
+from code_base import (load_config, get_resource_path, list_pdf_files, get_default_jobs, parse_jobs,
+                       compile_write_plan, get_output_format, run_pipeline, RunError)
+from sinks import OUTPUT_FORMATS, get_output_path
+
+# --- Batch Mode ---
+# Runs the whole pipeline without a single prompt, for cron jobs and systemd
+# timers: everything comes from the command line, the outcome is the exit
+# code, and a JSON summary of the run can be written for monitoring.
+#
+#   python batch.py --input input_pdfs --output datos.xlsx --summary run.json
+
+# Exit codes
+EXIT_OK = 0
+# The run could not complete: bad config or arguments, missing template or
+# input folder, output that could not be written, unexpected error
+EXIT_ERROR = 1
+# (2 is argparse's exit code for invalid command line options)
+# The output was written, but some PDFs could not be extracted
+EXIT_PARTIAL = 3
+
+class RunSummary:
+    """
+    Counts and per-stage timings of a batch run, saved as JSON with save().
+    The timings are those of code_base.run_pipeline: "extract" is the time the
+    writer waited for PDFs to be extracted and "write" the rest of its time.
+    """
+
+    def __init__(self):
+        self.data = {
+            "started": datetime.datetime.now().isoformat(timespec="seconds"),
+            "finished": None,
+            "status": None,
+            "exit_code": None,
+            "message": None,
+            "output": None,
+            "format": None,
+            "files": {"seen": 0, "skipped": 0, "extracted": 0, "failed": 0},
+            "records_written": 0,
+            "timings": {},
+        }
+
+    def add_result(self, result):
+        """Copies the file counts, records written and stage timings of a code_base.PipelineResult."""
+        self.data["files"].update(result.files)
+        if result.written is not None:
+            self.data["records_written"] = len(result.written)
+        self.data["timings"] = {name: round(seconds, 3) for name, seconds in result.timings.items()}
+
+    def finish(self, status, exit_code, message=None):
+        """Records the outcome of the run. Returns exit_code."""
+        self.data.update(finished=datetime.datetime.now().isoformat(timespec="seconds"),
+                         status=status, exit_code=exit_code, message=message)
+        return exit_code
+
+    def save(self, path):
+        """Writes the summary to path (through a temporary file). A failure only prints a warning."""
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not save the run summary '{path}'. Error: {e}")
+
+def get_program_file(relative_path):
+    """
+    Like get_resource_path, but for a script run from source the file is looked
+    for next to it rather than in the working directory, which cron does not set.
+    """
+    if hasattr(sys, "_MEIPASS"):
+        return get_resource_path(relative_path)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), relative_path)
+
+def parse_args(argv=None):
+    """Parses the command line options of batch mode."""
+    parser = argparse.ArgumentParser(description="Extract data from PDF albaranes without any prompt "
+                                                 "(for cron and systemd timers).")
+    parser.add_argument("-i", "--input", action="append", dest="input_folders", metavar="FOLDER",
+                        help="folder with the PDFs; can be given more than once (default: input_pdfs)")
+    parser.add_argument("-o", "--output", required=True,
+                        help="output workbook, database or folder (see --format)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, dest="output_format",
+                        help="output format (default: 'output_format' in config.json, or excel)")
+    parser.add_argument("-j", "--jobs", type=parse_jobs, default=get_default_jobs(),
+                        help="number of worker processes used to extract the PDFs (default: number of CPU cores)")
+    parser.add_argument("--config", help="configuration file (default: config.json next to the program)")
+    parser.add_argument("--template", help="Excel template (default: PLANTILLA.xlsx next to the program)")
+    parser.add_argument("--cache-path", help="extraction cache database (default: the one in config.json)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="extract every PDF again instead of using the extraction cache")
+    parser.add_argument("--build-only", action="store_true",
+                        help="build the workbook from its record store, without extracting any PDF")
+    parser.add_argument("--summary", help="write a JSON summary of the run to this file")
+    return parser.parse_args(argv)
+
+def run_batch(args, summary):
+    """
+    Runs the pipeline (see code_base.run_pipeline) with everything taken from
+    args, and fills in the RunSummary. Returns the exit code.
+    """
+    config = load_config(args.config or get_program_file('config.json'))
+    if config is None:
+        return summary.finish("error", EXIT_ERROR, "The configuration file could not be loaded.")
+    if args.cache_path:
+        # Relative to the working directory, like the other paths on the command line
+        config['extraction_cache'] = dict(config.get('extraction_cache', {}), path=os.path.abspath(args.cache_path))
+
+    try:
+        write_plan = compile_write_plan(config)
+        output_format = get_output_format(config, args.output_format)
+    except RunError as e:
+        return summary.finish("error", EXIT_ERROR, str(e))
+    output_filename = get_output_path(args.output, output_format)
+    summary.data.update(output=output_filename, format=output_format)
+
+    template_path = args.template or get_program_file('PLANTILLA.xlsx')
+    if output_format == "excel" and not os.path.exists(template_path):
+        message = f"Template file '{template_path}' not found."
+        print(f"Error: {message}")
+        return summary.finish("error", EXIT_ERROR, message)
+
+    input_folders = [] if args.build_only else args.input_folders or ["input_pdfs"]
+    for input_folder in input_folders:
+        if not os.path.isdir(input_folder):
+            message = f"Input folder '{input_folder}' not found."
+            print(f"Error: {message}")
+            return summary.finish("error", EXIT_ERROR, message)
+
+    inputs = []
+    for input_folder in input_folders:
+        pdf_files = list_pdf_files(input_folder)
+        print(f"Found {len(pdf_files)} PDF(s) in '{input_folder}'.")
+        inputs.append((input_folder, pdf_files))
+
+    try:
+        result = run_pipeline(inputs, output_filename, output_format, template_path, write_plan, config, args.jobs,
+                              use_cache=not args.no_cache, build_only=args.build_only)
+    except RunError as e:
+        return summary.finish("error", EXIT_ERROR, str(e))
+    summary.add_result(result)
+
+    if result.status == "nothing_to_do":
+        return summary.finish("nothing_to_do", EXIT_OK)
+    if result.status == "no_data":
+        return summary.finish("error", EXIT_ERROR, "No data was successfully extracted from any PDF.")
+    if result.files["failed"]:
+        message = f"{result.files['failed']} PDF(s) could not be extracted."
+        print(f"Warning: {message}")
+        return summary.finish("partial", EXIT_PARTIAL, message)
+    print("Processing finished.")
+    return summary.finish("ok", EXIT_OK)
+
+def main(argv=None):
+    """Batch entry point. Returns the exit code."""
+    args = parse_args(argv)
+    print("Starting PDF processing (batch mode)...")
+    summary = RunSummary()
+    try:
+        exit_code = run_batch(args, summary)
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        print(traceback.format_exc())
+        exit_code = summary.finish("error", EXIT_ERROR, f"An unexpected error occurred: {e}")
+    if args.summary:
+        summary.save(args.summary)
+    return exit_code
+
+if __name__ == "__main__":
+    # Needed for the worker processes of the frozen (PyInstaller) build
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import argparse
+import pymupdf
+
+from code_base import get_resource_path, load_config, extract_data_from_pdf
+
+def extract_data_per_field(pdf_path, fields):
+    """
+    The original extraction loop, kept here as the baseline:
+    it loads the page and extracts its text again for every field.
+    """
+    doc = pymupdf.open(pdf_path)
+    extracted_data = {}
+    for field in fields:
+        page_num = field['page']
+        if page_num >= doc.page_count:
+            extracted_data[field['name']] = ""
+            continue
+        page = doc.load_page(page_num)
+        rect = pymupdf.Rect(*field['rect'])
+        text = page.get_text("text", clip=rect).strip()
+        extracted_data[field['name']] = text.replace('\n', ' ').replace('\r', ' ')
+    doc.close()
+    return extracted_data
+
+def time_per_document(extract, pdf_paths, fields, repeat):
+    """Runs extract over all the PDFs 'repeat' times and returns the average milliseconds per document."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for pdf_path in pdf_paths:
+            extract(pdf_path, fields)
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / (repeat * len(pdf_paths))
+
+def scale_fields(fields, factor):
+    """Repeats the configured fields 'factor' times (with unique names) to simulate bigger configs."""
+    if factor <= 1:
+        return fields
+    return [dict(field, name=f"{field['name']} #{i}") for i in range(factor) for field in fields]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per-document extraction time of the extraction strategies.")
+    parser.add_argument("folder", nargs="?", default="input_pdfs", help="folder with the PDFs to benchmark (default: input_pdfs)")
+    parser.add_argument("-r", "--repeat", type=int, default=20, help="how many times to go over the folder (default: 20)")
+    parser.add_argument("-s", "--scale-fields", type=int, default=1,
+                        help="repeat the configured fields this many times, to see how each strategy scales (default: 1)")
+    args = parser.parse_args()
+
+    config = load_config(get_resource_path('config.json'))
+    if config is None:
+        return 1
+    fields = scale_fields(config['extraction_fields'], args.scale_fields)
+
+    pdf_paths = [os.path.join(args.folder, f) for f in sorted(os.listdir(args.folder)) if f.lower().endswith('.pdf')]
+    if not pdf_paths:
+        print(f"No PDF files found in '{args.folder}'.")
+        return 1
+
+    def extract_words(pdf_path, fields):
+        return extract_data_from_pdf(pdf_path, fields, engine="words")
+
+    # The 'clip' engine must give exactly the same data as the original loop.
+    # The 'words' engine works on whole words, so a rectangle that cuts through
+    # a word can differ; report it but keep going.
+    for pdf_path in pdf_paths:
+        baseline = extract_data_per_field(pdf_path, fields)
+        if baseline != extract_data_from_pdf(pdf_path, fields):
+            print(f"Error: the 'clip' engine disagrees with the original loop on '{pdf_path}'.")
+            return 1
+        if baseline != extract_words(pdf_path, fields):
+            print(f"Note: the 'words' engine gives different text for some fields of '{pdf_path}'.")
+
+    print(f"{len(pdf_paths)} PDF(s), {len(fields)} field(s), {args.repeat} round(s)")
+    before = time_per_document(extract_data_per_field, pdf_paths, fields, args.repeat)
+    clip = time_per_document(extract_data_from_pdf, pdf_paths, fields, args.repeat)
+    words = time_per_document(extract_words, pdf_paths, fields, args.repeat)
+    print(f"Original (page reloaded per field): {before:8.2f} ms/document")
+    print(f"'clip' engine (page parsed once):   {clip:8.2f} ms/document  ({before / clip:.1f}x)")
+    print(f"'words' engine (one word pass):     {words:8.2f} ms/document  ({before / words:.1f}x)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import io
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import contextlib
+from copy import copy
+from openpyxl import load_workbook
+
+from code_base import (get_resource_path, load_config, compile_write_plan, get_extraction_engine, list_pdf_files,
+                       hash_pdf_files, extract_all_pdfs, build_records, export_to_excel)
+
+def update_copy(workbook_path, folder, records, template_path, write_plan, patch_updates):
+    """
+    Updates a copy of the workbook, in its own folder (where its backup goes too),
+    patching it in place or with openpyxl. Returns the copy's path and the log of the update.
+    """
+    os.makedirs(folder)
+    copy_path = os.path.join(folder, os.path.basename(workbook_path))
+    shutil.copyfile(workbook_path, copy_path)
+    log = io.StringIO()
+    current_dir = os.getcwd()
+    os.chdir(folder)
+    try:
+        with contextlib.redirect_stdout(log):
+            export_to_excel(records, copy_path, template_path, write_plan, patch_updates=patch_updates)
+    finally:
+        os.chdir(current_dir)
+    return copy_path, log.getvalue()
+
+def describe_sheet(sheet):
+    """Returns the layout of a sheet: merged cells, column widths and row heights."""
+    return (sorted(str(merged) for merged in sheet.merged_cells.ranges),
+            {letter: (dim.width, dim.hidden) for letter, dim in sheet.column_dimensions.items()},
+            {row: (dim.height, dim.hidden) for row, dim in sheet.row_dimensions.items() if dim.height or dim.hidden})
+
+def describe_cell(cell):
+    """Returns what the check compares in a cell: its value (dates included, with their type) and its style."""
+    # The style proxies only compare equal to the style objects themselves
+    return (cell.value, type(cell.value).__name__, cell.number_format, copy(cell.font), copy(cell.border),
+            copy(cell.fill), copy(cell.alignment), copy(cell.protection))
+
+def compare_workbooks(patched_path, openpyxl_path):
+    """Returns the differences between the two updated workbooks, as text lines."""
+    patched, reference = load_workbook(patched_path), load_workbook(openpyxl_path)
+    try:
+        if patched.sheetnames != reference.sheetnames:
+            return [f"Sheets: {patched.sheetnames} (patched) != {reference.sheetnames} (openpyxl)"]
+        differences = []
+        for title in reference.sheetnames:
+            patched_sheet, reference_sheet = patched[title], reference[title]
+            if describe_sheet(patched_sheet) != describe_sheet(reference_sheet):
+                differences.append(f"'{title}': merged cells, column widths or row heights differ")
+            max_row = max(patched_sheet.max_row, reference_sheet.max_row)
+            max_column = max(patched_sheet.max_column, reference_sheet.max_column)
+            for row in range(1, max_row + 1):
+                for column in range(1, max_column + 1):
+                    patched_cell = patched_sheet.cell(row=row, column=column)
+                    reference_cell = reference_sheet.cell(row=row, column=column)
+                    if describe_cell(patched_cell) != describe_cell(reference_cell):
+                        differences.append(f"'{title}'!{reference_cell.coordinate}: {patched_cell.value!r} "
+                                           f"(patched) != {reference_cell.value!r} (openpyxl), or their styles differ")
+        return differences
+    finally:
+        patched.close()
+        reference.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that patching a workbook in place gives the same result "
+                                                 "as the full openpyxl update: values, dates and styles.")
+    parser.add_argument("workbook", help="the workbook to update (it is not modified: copies are updated)")
+    parser.add_argument("folder", nargs="?", default="input_pdfs", help="folder with the PDFs to add (default: input_pdfs)")
+    args = parser.parse_args()
+
+    config = load_config(get_resource_path('config.json'))
+    if config is None:
+        return 1
+    write_plan = compile_write_plan(config)
+    template_path = get_resource_path('PLANTILLA.xlsx')
+
+    pdf_files = list_pdf_files(args.folder)
+    if not pdf_files:
+        print(f"No PDF files found in '{args.folder}'.")
+        return 1
+    pdf_hashes = hash_pdf_files(args.folder, pdf_files)
+    results = extract_all_pdfs(args.folder, pdf_files, config['extraction_fields'],
+                               engine=get_extraction_engine(config), pdf_hashes=pdf_hashes)
+    records = build_records(pdf_files, pdf_hashes, results)
+    print(f"{len(records)} record(s) from {len(pdf_files)} PDF(s), added to '{args.workbook}'")
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        patched_path, patch_log = update_copy(args.workbook, os.path.join(work_dir, "patched"), records,
+                                              template_path, write_plan, patch_updates=True)
+        openpyxl_path, _ = update_copy(args.workbook, os.path.join(work_dir, "openpyxl"), records,
+                                                  template_path, write_plan, patch_updates=False)
+        if "Nothing to write" in patch_log:
+            print("Error: the workbook already holds every record, so nothing was updated.")
+            return 1
+        if "Updating with openpyxl" in patch_log:
+            # Then both copies went through openpyxl: the check would prove nothing
+            print("Error: the workbook could not be patched in place:")
+            print("".join(line for line in patch_log.splitlines(keepends=True) if "Updating with openpyxl" in line))
+            return 1
+        differences = compare_workbooks(patched_path, openpyxl_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if differences:
+        print(f"Error: {len(differences)} difference(s) between the patched and the openpyxl update:")
+        for line in differences[:20]:
+            print(f"  {line}")
+        return 1
+    print("The patched and the openpyxl update give the same values, dates and styles.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
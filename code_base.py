@@ -1,14 +1,43 @@
+import time
+# Taken before the other imports, for --startup-time
+STARTED = time.perf_counter()
+
 import os
+import re
 import json
-import pymupdf
-import fitz  # This is the PyMuPDF library
-import pandas as pd
 import sys
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.worksheet.dimensions import ColumnDimension, RowDimension
+from openpyxl.worksheet.worksheet import Worksheet
 from openpyxl.utils.exceptions import InvalidFileException
-from openpyxl.styles import Font, Border, Fill, Protection, Alignment, Side
-import shutil
-import datetime  # <-- NEW IMPORT
+from openpyxl.styles import Font, Border, Side, NamedStyle
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE, BUILTIN_FORMATS_MAX_SIZE
+import weakref
+import pickle
+import tempfile
+from copy import copy
+from collections import namedtuple, Counter
+import argparse
+import contextlib
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, islice, chain
+import queue
+import threading
+import sqlite3
+from postprocess import (COLUMN_TYPES, DEFAULT_DECIMAL_SEPARATOR, DEFAULT_THOUSANDS_SEPARATOR, DEFAULT_DATE_FORMAT,
+                         DEFAULT_DATE_NUMBER_FORMAT, convert_column, convert_sheet_column, is_valid_date_format)
+from xlsx_patch import XlsxPatcher, PatchNotPossible
+from template_cache import load_template_layout
+from backups import BackupJob, get_backup_settings
+from sinks import OUTPUT_FORMATS, SinkError, open_sink, parquet_available, get_output_path
+from record_store import open_record_store
+from extract_cache import open_extraction_cache, clear_extraction_cache, file_sha256, hash_extraction_config
+from startup import print_startup_report
 
 def get_resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -42,96 +71,368 @@ def setup_directories(input_dir):
         return False
     return True
 
-def extract_data_from_pdf(pdf_path, fields):
+def group_fields_by_page(fields):
+    """
+    Groups the extraction fields by page number, e.g. {0: [field, field, ...]},
+    keeping the order in which they appear in the config.
+    """
+    fields_by_page = {}
+    for field in fields:
+        fields_by_page.setdefault(field['page'], []).append(field)
+    return fields_by_page
+
+# Set once replaying a display list fails, so the worker stops trying it
+display_list_failed = False
+
+def get_clipped_text(page, display_list, rect):
+    """
+    Returns the same text as page.get_text("text", clip=rect), but replays the
+    page's display list instead of interpreting the page content again.
+    (PyMuPDF ignores 'clip' when a ready-made TextPage is passed in, so each
+    rectangle still gets its own clipped TextPage, built from the display list.)
+    The display list is replayed through PyMuPDF's low-level bindings; if those
+    are missing or behave differently in the installed version, the text is
+    read with page.get_text() instead, for this and every later rectangle.
+    """
+    global display_list_failed
+    import pymupdf
+    mupdf = getattr(pymupdf, "mupdf", None)
+    if mupdf is None or display_list_failed:
+        # Older PyMuPDF without the low-level bindings
+        return page.get_text("text", clip=rect)
+
+    try:
+        clip = mupdf.FzRect(rect.x0, rect.y0, rect.x1, rect.y1)
+        stext_page = mupdf.FzStextPage(clip)
+        device = mupdf.fz_new_stext_device(stext_page, mupdf.FzStextOptions(pymupdf.TEXTFLAGS_TEXT))
+        mupdf.fz_run_display_list(display_list.this, device, mupdf.FzMatrix(), clip, mupdf.FzCookie())
+        mupdf.fz_close_device(device)
+
+        textpage = pymupdf.TextPage(stext_page)
+        textpage.parent = page
+        return textpage.extractText()
+    except Exception as e:
+        print(f"Warning: Fast clipped text extraction is not available with this PyMuPDF version ({e}). "
+              f"Using page.get_text() instead.")
+        display_list_failed = True
+        return page.get_text("text", clip=rect)
+
+# --- Word Index Extraction Engine ---
+
+# "clip":  one clipped text extraction per field (exactly like get_text(clip=...))
+# "words": one word extraction per page, fields resolved with NumPy
+EXTRACTION_ENGINES = ("clip", "words")
+
+def build_word_index(page):
+    """
+    Extracts every word of the page once.
+    Returns an (N, 4) NumPy array with the word rectangles [x0, y0, x1, y1]
+    and the list of the N words, both in the page's reading order.
+    """
+    import numpy as np
+    words = page.get_text("words")
+    boxes = np.array([word[:4] for word in words], dtype=float).reshape(-1, 4)
+    return boxes, [word[4] for word in words]
+
+def find_words_in_rects(boxes, rects):
+    """
+    Tests all the words against all the rectangles in one go.
+    Returns an (M, N) boolean matrix: row i tells which of the N words lie in
+    rectangle i. A word belongs to a rectangle when its centre is inside it,
+    so a neighbouring label that only grazes the edge is left out.
+    """
+    import numpy as np
+    rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+    centres_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    centres_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    return ((centres_x >= rects[:, 0:1]) & (centres_x <= rects[:, 2:3]) &
+            (centres_y >= rects[:, 1:2]) & (centres_y <= rects[:, 3:4]))
+
+def extract_texts_by_words(page, rects):
+    """
+    Returns the text inside each rectangle, built from a single word pass
+    over the page. Words keep the order get_text("text", clip=rect) gives them,
+    joined by single spaces.
+    """
+    import numpy as np
+    boxes, words = build_word_index(page)
+    matches = find_words_in_rects(boxes, rects)
+    return [" ".join(words[i] for i in np.flatnonzero(row)) for row in matches]
+
+def get_extraction_engine(config):
+    """Returns the extraction engine chosen in the config, falling back to 'clip'."""
+    engine = config.get('extraction_engine', 'clip')
+    if engine not in EXTRACTION_ENGINES:
+        print(f"Warning: Unknown extraction_engine '{engine}' in config. Using 'clip'.")
+        return "clip"
+    return engine
+
+# Value of a field whose text could not be extracted
+FIELD_ERROR = "ERROR"
+
+def extract_data_from_pdf(pdf_path, fields, engine="clip"):
     """
     Extracts data from a single PDF based on the fields defined in the config.
     Each 'field' specifies a page and a rectangle [x0, y0, x1, y1].
+    Every page is loaded and parsed only once, however many fields it holds.
+    'engine' is one of EXTRACTION_ENGINES.
     """
+    # Imported here, like NumPy above, so that only the extraction stage (and
+    # its worker processes) pays for loading PyMuPDF
+    import pymupdf
     try:
-        doc = fitz.open(pdf_path)
+        doc = pymupdf.open(pdf_path)
     except Exception as e:
         print(f"Error opening {pdf_path}: {e}")
         return None
 
-    extracted_data = {}
-    for field in fields:
-        try:
-            page_num = field['page']
-            rect_coords = field['rect']
-            
-            if page_num >= doc.page_count:
+    # Pre-fill in config order, so the result does not depend on the page grouping
+    extracted_data = {field['name']: "" for field in fields}
+    for page_num, page_fields in group_fields_by_page(fields).items():
+        if page_num >= doc.page_count:
+            for field in page_fields:
                 print(f"Warning: Page {page_num} out of range for {pdf_path}. Skipping field '{field['name']}'.")
-                extracted_data[field['name']] = ""
-                continue
-                
-            page = doc.load_page(page_num)
+            continue
 
-            
-            # DEBUG
-            # print(page.get_textpage().extractXML())
-            # text = page.get_text_blocks()
-            # print(f"Full text on page {page_num}:\n{text}\n--- End of page text ---\n")
-            # exit(0)
-            
-            # Define the rectangle (x0, y0, x1, y1)
-            rect = fitz.Rect(rect_coords[0], rect_coords[1], rect_coords[2], rect_coords[3])
- 
-            # Extract text from that rectangle
-            text = page.get_text("text", clip=rect).strip()
-            
-            # Clean up text (replace newlines with spaces)
-            text = text.replace('\n', ' ').replace('\r', ' ')
-            
-            # print(f"Extracted '{field['name']}': {text}")
-            extracted_data[field['name']] = text
+        try:
+            page = doc.load_page(page_num)
+            if engine == "words":
+                texts = extract_texts_by_words(page, [field['rect'] for field in page_fields])
+                for field, text in zip(page_fields, texts):
+                    extracted_data[field['name']] = text
+                continue
+            display_list = page.get_displaylist()
         except Exception as e:
-            print(f"Error processing field '{field['name']}' in {pdf_path}: {e}")
-            extracted_data[field['name']] = "ERROR"
+            for field in page_fields:
+                print(f"Error processing field '{field['name']}' in {pdf_path}: {e}")
+                extracted_data[field['name']] = FIELD_ERROR
+            continue
+
+        # DEBUG
+        # print(page.get_textpage().extractXML())
+        # text = page.get_text_blocks()
+        # print(f"Full text on page {page_num}:\n{text}\n--- End of page text ---\n")
+        # exit(0)
+
+        for field in page_fields:
+            try:
+                rect_coords = field['rect']
+
+                # Define the rectangle (x0, y0, x1, y1)
+                rect = pymupdf.Rect(rect_coords[0], rect_coords[1], rect_coords[2], rect_coords[3])
+
+                # Extract text from that rectangle
+                text = get_clipped_text(page, display_list, rect).strip()
+
+                # Clean up text (replace newlines with spaces)
+                text = text.replace('\n', ' ').replace('\r', ' ')
+
+                # print(f"Extracted '{field['name']}': {text}")
+                extracted_data[field['name']] = text
+            except Exception as e:
+                print(f"Error processing field '{field['name']}' in {pdf_path}: {e}")
+                extracted_data[field['name']] = FIELD_ERROR
 
     doc.close()
     return extracted_data
 
-# --- New Excel Helper Functions ---
+# --- Parallel Extraction ---
+
+def get_default_jobs():
+    """Returns the default number of extraction workers (one per CPU core)."""
+    return os.cpu_count() or 1
 
-def copy_sheet_properties(source_sheet, target_sheet):
+def _extract_worker(pdf_path, fields, engine):
     """
-    Manually copies cell values, styles, dimensions, and merged cells
-    from source_sheet to target_sheet (which must be in different workbooks).
+    Runs extract_data_from_pdf inside a worker process.
+    Anything the extraction prints is captured and returned with the result,
+    so the parent process can show it in the right place (console or GUI log).
     """
-    print(f"Copying properties from '{source_sheet.title}' to '{target_sheet.title}'...")
-    
-    # 1. Copy cell values and styles
-    for row in source_sheet.iter_rows():
-        for cell in row:
-            new_cell = target_sheet.cell(row=cell.row, column=cell.column, value=cell.value)
-            if cell.has_style:
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            data = extract_data_from_pdf(pdf_path, fields, engine)
+        except Exception as e:
+            print(f"Error processing {pdf_path}: {e}")
+            data = None
+    return data, log.getvalue()
+
+# PDFs handed to the workers at a time; bounds how many results are held in memory
+EXTRACT_BLOCK_SIZE = 256
+
+def list_pdf_files(input_folder):
+    """Returns the PDFs in input_folder, sorted so records always come out in the same order, whatever the worker count."""
+    return sorted(f for f in os.listdir(input_folder) if f.lower().endswith('.pdf'))
+
+def _iter_extract_block(pdf_paths, fields, engine, executor, jobs):
+    """
+    Extracts the given PDFs, with the executor's 'jobs' worker processes when there is one.
+    Yields one result per path, in order (None for the files that could not be processed).
+    """
+    if executor is None:
+        for pdf_path in pdf_paths:
+            print(f"Processing '{os.path.basename(pdf_path)}'...")
+            yield extract_data_from_pdf(pdf_path, fields, engine)
+        return
+
+    # Hand out work in small chunks so the per-task overhead stays low
+    # without leaving workers idle at the end of the block.
+    chunksize = max(1, len(pdf_paths) // (jobs * 4))
+    outputs = executor.map(_extract_worker, pdf_paths, repeat(fields), repeat(engine), chunksize=chunksize)
+    for pdf_path, (data, log) in zip(pdf_paths, outputs):
+        print(f"Processing '{os.path.basename(pdf_path)}'...")
+        if log:
+            print(log, end="")
+        yield data
+
+def iter_extract(input_folder, fields, pdf_files=None, jobs=None, engine="clip", cache=None, pdf_hashes=None):
+    """
+    Generator: extracts the PDFs of input_folder (all of them, or just pdf_files)
+    and yields (filename, pdf_hash, data) as soon as each one is ready, in
+    pdf_files order. data is None for the files that could not be processed.
+    Work is done EXTRACT_BLOCK_SIZE files at a time, in parallel when jobs > 1,
+    so memory does not grow with the size of the batch.
+    With an ExtractionCache, PDFs already extracted with the same config are
+    taken from the cache (matched by content, not by name) and only the rest are opened.
+    pdf_hashes can pass in the files' SHA-256 when the caller already has them.
+    """
+    if pdf_files is None:
+        pdf_files = list_pdf_files(input_folder)
+    if not pdf_files:
+        return
+    if jobs is None:
+        jobs = get_default_jobs()
+    if pdf_hashes is None:
+        pdf_hashes = hash_pdf_files(input_folder, pdf_files) if cache is not None else [None] * len(pdf_files)
+    config_hash = hash_extraction_config(fields, engine) if cache is not None else None
+
+    jobs = max(1, min(jobs, len(pdf_files)))
+    executor = None
+    if jobs > 1:
+        print(f"Extracting with {jobs} worker processes...")
+        executor = ProcessPoolExecutor(max_workers=jobs)
+
+    try:
+        for start in range(0, len(pdf_files), EXTRACT_BLOCK_SIZE):
+            block_files = pdf_files[start:start + EXTRACT_BLOCK_SIZE]
+            block_hashes = pdf_hashes[start:start + EXTRACT_BLOCK_SIZE]
+
+            cached = {}
+            if cache is not None:
                 try:
-                    new_cell.font = Font(name=cell.font.name, size=cell.font.size, bold=cell.font.bold, italic=cell.font.italic, vertAlign=cell.font.vertAlign, underline=cell.font.underline, strike=cell.font.strike, color=cell.font.color)
-                    new_cell.border = Border(left=cell.border.left, right=cell.border.right, top=cell.border.top, bottom=cell.border.bottom, diagonal=cell.border.diagonal, diagonal_direction=cell.border.diagonal_direction, outline=cell.border.outline, start=cell.border.start, end=cell.border.end)
-                    # new_cell.fill = Fill(fill_type=cell.fill.fill_type, start_color=cell.fill.start_color, end_color=cell.fill.end_color)
-                    new_cell.number_format = cell.number_format
-                    new_cell.protection = Protection(locked=cell.protection.locked, hidden=cell.protection.hidden)
-                    new_cell.alignment = Alignment(horizontal=cell.alignment.horizontal, vertical=cell.alignment.vertical, text_rotation=cell.alignment.text_rotation, wrap_text=cell.alignment.wrap_text, shrink_to_fit=cell.alignment.shrink_to_fit, indent=cell.alignment.indent)
-                except Exception as e:
-                    print(f"Warning: Could not copy style for cell {cell.coordinate}. Error: {e}")
-
-    # 2. Copy column dimensions
-    for col_letter, dim in source_sheet.column_dimensions.items():
-        if dim.width: # Only copy if width is set
-            target_sheet.column_dimensions[col_letter].width = dim.width
-        target_sheet.column_dimensions[col_letter].hidden = dim.hidden
-
-    # 3. Copy row dimensions
-    for row_index, dim in source_sheet.row_dimensions.items():
-        if dim.height: # Only copy if height is set
-            target_sheet.row_dimensions[row_index].height = dim.height
-        target_sheet.row_dimensions[row_index].hidden = dim.hidden
-
-    # 4. Copy merged cells
-    for merge_range in source_sheet.merged_cells.ranges:
-        target_sheet.merge_cells(str(merge_range))
-    
-    print(f"Finished copying properties to '{target_sheet.title}'.")
+                    cached = cache.get_many([h for h in block_hashes if h], config_hash)
+                except sqlite3.Error as e:
+                    print(f"Warning: Could not read the extraction cache. Error: {e}")
+                if cached:
+                    print(f"{sum(h in cached for h in block_hashes)} PDF(s) already extracted, taken from the cache.")
+
+            missing = [os.path.join(input_folder, filename)
+                       for filename, pdf_hash in zip(block_files, block_hashes) if pdf_hash not in cached]
+            extracted = _iter_extract_block(missing, fields, engine, executor, jobs)
+            new_records = {}
+            try:
+                for filename, pdf_hash in zip(block_files, block_hashes):
+                    if pdf_hash in cached:
+                        yield filename, pdf_hash, cached[pdf_hash]
+                        continue
+                    data = next(extracted)
+                    # A field that failed may work next time: such records are not cached
+                    if data is not None and pdf_hash and FIELD_ERROR not in data.values():
+                        new_records[pdf_hash] = data
+                    yield filename, pdf_hash, data
+            finally:
+                # Also when the run is cancelled or closed partway through the block
+                if cache is not None:
+                    try:
+                        cache.put_many(new_records, config_hash)
+                    except sqlite3.Error as e:
+                        print(f"Warning: Could not update the extraction cache. Error: {e}")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def extract_all_pdfs(input_folder, pdf_files, fields, jobs=None, engine="clip", cache=None, pdf_hashes=None):
+    """
+    Extracts data from every file in pdf_files (names relative to input_folder)
+    and returns the results as a list, in pdf_files order, with None for the
+    files that could not be processed. See iter_extract for the arguments.
+    """
+    return [data for filename, pdf_hash, data in
+            iter_extract(input_folder, fields, pdf_files, jobs, engine, cache, pdf_hashes)]
+
+# --- Extraction Pipeline ---
+
+# Records waiting between the extraction thread and the Excel writer
+PIPELINE_QUEUE_SIZE = 64
+_END_OF_RECORDS = object()
+
+# What the optional 'progress' callback of the pipeline receives. 'stage' is
+# "scan" (hashing the PDFs), "extract" or "write" (building the output);
+# 'done' and 'total' count PDFs, and 'filename' is the last one done (or None).
+ProgressEvent = namedtuple("ProgressEvent", ["stage", "done", "total", "filename"])
+
+def stream_records(input_folder, pdf_files, fields, jobs=None, engine="clip", cache=None, pdf_hashes=None,
+                   queue_size=PIPELINE_QUEUE_SIZE, progress=None, cancel=None):
+    """
+    Producer/consumer pipeline: a background thread runs iter_extract and puts
+    the records (see build_record) in a bounded queue, and this generator yields
+    them to the caller (the Excel writer) as they arrive. The workbook is written
+    while extraction is still running, and at most queue_size records wait in between.
+    An error in the extraction thread is raised here, once the records before it are consumed.
+    progress, if given, is called from the extraction thread with a ProgressEvent
+    after every PDF. Setting cancel (a threading.Event) stops the extraction
+    after the PDFs being extracted: the worker pool is shut down and the
+    stream ends normally, so the records extracted until then still get written.
+    """
+    records = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        # Gives up when the consumer has gone away, so the thread never blocks forever
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            if progress is not None:
+                progress(ProgressEvent("extract", 0, len(pdf_files), None))
+            extraction = iter_extract(input_folder, fields, pdf_files, jobs, engine, cache, pdf_hashes)
+            # Closing the generator shuts its worker pool down
+            with contextlib.closing(extraction):
+                for done, (filename, pdf_hash, data) in enumerate(extraction, start=1):
+                    record = build_record(filename, pdf_hash, data)
+                    if record is not None and not put(record):
+                        return
+                    if progress is not None:
+                        progress(ProgressEvent("extract", done, len(pdf_files), filename))
+                    if cancel is not None and cancel.is_set():
+                        print(f"Extraction cancelled after {done} of {len(pdf_files)} PDF(s).")
+                        break
+        except BaseException as e:
+            errors.append(e)
+        put(_END_OF_RECORDS)
+
+    producer = threading.Thread(target=produce, name="extraction-producer", daemon=True)
+    producer.start()
+    try:
+        while True:
+            record = records.get()
+            if record is _END_OF_RECORDS:
+                break
+            yield record
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        producer.join()
+
+# --- New Excel Helper Functions ---
 
 def get_header_map(sheet, header_row=4):
     """
@@ -145,341 +446,1486 @@ def get_header_map(sheet, header_row=4):
             header_map[header_name] = cell.column
     return header_map
 
-def write_data_to_sheet(sheet, header_map, data_row, target_row):
+# --- Shared Row Styles ---
+
+# Every written row uses the same black font and thin black border. The style
+# objects are built once here, and registered once per workbook (see get_cell_style).
+ROW_FONT = Font(color="000000")
+ROW_BORDER_SIDE = Side(border_style="thin", color="000000")
+ROW_BORDER = Border(left=ROW_BORDER_SIDE, right=ROW_BORDER_SIDE, top=ROW_BORDER_SIDE, bottom=ROW_BORDER_SIDE)
+
+# Columns that get the border: A (1) to N (14)
+ROW_BORDER_COLUMNS = range(1, 15)
+
+_cell_styles_by_workbook = weakref.WeakKeyDictionary()
+
+def get_cell_style(workbook, border, font, number_format=None):
     """
-    Writes a single PDF's data (data_row) to the specified sheet
-    at the target_row, using the header_map to find correct columns.
-    
-    --- NEW: This function also applies a border to the range A5:N5. ---
+    Returns the style array of a written cell (row border and/or black font,
+    plus an optional number format), registered in the workbook only once.
+    Cells then just take a copy of it (as openpyxl's own sheet copy does),
+    instead of having new Font/Border objects looked up for every cell.
     """
-    sheet.insert_rows(target_row)
-    # Define the standard black font
-    black_font = Font(color="000000")
-
-    # --- NEW: Define the border style ---
-    thin_border_side = Side(border_style="thin", color="000000")
-    thin_border = Border(
-        left=thin_border_side,
-        right=thin_border_side,
-        top=thin_border_side,
-        bottom=thin_border_side
-    )
-
-    # --- NEW: Apply border to row 5 (A5:N5) ---
-    # Loop from column 1 (A) to 14 (N)
-    for col_idx in range(1, 15): 
-        cell = sheet.cell(row=target_row, column=col_idx)
-        cell.border = thin_border
-    
-    # --- End of new border logic ---
-
-
-    # Maps config.json 'name' to Excel 'header name'
-    # This allows config and Excel to have slightly different names if needed,
-    # but here they are identical.
-    field_to_header_map = {
-        "FECHA": "FECHA",
-        "BATEA": "BATEA",
-        "EMPRESA": "EMPRESA",
-        "NIF EMPRESA": "NIF EMPRESA",
-        "KG BRUTOS": "KG BRUTOS",
-        "DESCUENTO": "DESCUENTO",
-        "KG NETOS": "KG NETOS"
-    }
-
-    for field_name, header_name in field_to_header_map.items():
-        if header_name in header_map:
-            col_idx = header_map[header_name]
-            value_to_write = data_row.get(field_name, "")
-            
-            try:
-                numeric_value = float(value_to_write)
-                cell = sheet.cell(row=target_row, column=col_idx, value=numeric_value)
-                cell.font = black_font  # --- APPLY FONT ---
-            except (ValueError, TypeError):
-                # Not a number, write as string
-                cell = sheet.cell(row=target_row, column=col_idx, value=data_row.get(field_name, ""))
-                cell.font = black_font  # --- APPLY FONT ---
+    cell_styles = _cell_styles_by_workbook.setdefault(workbook, {})
+    key = (border, font, number_format)
+    style = cell_styles.get(key)
+    if style is None:
+        style = StyleArray()
+        if border:
+            style.borderId = workbook._borders.add(ROW_BORDER)
+        if font:
+            style.fontId = workbook._fonts.add(ROW_FONT)
+        if number_format:
+            style.numFmtId = register_number_format(workbook, number_format)
+        cell_styles[key] = style
+    return style
+
+def register_number_format(workbook, number_format):
+    """Returns the id of number_format in the workbook, adding it if it is not a built-in format."""
+    if number_format in BUILTIN_FORMATS_REVERSE:
+        return BUILTIN_FORMATS_REVERSE[number_format]
+    return workbook._number_formats.add(number_format) + BUILTIN_FORMATS_MAX_SIZE
+
+def register_template_styles(layout, workbook):
+    """
+    Registers the styles of a TemplateLayout (see template_cache.py) in the
+    workbook, each font, fill, border... only once. Returns the style arrays,
+    in the order of layout.styles.
+    """
+    named_styles = workbook._named_styles
+    style_arrays = []
+    for style in layout.styles:
+        style_array = StyleArray()
+        style_array.fontId = workbook._fonts.add(style.font)
+        style_array.fillId = workbook._fills.add(style.fill)
+        style_array.borderId = workbook._borders.add(style.border)
+        style_array.alignmentId = workbook._alignments.add(style.alignment)
+        style_array.protectionId = workbook._protections.add(style.protection)
+        if isinstance(style.number_format, str):
+            style_array.numFmtId = register_number_format(workbook, style.number_format)
         else:
-            print(f"Warning: Header '{header_name}' not found in sheet '{sheet.title}'. Skipping data.")
+            style_array.numFmtId = style.number_format
+        # Named styles are not copied: fall back to 'Normal' unless the workbook has one with the same name
+        style_array.xfId = named_styles.names.index(style.named_style) if style.named_style in named_styles.names else 0
+        style_array.quotePrefix = style.quote_prefix
+        style_array.pivotButton = style.pivot_button
+        style_arrays.append(style_array)
+    return style_arrays
+
+# --- Write Plan ---
 
+# Used when config.json has no "output_columns": the columns written before
+# they became configurable. 'field' is the config.json 'name', 'header' the
+# Excel header name.
+DEFAULT_OUTPUT_COLUMNS = [
+    {"field": "FECHA", "header": "FECHA", "type": "auto"},
+    {"field": "BATEA", "header": "BATEA", "type": "auto"},
+    {"field": "EMPRESA", "header": "EMPRESA", "type": "auto"},
+    {"field": "NIF EMPRESA", "header": "NIF EMPRESA", "type": "auto"},
+    {"field": "KG BRUTOS", "header": "KG BRUTOS", "type": "auto"},
+    {"field": "DESCUENTO", "header": "DESCUENTO", "type": "auto"},
+    {"field": "KG NETOS", "header": "KG NETOS", "type": "auto"},
+]
 
-def get_or_create_sheet(workbook, batea_name, template_sheet_name="TEMPLATE"):
+# Headers whose values identify an albaran in a sheet (see probe_workbook), unless
+# config.json has a "duplicate_key": the columns every version of the tool has written
+DEFAULT_DUPLICATE_KEY = [column["header"] for column in DEFAULT_OUTPUT_COLUMNS]
+
+# One compiled entry of the write plan ('key': part of the duplicate key)
+OutputColumn = namedtuple("OutputColumn", ["field", "header", "type", "number_format", "date_format",
+                                           "decimal_separator", "thousands_separator", "key"])
+
+def compile_write_plan(config):
     """
-    Tries to find a sheet with batea_name. If not found,
-    copies the internal 'TEMPLATE' sheet and renames it.
+    Validates the "output_columns" of the config and compiles them, once per run,
+    into the write plan: a list of OutputColumn.
+    Raises RunError if the mapping is not valid.
     """
-    if batea_name in workbook.sheetnames:
-        return workbook[batea_name]
-    else:
-        print(f"Sheet '{batea_name}' not found. Creating it from '{template_sheet_name}'...")
-        
-        if template_sheet_name not in workbook.sheetnames:
-            print(f"CRITICAL ERROR: Template sheet '{template_sheet_name}' not found in the workbook.")
-            print("Cannot create new sheets.")
-            # We can't exit the program here, so we return None and let the main loop handle it
-            return None 
-            
-        template_sheet = workbook[template_sheet_name]
-        
-        # --- FIX: Add an explicit check for a valid worksheet object ---
-        if not hasattr(template_sheet, 'parent') or template_sheet.parent != workbook:
-            print(f"CRITICAL ERROR: The template sheet '{template_sheet_name}' is not a valid worksheet or "
-                  f"does not belong to this workbook.")
-            print("This can sometimes happen if the file is corrupt.")
-            return None
-        # --- END FIX ---
-
-        # --- FIX: Pass the object reference directly just to be safe ---
-        new_sheet = workbook.copy_worksheet(template_sheet)
-        new_sheet.title = batea_name
-        return new_sheet
-    
-def main():
-    """Main execution function."""
-    print("Starting PDF processing...")
-    
-    # We need to find the config file, whether running as .py or .exe
-    config_path = get_resource_path('config.json')
-    config = load_config(config_path)
-    
-    if config is None:
-        input("Press Enter to exit.")
-        return
+    output_columns = config.get('output_columns', DEFAULT_OUTPUT_COLUMNS)
+    field_names = {field['name'] for field in config.get('extraction_fields', [])}
+    field_names.add('Source File')
+    decimal_separator = config.get('decimal_separator', DEFAULT_DECIMAL_SEPARATOR)
+    thousands_separator = config.get('thousands_separator', DEFAULT_THOUSANDS_SEPARATOR)
+    duplicate_key = config.get('duplicate_key', DEFAULT_DUPLICATE_KEY)
 
-    input_folder = "input_pdfs"
-    if not setup_directories(input_folder):
-        input("Press Enter to exit.")
+    errors = []
+    write_plan = []
+    if not isinstance(output_columns, list):
+        errors.append("'output_columns' must be a list.")
+        output_columns = []
+    if not isinstance(decimal_separator, str) or len(decimal_separator) != 1:
+        errors.append("'decimal_separator' must be a single character.")
+    if not isinstance(thousands_separator, str) or len(thousands_separator) > 1 or thousands_separator == decimal_separator:
+        errors.append("'thousands_separator' must be empty or a single character different from the decimal separator.")
+    if not isinstance(duplicate_key, list) or not all(isinstance(header, str) for header in duplicate_key):
+        errors.append("'duplicate_key' must be a list of headers.")
+        duplicate_key = []
+
+    seen_headers = set()
+    for position, column in enumerate(output_columns, start=1):
+        if not isinstance(column, dict):
+            errors.append(f"output column #{position} must be an object.")
+            continue
+        field_name = column.get('field')
+        header_name = column.get('header', field_name)
+        column_type = column.get('type', 'auto')
+        number_format = column.get('number_format')
+        date_format = column.get('date_format', DEFAULT_DATE_FORMAT)
+
+        if not isinstance(field_name, str) or not field_name:
+            errors.append(f"output column #{position} has no 'field'.")
+            continue
+        if not isinstance(header_name, str) or not header_name.strip():
+            errors.append(f"output column '{field_name}' has an invalid 'header'.")
+            continue
+        if column_type not in COLUMN_TYPES:
+            errors.append(f"output column '{field_name}' has unknown type '{column_type}' "
+                          f"(expected one of: {', '.join(COLUMN_TYPES)}).")
+            continue
+        if number_format is not None and (not isinstance(number_format, str) or not number_format):
+            errors.append(f"output column '{field_name}' has an invalid 'number_format'.")
+            continue
+        if column_type == "date" and not is_valid_date_format(date_format):
+            errors.append(f"output column '{field_name}' has an invalid 'date_format'.")
+            continue
+        if header_name.strip() in seen_headers:
+            errors.append(f"header '{header_name}' is used by more than one output column.")
+            continue
+        if field_name not in field_names:
+            print(f"Warning: Output column '{field_name}' is not an extraction field. It will be left empty.")
+
+        if column_type == "date" and number_format is None:
+            # Without a format Excel would show the date as a plain number
+            number_format = DEFAULT_DATE_NUMBER_FORMAT
+
+        seen_headers.add(header_name.strip())
+        write_plan.append(OutputColumn(field_name, header_name.strip(), column_type, number_format, date_format,
+                                       decimal_separator, thousands_separator, header_name.strip() in duplicate_key))
+
+    for header in duplicate_key:
+        if header not in seen_headers and 'duplicate_key' in config:
+            errors.append(f"'duplicate_key' header '{header}' is not an output column.")
+
+    if errors:
+        message = "Invalid 'output_columns' in config.json:\n" + "\n".join(f"- {error}" for error in errors)
+        print(f"Error: {message}")
+        raise RunError("Config Error", message)
+    return write_plan
+
+# --- Column Plans ---
+
+_column_plans_by_sheet = weakref.WeakKeyDictionary()
+
+def compile_column_plan(sheet_title, header_map, write_plan, cell_style):
+    """
+    Binds the write plan to a sheet's header map, giving the list of cells the
+    writer fills: [(OutputColumn, column index, style), ...].
+    cell_style(border, number_format) gives the style of a cell with the black
+    font: a style array (see get_cell_style) or a patched cell format id.
+    Headers missing from the sheet are reported here, once per sheet.
+    """
+    column_plan = []
+    for column in write_plan:
+        if column.header not in header_map:
+            print(f"Warning: Header '{column.header}' not found in sheet '{sheet_title}'. Skipping data.")
+            continue
+        col_idx = header_map[column.header]
+        # Black font, keeping the row border inside A:N
+        style = cell_style(col_idx in ROW_BORDER_COLUMNS, column.number_format)
+        column_plan.append((column, col_idx, style))
+    return column_plan
+
+def workbook_cell_style(workbook):
+    """Returns the cell_style function of compile_column_plan for an openpyxl workbook."""
+    return lambda border, number_format: get_cell_style(workbook, border, True, number_format)
+
+def get_column_plan(sheet, write_plan, header_row=4):
+    """
+    Returns the sheet's column plan. The header row is read and compiled
+    only the first time a sheet is written to during the run.
+    """
+    column_plan = _column_plans_by_sheet.get(sheet)
+    if column_plan is None:
+        column_plan = compile_column_plan(sheet.title, get_header_map(sheet, header_row), write_plan,
+                                          workbook_cell_style(sheet.parent))
+        _column_plans_by_sheet[sheet] = column_plan
+    return column_plan
+
+def write_rows_to_sheet(sheet, data_rows, write_plan, first_row=5):
+    """
+    Writes several PDFs' data to the sheet, on top of the existing data.
+    All the new rows are inserted with a single shift of the existing ones,
+    then filled. As before, the last record ends up on top (first_row).
+    """
+    if not data_rows:
         return
+    column_plan = get_column_plan(sheet, write_plan, header_row=first_row - 1)
+    border_style = get_cell_style(sheet.parent, True, False)
+    typed_rows = convert_rows(data_rows, column_plan)
 
-    all_data = []
-    
-    # Get field names for the Excel columns
-    field_names = [field['name'] for field in config['extraction_fields']]
-    
-    pdf_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.pdf')]
+    sheet.insert_rows(first_row, amount=len(data_rows))
+    for offset, index in enumerate(reversed(range(len(data_rows)))):
+        target_row = first_row + offset
+        print(f"Writing data from '{data_rows[index]['Source File']}' to sheet '{sheet.title}', row {target_row}...")
+        fill_data_row(sheet, column_plan, border_style, typed_rows[index], target_row)
+
+def convert_rows(data_rows, column_plan):
+    """Converts the whole batch column by column (see convert_column), then returns it row by row."""
+    typed_columns = [convert_column([data_row.get(column.field, "") for data_row in data_rows], column)
+                     for column, col_idx, style in column_plan]
+    return list(zip(*typed_columns)) if typed_columns else [()] * len(data_rows)
+
+def fill_data_row(sheet, column_plan, border_style, values, target_row):
+    """
+    Writes a single PDF's already converted values to the specified sheet
+    at the target_row (which must already be free), following the
+    sheet's column plan (see compile_column_plan).
     
-    if not pdf_files:
-        print(f"No PDF files found in '{input_folder}'.")
-        input("Press Enter to exit.")
-        return
+    --- NEW: This function also applies a border to the range A5:N5. ---
+    """
+    # --- Apply border to the row (A:N) ---
+    for col_idx in ROW_BORDER_COLUMNS:
+        cell = sheet.cell(row=target_row, column=col_idx)
+        cell._style = copy(border_style)
+
+    for (column, col_idx, style), value in zip(column_plan, values):
+        cell = sheet.cell(row=target_row, column=col_idx, value=value)
+        cell._style = copy(style)
+
+
+# --- Sheet Registry ---
+
+# Characters Excel does not allow in a sheet title, and its longest title
+INVALID_TITLE_CHARACTERS_RE = re.compile(r"[\\/?*\[\]:]")
+MAX_TITLE_LENGTH = 31
+
+def get_sheet_title(batea_name):
+    """
+    Returns the sheet title for a BATEA name. Excel does not allow \\ / ? * [ ] :
+    (replaced with '_'), titles longer than 31 characters (cut) or an apostrophe
+    at either end (removed). Returns "" if nothing is left.
+    """
+    title = INVALID_TITLE_CHARACTERS_RE.sub("_", batea_name.strip())[:MAX_TITLE_LENGTH]
+    return title.strip("'").strip()
+
+def get_sheet_key(title):
+    """Normalizes a sheet title for lookups: Excel does not tell titles apart by case."""
+    return title.casefold()
+
+class SheetRegistry:
+    """
+    The sheets of a workbook by BATEA, for one run, so looking a BATEA up costs
+    the same however many sheets there are. 'sheets' is {title: sheet}, where a
+    sheet can be any object; create_sheet(title), if given, makes the ones that
+    are missing (and may return None). Each BATEA's title is worked out and
+    checked once (see get_sheet_title), with a warning if it had to change.
+    """
+
+    def __init__(self, sheets, create_sheet=None, warn=True):
+        self._sheets = {get_sheet_key(title): sheet for title, sheet in sheets.items()}
+        self._titles = {}
+        self.create_sheet = create_sheet
+        self.warn = warn
+
+    def title(self, batea_name):
+        """Returns the valid sheet title for batea_name, "" if there is none."""
+        title = self._titles.get(batea_name)
+        if title is None:
+            title = get_sheet_title(batea_name)
+            if self.warn and not title:
+                print(f"Warning: BATEA '{batea_name}' cannot be used as a sheet name.")
+            elif self.warn and title != batea_name.strip():
+                print(f"Warning: BATEA '{batea_name}' is not a valid sheet name. Using '{title}'.")
+            self._titles[batea_name] = title
+        return title
+
+    def get(self, batea_name):
+        """Returns the sheet of batea_name, or None if the workbook does not have it."""
+        return self._sheets.get(get_sheet_key(self.title(batea_name)))
+
+    def get_or_create(self, batea_name):
+        """Returns the sheet of batea_name, creating it if needed. Returns None if it cannot be created."""
+        sheet = self.get(batea_name)
+        title = self.title(batea_name)
+        if sheet is None and title and self.create_sheet is not None:
+            sheet = self.create_sheet(title)
+            if sheet is not None:
+                self._sheets[get_sheet_key(title)] = sheet
+        return sheet
+
+    def values(self):
+        """Returns the registered sheets, in the order they were added."""
+        return list(self._sheets.values())
+
+def workbook_sheet_registry(workbook, template_sheet_name="TEMPLATE"):
+    """Returns the SheetRegistry of an openpyxl workbook; missing sheets are copied from its TEMPLATE sheet."""
+    return SheetRegistry({sheet.title: sheet for sheet in workbook.worksheets},
+                         lambda title: copy_template_sheet(workbook, title, template_sheet_name))
+
+def copy_template_sheet(workbook, title, template_sheet_name="TEMPLATE"):
+    """
+    Copies the internal 'TEMPLATE' sheet as a new sheet called title.
+    Returns None if the workbook has no usable TEMPLATE sheet.
+    """
+    print(f"Sheet '{title}' not found. Creating it from '{template_sheet_name}'...")
+
+    if template_sheet_name not in workbook.sheetnames:
+        print(f"CRITICAL ERROR: Template sheet '{template_sheet_name}' not found in the workbook.")
+        print("Cannot create new sheets.")
+        # We can't exit the program here, so we return None and let the main loop handle it
+        return None
+
+    template_sheet = workbook[template_sheet_name]
+
+    # --- FIX: Add an explicit check for a valid worksheet object ---
+    if not hasattr(template_sheet, 'parent') or template_sheet.parent != workbook:
+        print(f"CRITICAL ERROR: The template sheet '{template_sheet_name}' is not a valid worksheet or "
+              f"does not belong to this workbook.")
+        print("This can sometimes happen if the file is corrupt.")
+        return None
+    # --- END FIX ---
+
+    # --- FIX: Pass the object reference directly just to be safe ---
+    new_sheet = workbook.copy_worksheet(template_sheet)
+    new_sheet.title = title
+    return new_sheet
+
+# --- Run Errors ---
 
-    print(f"Found {len(pdf_files)} PDF(s) to process...")
+class RunError(Exception):
+    """
+    Raised when the Excel stage cannot go on. The message has already been
+    printed to the log; 'title' is a short category used by the GUI's error dialog.
+    """
+    def __init__(self, title, message):
+        super().__init__(message)
+        self.title = title
+
+# --- Written Albaranes Index ---
+
+def get_index_path(output_filename):
+    """
+    Returns the path of the sidecar index listing the albaranes already in an
+    output: 'datos.index.json' for the workbook 'datos.xlsx', and the full name
+    plus '.index.json' for the other formats ('datos.sqlite.index.json',
+    'datos_csv.index.json'), so outputs of the same name never share an index.
+    """
+    base_name, extension = os.path.splitext(output_filename)
+    if extension.lower() == ".xlsx":
+        return base_name + ".index.json"
+    return output_filename + ".index.json"
 
+def load_written_index(output_filename):
+    """
+    Loads the sidecar index of output_filename as a dict
+    {SHA-256 of the PDF: {"file": ..., "batea": ...}}, so checking whether an
+    albaran is already in the workbook never requires reading its sheets.
+    Returns an empty index when the workbook or its index does not exist yet.
+    """
+    index_path = get_index_path(output_filename)
+    if not os.path.exists(output_filename) or not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)['albaranes']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Warning: Could not read the index '{index_path}'. Error: {e}")
+        print("All PDFs will be written again.")
+        return {}
+
+def save_written_index(output_filename, written_index):
+    """Saves the sidecar index of output_filename (through a temporary file, so it is never left half-written)."""
+    index_path = get_index_path(output_filename)
+    temp_path = index_path + ".tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": 1, "albaranes": written_index}, f, ensure_ascii=False, indent=0)
+        os.replace(temp_path, index_path)
+    except OSError as e:
+        print(f"Warning: Could not save the index '{index_path}'. Error: {e}")
+        print("The PDFs of this run may be written again next time.")
+
+def add_to_written_index(written_index, records):
+    """Adds the records that made it into the workbook to the index."""
+    for record in records:
+        pdf_hash = record.get('Source Hash')
+        if pdf_hash:
+            written_index[pdf_hash] = {"file": record['Source File'], "batea": record.get('BATEA', "")}
+
+def hash_pdf_files(input_folder, pdf_files):
+    """Returns the SHA-256 of every PDF, or None for the ones that cannot be read."""
+    pdf_hashes = []
     for filename in pdf_files:
-        pdf_path = os.path.join(input_folder, filename)
-        print(f"Processing '{filename}'...")
-        data = extract_data_from_pdf(pdf_path, config['extraction_fields'])
-        
-        if data:
-            data["FECHA"] = data["FECHA"].split(" ")[0]
-            data['Source File'] = filename  # Add source filename for reference
-            all_data.append(data)
-
-    if not all_data:
-        print("No data was successfully extracted from any PDF.")
-        input("Press Enter to exit.")
-        return
+        try:
+            pdf_hashes.append(file_sha256(os.path.join(input_folder, filename)))
+        except OSError:
+            # Unreadable file: let the extraction report the error
+            pdf_hashes.append(None)
+    return pdf_hashes
 
-    print("Data extraction complete. Generating Excel file...")
-    
-    # DEBUG: Print the full DataFrame
-    # Create a pandas DataFrame
-    # df = pd.DataFrame(all_data)
-    # print("\nExtracted DataFrame:")
-    # try:
-    #     # Print without truncation
-    #     with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 0):
-    #         print(df.to_string(index=False))
-    # except Exception:
-    #     # Fallback
-    #     print(df)
-    
-     # --- 2. Get Template and Output File Paths ---
-    template_path = get_resource_path('PLANTILLA.xlsx')
+def select_new_pdfs(pdf_files, pdf_hashes, written_index):
+    """
+    Leaves out the PDFs whose contents are already in the workbook, and the
+    second copy of any PDF that appears twice in the folder.
+    Returns the remaining (pdf_files, pdf_hashes).
+    """
+    new_files, new_hashes = [], []
+    seen = set(written_index)
+    for filename, pdf_hash in zip(pdf_files, pdf_hashes):
+        if pdf_hash is not None:
+            if pdf_hash in seen:
+                continue
+            seen.add(pdf_hash)
+        new_files.append(filename)
+        new_hashes.append(pdf_hash)
+
+    skipped = len(pdf_files) - len(new_files)
+    if skipped:
+        print(f"Skipping {skipped} PDF(s) already in the workbook.")
+    return new_files, new_hashes
+
+def build_record(filename, pdf_hash, data):
+    """
+    Turns one extraction result into the record written to Excel, or None if
+    the PDF failed. data itself is left as extracted: it is also what goes to
+    the extraction cache.
+    """
+    if not data:
+        return None
+    record = dict(data)
+    record["FECHA"] = record["FECHA"].split(" ")[0]
+    record['Source File'] = filename  # Add source filename for reference
+    record['Source Hash'] = pdf_hash
+    return record
+
+def build_records(pdf_files, pdf_hashes, results):
+    """Turns the extraction results into the records written to Excel, dropping the failed PDFs."""
+    all_data = []
+    for filename, pdf_hash, data in zip(pdf_files, pdf_hashes, results):
+        record = build_record(filename, pdf_hash, data)
+        if record is not None:
+            all_data.append(record)
+    return all_data
+
+# --- Excel Stage ---
+
+def restore_template_sheet(workbook, output_filename, template_path, template_sheet_name="TEMPLATE"):
+    """Recreates the TEMPLATE sheet of an existing workbook from PLANTILLA.xlsx. Raises RunError on failure."""
+    print(f"Warning: '{template_sheet_name}' sheet not found in '{output_filename}'.")
+    print("Attempting to create it from 'PLANTILLA.xlsx'...")
+
+    # Load the external template file
     if not os.path.exists(template_path):
-        print(f"Error: Template file 'PLANTILLA.xlsx' not found.")
-        print("Please make sure it is in the same directory as the .exe")
-        input("Press Enter to exit.")
-        return
+        message = f"CRITICAL ERROR: 'PLANTILLA.xlsx' not found at {template_path}. Cannot create 'TEMPLATE' sheet."
+        print(message)
+        raise RunError("Template Error", message)
 
-    output_filename = input("Enter the name for the output Excel file (e.g., 'datos.xlsx'): ")
-    if not output_filename.lower().endswith('.xlsx'):
-        output_filename += '.xlsx'
+    try:
+        layout = load_template_layout(template_path)
 
-    # --- 3. Determine Mode: Create New or Update Existing ---
-    
-    if os.path.exists(output_filename):
-        # --- MODE 2: UPDATE EXISTING FILE ---
-        print(f"File '{output_filename}' exists. Will update it.")
-        
-        # --- NEW BACKUP LOGIC START ---
-        try:
-            backup_dir = ".old"
-            os.makedirs(backup_dir, exist_ok=True)
-            
-            # Get timestamp
-            now = datetime.datetime.now()
-            timestamp = now.strftime("%Y-%m-%d_%H%M%S")
-            
-            # Create new filename
-            base_name, extension = os.path.splitext(output_filename)
-            backup_filename = f"{base_name}_{timestamp}{extension}"
-            backup_path = os.path.join(backup_dir, backup_filename)
-            
-            # Copy the file
-            shutil.copy(output_filename, backup_path)
-            print(f"Created backup of '{output_filename}' at '{backup_path}'")
-            
-        except Exception as e:
-            print(f"Warning: Could not create backup for '{output_filename}'. Error: {e}")
-            # Continue execution even if backup fails.
-        # --- NEW BACKUP LOGIC END ---
-        
-        try:
-            workbook = load_workbook(output_filename)
-            # --- FIX: We no longer need to load the external template ---
-            # template_wb = load_workbook(template_path)
-            # template_sheet = template_wb.active 
-        except (InvalidFileException, FileNotFoundError):
-            print(f"Error: Could not open '{output_filename}'. It might be corrupt or not a valid .xlsx file.")
-            input("Press Enter to exit.")
-            return
-        except Exception as e:
-            print(f"Error loading workbook: {e}")
-            input("Press Enter to exit.")
+        # Create the new TEMPLATE sheet in the destination workbook
+        target_sheet = workbook.create_sheet(title=template_sheet_name)
+        fill_template_sheet(layout, target_sheet)
+        print(f"Successfully created 'TEMPLATE' sheet in '{output_filename}'.")
+
+    except Exception as e:
+        print(f"CRITICAL ERROR: Failed to create 'TEMPLATE' sheet from 'PLANTILLA.xlsx'.")
+        print(f"Error details: {e}")
+        raise RunError("Template Error", f"CRITICAL ERROR: Failed to create 'TEMPLATE' sheet from 'PLANTILLA.xlsx'.\n{e}")
+
+# Records written at a time: every sheet gets one row shift per chunk
+WRITE_CHUNK_SIZE = 500
+
+def iter_chunks(records, size):
+    """Yields the records in lists of up to 'size', consuming the iterable lazily."""
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
             return
-        
-        # --- MODIFIED: Check for TEMPLATE sheet and create if missing ---
-        template_sheet_name = "TEMPLATE"
-        if template_sheet_name not in workbook.sheetnames:
-            print(f"Warning: '{template_sheet_name}' sheet not found in '{output_filename}'.")
-            print("Attempting to create it from 'PLANTILLA.xlsx'...")
-            
-            try:
-                # Load the external template file
-                if not os.path.exists(template_path):
-                     print(f"CRITICAL ERROR: 'PLANTILLA.xlsx' not found at {template_path}. Cannot create 'TEMPLATE' sheet.")
-                     input("Press Enter to exit.")
-                     return
-
-                template_wb = load_workbook(template_path)
-                source_sheet = template_wb.active
-                
-                # Create the new TEMPLATE sheet in the destination workbook
-                target_sheet = workbook.create_sheet(title=template_sheet_name)
-                
-                # Manually copy all properties
-                copy_sheet_properties(source_sheet, target_sheet)
-                
-                template_wb.close()
-                print(f"Successfully created 'TEMPLATE' sheet in '{output_filename}'.")
-            
-            except Exception as e:
-                print(f"CRITICAL ERROR: Failed to create 'TEMPLATE' sheet from 'PLANTILLA.xlsx'.")
-                print(f"Error details: {e}")
-                input("Press Enter to exit.")
-                return
-        # --- END MODIFICATION ---
-            
-        for data_row in all_data:
+        yield chunk
+
+def index_entry(record):
+    """Keeps only what add_to_written_index needs from a record written to the workbook."""
+    return {'Source File': record['Source File'], 'Source Hash': record.get('Source Hash'),
+            'BATEA': record.get('BATEA', "")}
+
+def update_workbook(all_data, output_filename, template_path, write_plan):
+    """
+    MODE 2: adds the records to an existing workbook (export_to_excel backs it up).
+    all_data can be any iterable of records; it is consumed WRITE_CHUNK_SIZE records at a time.
+    Returns the workbook and the records that were written (see index_entry).
+    """
+    try:
+        workbook = load_workbook(output_filename)
+    except (InvalidFileException, FileNotFoundError):
+        message = f"Error: Could not open '{output_filename}'. It might be corrupt or not a valid .xlsx file."
+        print(message)
+        raise RunError("File Error", message)
+    except Exception as e:
+        print(f"Error loading workbook: {e}")
+        raise RunError("File Error", f"Error loading workbook: {e}")
+
+    # Check for TEMPLATE sheet and create if missing
+    template_sheet_name = "TEMPLATE"
+    if template_sheet_name not in workbook.sheetnames:
+        restore_template_sheet(workbook, output_filename, template_path, template_sheet_name)
+
+    sheets = workbook_sheet_registry(workbook, template_sheet_name)
+    written = []
+    for chunk in iter_chunks(all_data, WRITE_CHUNK_SIZE):
+        # Group data by BATEA, so every sheet gets the chunk's new rows in one go
+        data_by_batea = {}
+        for data_row in chunk:
             batea = data_row.get("BATEA", "").strip()
             if not batea:
                 print(f"Warning: PDF '{data_row['Source File']}' has no BATEA. Skipping.")
                 continue
-            
-            # --- FIX: Update function call ---
-            sheet = get_or_create_sheet(workbook, batea, template_sheet_name)
-            
+            data_by_batea.setdefault(batea, []).append(data_row)
+
+        for batea, batea_data in data_by_batea.items():
+            sheet = sheets.get_or_create(batea)
+
             if sheet is None:
-                print(f"Skipping PDF '{data_row['Source File']}' due to missing template sheet.")
+                for data_row in batea_data:
+                    print(f"Skipping PDF '{data_row['Source File']}' due to missing template sheet.")
                 continue
-                
-            header_map = get_header_map(sheet, header_row=4)
-            
-            # Find next empty row (start from row 5)
-            target_row = 5            
-            print(f"Writing data from '{data_row['Source File']}' to sheet '{batea}', row {target_row}...")
-            write_data_to_sheet(sheet, header_map, data_row, target_row)
-        
-        # template_wb.close() # No longer needed
 
-    else:
-        # --- MODE 1: CREATE NEW FILE ---
-        print(f"Creating new file '{output_filename}' from template...")
-        
+            # New rows always go on top of the data (row 5)
+            write_rows_to_sheet(sheet, batea_data, write_plan, first_row=5)
+            written.extend(index_entry(data_row) for data_row in batea_data)
+
+    return workbook, written
+
+def create_workbook(all_data, output_filename, template_path, write_plan):
+    """
+    MODE 1: builds a new workbook from the template, one sheet per BATEA.
+    all_data can be any iterable of records; it is consumed WRITE_CHUNK_SIZE records at a time.
+    Returns the workbook and the records that were written (see index_entry).
+    """
+    print(f"Creating new file '{output_filename}' from template...")
+
+    try:
+        layout = load_template_layout(template_path)
+
+        # The first sheet of the new workbook becomes the template
+        workbook = Workbook()
+        template_sheet = workbook.active
+        template_sheet_name = "TEMPLATE"
+        template_sheet.title = template_sheet_name
+        fill_template_sheet(layout, template_sheet)
+
+    except (InvalidFileException, FileNotFoundError):
+        message = f"Error: Could not open the template for the new file '{output_filename}'."
+        print(message)
+        raise RunError("File Error", message)
+    except Exception as e:
+        print(f"Error loading new workbook: {e}")
+        raise RunError("File Error", f"Error loading new workbook: {e}")
+
+    sheets = workbook_sheet_registry(workbook, template_sheet_name)
+    written = []
+    for chunk in iter_chunks(all_data, WRITE_CHUNK_SIZE):
         # Group data by BATEA
         data_by_batea = {}
-        for row in all_data:
+        for row in chunk:
             batea = row.get('BATEA', 'UNKNOWN_BATEA').strip()
             if not batea:
                 batea = 'UNKNOWN_BATEA'
             if batea not in data_by_batea:
                 data_by_batea[batea] = []
             data_by_batea[batea].append(row)
-        
-        # Copy template to the new output filename
-        shutil.copy(template_path, output_filename)
-        
-        try:
-            # --- FIX START ---
-            # We only load the new output file
-            workbook = load_workbook(output_filename)
-            
-            # Get the first sheet (which is our template) and rename it.
-            template_sheet = workbook.active
-            template_sheet_name = "TEMPLATE"
-            template_sheet.title = template_sheet_name
-            # --- FIX END ---
-            
-        except (InvalidFileException, FileNotFoundError):
-            print(f"Error: Could not open the new file '{output_filename}'.")
-            input("Press Enter to exit.")
-            return
-        except Exception as e:
-            print(f"Error loading new workbook: {e}")
-            input("Press Enter to exit.")
-            return
 
-        # is_first_sheet = True # No longer needed
         for batea_name, batea_data in data_by_batea.items():
-            # --- FIX: Always copy the template sheet ---
-            print(f"Creating sheet '{batea_name}'...")
-            sheet = get_or_create_sheet(workbook, batea_name, template_sheet_name)
-            
+            # copy_template_sheet reports each new sheet
+            sheet = sheets.get_or_create(batea_name)
+
             if sheet is None:
                 print(f"Skipping Batea '{batea_name}' due to missing template sheet.")
                 continue
-            
-            header_map = get_header_map(sheet, header_row=4)
-            
-            # Write all data for this batea, starting at row 5
-            target_row = 5
-            for data_row in batea_data:
-                print(f"Writing data from '{data_row['Source File']}' to sheet '{batea_name}', row {target_row}...")
-                write_data_to_sheet(sheet, header_map, data_row, target_row)
-        
-        # template_wb.close() # No longer needed
-
-    # --- 4. Save and Exit ---
+
+            # Write this chunk's data for this batea, starting at row 5
+            write_rows_to_sheet(sheet, batea_data, write_plan, first_row=5)
+            written.extend(index_entry(row) for row in batea_data)
+
+    return workbook, written
+
+# --- Update Probe ---
+
+class WorkbookProbe:
+    """
+    Tells which records an existing workbook already holds, reading it without
+    loading it: the key of a row is the value of each of its duplicate key
+    columns (see compile_write_plan), as convert_column gives it. A sheet is
+    only read the first time a record targets it, and then only its header
+    row and key columns (see XlsxPatcher.read_cells).
+    """
+
+    def __init__(self, reader, write_plan, first_row=5):
+        self.reader = reader
+        self.write_plan = write_plan
+        self.first_row = first_row
+        self.sheetnames = [sheet_name for sheet_name in reader.sheetnames if sheet_name != "TEMPLATE"]
+        self.checked_rows = 0
+        self.checked_sheets = 0
+        self._sheets = {}
+
+    def sheet_keys(self, sheet_name):
+        """
+        Returns (Counter of the keys of the sheet's data rows, [(OutputColumn,
+        column index), ...] the key is made of), reading the sheet on first use.
+        A sheet that cannot be read is taken as empty, with a warning.
+        """
+        if sheet_name not in self._sheets:
+            try:
+                header_map = self.reader.read_header_map(sheet_name, self.first_row - 1)
+                columns = [(column, header_map[column.header]) for column in self.write_plan
+                           if column.key and column.header in header_map]
+                rows = self.reader.read_cells(sheet_name, self.first_row,
+                                              columns=[col_idx for column, col_idx in columns]) if columns else {}
+            except PatchNotPossible as e:
+                print(f"Warning: Could not check which records sheet '{sheet_name}' already holds ({e}).")
+                columns, rows = [], {}
+            typed_columns = [convert_sheet_column([cells.get(col_idx) for cells in rows.values()], column)
+                             for column, col_idx in columns]
+            self._sheets[sheet_name] = (Counter(zip(*typed_columns)), columns)
+            self.checked_rows += len(rows)
+            self.checked_sheets += 1
+        return self._sheets[sheet_name]
+
+def probe_workbook(output_filename, write_plan, first_row=5):
+    """
+    Opens an existing workbook to learn which records it already holds (see
+    WorkbookProbe). Returns the WorkbookProbe, or None if the workbook cannot
+    be read (the update itself then reports the error).
+    """
+    try:
+        return WorkbookProbe(XlsxPatcher(output_filename), write_plan, first_row)
+    except PatchNotPossible as e:
+        print(f"Warning: Could not check which records '{output_filename}' already holds ({e}).")
+        return None
+
+def record_keys(records, columns):
+    """Returns the key of each record for a sheet's key columns (see probe_workbook)."""
+    typed_columns = [convert_column([record.get(column.field, "") for record in records], column, warn=False)
+                     for column, col_idx in columns]
+    return list(zip(*typed_columns)) if typed_columns else [()] * len(records)
+
+def skip_present_records(records, probe, present):
+    """
+    Yields the records that are not in the probed workbook yet. The ones it
+    already holds are reported and added to 'present' (see index_entry).
+    Every row of the workbook stands for one record, so a PDF copied twice
+    with the same data is still written once more than the workbook holds.
+    Only the sheets the records go to are read.
+    """
+    sheets = SheetRegistry({sheet_name: sheet_name for sheet_name in probe.sheetnames}, warn=False)
+    for chunk in iter_chunks(records, WRITE_CHUNK_SIZE):
+        records_by_sheet = {}
+        for record in chunk:
+            sheet_name = sheets.get(record.get("BATEA", "").strip())
+            if sheet_name is not None:
+                records_by_sheet.setdefault(sheet_name, []).append(record)
+
+        already_there = set()
+        for sheet_name, sheet_records in records_by_sheet.items():
+            existing, key_columns = probe.sheet_keys(sheet_name)
+            if not existing:
+                continue
+            for record, key in zip(sheet_records, record_keys(sheet_records, key_columns)):
+                if existing[key] > 0:
+                    existing[key] -= 1
+                    already_there.add(id(record))
+                    print(f"Skipping PDF '{record['Source File']}': its data is already in sheet '{sheet_name}'.")
+                    present.append(index_entry(record))
+
+        for record in chunk:
+            if id(record) not in already_there:
+                yield record
+
+    print(f"Checked {probe.checked_rows} row(s) in {probe.checked_sheets} sheet(s) of '{probe.reader.path}' "
+          f"for records already there.")
+
+# --- In-Place Updates ---
+
+def iter_patched_rows(sheet_name, column_plan, spool, border_style, first_row=5):
+    """
+    Yields the cells of each new row of a patched sheet, from top to bottom, as
+    (column index, value, cell format id): the same cells write_rows_to_sheet fills.
+    """
+    for offset, (record, values) in enumerate(iter_spooled_rows(spool, column_plan)):
+        print(f"Writing data from '{record['Source File']}' to sheet '{sheet_name}', row {first_row + offset}...")
+        cells = {col_idx: (col_idx, None, border_style) for col_idx in ROW_BORDER_COLUMNS}
+        for (column, col_idx, style), value in zip(column_plan, values):
+            cells[col_idx] = (col_idx, value, style)
+        yield list(cells.values())
+
+def update_with_openpyxl(all_data, output_filename, template_path, write_plan, backup):
+    """
+    Runs the full openpyxl update (update_workbook) and saves it, once the
+    backup (a BackupJob) is done. Returns the records that were written.
+    """
+    workbook, written = update_workbook(all_data, output_filename, template_path, write_plan)
+    backup.wait()
+    save_output_workbook(workbook, output_filename)
+    return written
+
+def patch_cell_formats(patcher, workbook):
+    """
+    Returns the id in the patched workbook of each cell format of an openpyxl
+    workbook (its cellXfs, in order), adding the ones it does not have yet.
+    """
+    cell_formats = []
+    for style in workbook._cell_styles:
+        if style.numFmtId >= BUILTIN_FORMATS_MAX_SIZE:
+            number_format = workbook._number_formats[style.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+        else:
+            number_format = style.numFmtId
+        cell_formats.append(patcher.add_cell_format(
+            font=workbook._fonts[style.fontId], fill=workbook._fills[style.fillId],
+            border=workbook._borders[style.borderId], number_format=number_format,
+            alignment=workbook._alignments[style.alignmentId], protection=workbook._protections[style.protectionId],
+            named_style=workbook._named_styles[style.xfId].name, quote_prefix=style.quotePrefix,
+            pivot_button=style.pivotButton))
+    return cell_formats
+
+def add_patched_sheets(patcher, new_sheets, layout, write_plan):
+    """
+    Builds the sheets a patched update adds, {title: RecordSpool}, from the
+    template like create_workbook_write_only, in a temporary write-only workbook
+    the patcher copies them from on save (see XlsxPatcher.add_sheets).
+    Returns the path of that workbook, for the caller to remove after the save.
+    """
+    workbook = Workbook(write_only=True)
+    # Dates are written as numbers, counted from the patched workbook's epoch
+    workbook.epoch = patcher.epoch
+    # The template's named styles only need their names: the patched workbook's own are used
+    for name in {style.named_style for style in layout.styles} - set(workbook._named_styles.names) - {None}:
+        workbook.add_named_style(NamedStyle(name=name))
+    template_styles = register_template_styles(layout, workbook)
+    header_map = layout.header_map()
+
+    for title, spool in new_sheets.items():
+        print(f"Sheet '{title}' not found. Creating it from the template...")
+        sheet = workbook.create_sheet(title=title)
+        column_plan = compile_column_plan(sheet.title, header_map, write_plan, workbook_cell_style(workbook))
+        write_spooled_sheet(sheet, column_plan, spool, layout, template_styles)
+
+    fd, temp_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        workbook.save(temp_path)
+        patcher.add_sheets(temp_path, patch_cell_formats(patcher, workbook))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+def update_workbook_in_place(all_data, output_filename, template_path, write_plan, backup):
+    """
+    MODE 2, fast path: adds the records to an existing workbook by patching its
+    XML (see xlsx_patch). Only the sheets that gain rows are rewritten, new
+    sheets are built from the template and added as new parts, and every other
+    part of the file is copied as it is, so the workbook is never loaded.
+    When the workbook still has a TEMPLATE sheet, or a sheet has something the
+    patcher cannot move, the whole update is done with openpyxl instead. The
+    file is only replaced once the backup (a BackupJob) is done.
+    Returns the records that were written. Raises RunError like export_to_excel.
+    """
+    try:
+        patcher = XlsxPatcher(output_filename)
+    except PatchNotPossible as e:
+        print(f"Note: Updating with openpyxl, the workbook cannot be patched ({e}).")
+        return update_with_openpyxl(all_data, output_filename, template_path, write_plan, backup)
+
+    # Group data by sheet; every sheet's rows are kept aside until it is rewritten
+    sheets = SheetRegistry({sheet_name: sheet_name for sheet_name in patcher.sheetnames})
+    spools = {}
+    written = []
+    new_sheets_path = None
+    try:
+        for chunk in iter_chunks(all_data, WRITE_CHUNK_SIZE):
+            data_by_batea = {}
+            for data_row in chunk:
+                batea = data_row.get("BATEA", "").strip()
+                if not batea:
+                    print(f"Warning: PDF '{data_row['Source File']}' has no BATEA. Skipping.")
+                    continue
+                data_by_batea.setdefault(batea, []).append(data_row)
+            for batea, batea_data in data_by_batea.items():
+                sheet_name = sheets.get(batea) or sheets.title(batea)
+                if not sheet_name:
+                    for data_row in batea_data:
+                        print(f"Skipping PDF '{data_row['Source File']}': no sheet can be named after its BATEA.")
+                    continue
+                spools.setdefault(sheet_name, RecordSpool()).add(batea_data)
+                written.extend(index_entry(data_row) for data_row in batea_data)
+
+        def spooled_records():
+            return (data_row for spool in spools.values() for batch in spool.iter_batches() for data_row in batch)
+
+        if "TEMPLATE" in patcher.sheetnames:
+            print("Note: Updating with openpyxl, the workbook has its own 'TEMPLATE' sheet.")
+            return update_with_openpyxl(spooled_records(), output_filename, template_path, write_plan, backup)
+        new_sheets = {sheet_name: spool for sheet_name, spool in spools.items() if sheets.get(sheet_name) is None}
+        layout = get_template_layout(template_path) if new_sheets else None
+
+        try:
+            border_style = patcher.add_cell_style(border=ROW_BORDER)
+            cell_style = lambda border, number_format: patcher.add_cell_style(
+                ROW_FONT, ROW_BORDER if border else None, number_format)
+            for sheet_name, spool in spools.items():
+                if sheet_name in new_sheets:
+                    continue
+                column_plan = compile_column_plan(sheet_name, patcher.read_header_map(sheet_name), write_plan, cell_style)
+                patcher.insert_rows(sheet_name, 5, spool.count,
+                                    iter_patched_rows(sheet_name, column_plan, spool, border_style))
+            if new_sheets:
+                new_sheets_path = add_patched_sheets(patcher, new_sheets, layout, write_plan)
+
+            backup.wait()
+            patcher.save(output_filename)
+        except PatchNotPossible as e:
+            print(f"Note: Updating with openpyxl, the workbook cannot be patched ({e}).")
+            return update_with_openpyxl(spooled_records(), output_filename, template_path, write_plan, backup)
+        except Exception as e:
+            raise_save_error(output_filename, e)
+    finally:
+        for spool in spools.values():
+            spool.close()
+        if new_sheets_path is not None:
+            os.remove(new_sheets_path)
+
+    print(f"\nSuccess! Data saved to '{output_filename}'")
+    return written
+
+# --- Write-Only Output ---
+
+class RecordSpool:
+    """
+    Holds records in a temporary file, a batch at a time, until they are written.
+    They arrive oldest first but go on top of the sheet newest first, and a sheet
+    that is streamed out (write-only or patched) can only be written top to bottom.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._offsets = []
+        self._file = tempfile.TemporaryFile()
+
+    def add(self, records):
+        """Appends a batch of records to the spool."""
+        self._offsets.append(self._file.tell())
+        pickle.dump(records, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.count += len(records)
+
+    def iter_batches(self, newest_first=False):
+        """Yields the spooled batches, in the order they were added or (newest_first) the other way round."""
+        for offset in (reversed(self._offsets) if newest_first else self._offsets):
+            self._file.seek(offset)
+            batch = pickle.load(self._file)
+            yield batch[::-1] if newest_first else batch
+
+    def close(self):
+        self._file.close()
+
+def iter_spooled_rows(spool, column_plan):
+    """Yields (record, converted values) for every spooled record, newest first, converting a batch at a time."""
+    for batch in spool.iter_batches(newest_first=True):
+        yield from zip(batch, convert_rows(batch, column_plan))
+
+def copy_template_layout(layout, sheet, shift, template_styles, first_row=5):
+    """
+    Copies the template's sheet-level layout (column widths, row heights,
+    merged cells, sheet properties such as the tab colour, and page setup) from
+    a TemplateLayout to a sheet; for a write-only sheet, before any row is written.
+    Rows from first_row down are moved 'shift' rows lower, below the data.
+    """
+    for col_letter, fields, style_key in layout.column_dimensions:
+        new_dim = ColumnDimension(sheet, index=col_letter, **fields)
+        if style_key is not None:
+            new_dim._style = copy(template_styles[style_key])
+        sheet.column_dimensions[col_letter] = new_dim
+
+    for row_index, fields, style_key in layout.row_dimensions:
+        new_index = row_index + shift if row_index >= first_row else row_index
+        new_dim = RowDimension(sheet, index=new_index, **fields)
+        if style_key is not None:
+            new_dim._style = copy(template_styles[style_key])
+        sheet.row_dimensions[new_index] = new_dim
+
+    for coord in layout.merged_cells:
+        new_range = CellRange(coord)
+        if new_range.min_row >= first_row:
+            new_range.shift(row_shift=shift)
+        if isinstance(sheet, Worksheet):
+            # A regular sheet also turns the covered cells into merged cells
+            sheet.merge_cells(new_range.coord)
+        else:
+            sheet.merged_cells.add(new_range)
+
+    sheet.sheet_properties = copy(layout.sheet_properties)
+    sheet.sheet_format = copy(layout.sheet_format)
+    sheet.page_margins = copy(layout.page_margins)
+    sheet.page_setup = copy(layout.page_setup)
+    sheet.page_setup._parent = sheet
+    sheet.print_options = copy(layout.print_options)
+
+def fill_template_sheet(layout, sheet):
+    """
+    Fills an empty regular (not write-only) sheet with the template described
+    by a TemplateLayout: its cells and styles, then its sheet-level layout
+    (see copy_template_layout). Used for the TEMPLATE sheet of the openpyxl paths.
+    """
+    template_styles = register_template_styles(layout, sheet.parent)
+    for row_index, cells in layout.rows.items():
+        for column, value, style_key in cells:
+            cell = sheet.cell(row=row_index, column=column, value=value)
+            if style_key is not None:
+                cell._style = copy(template_styles[style_key])
+    copy_template_layout(layout, sheet, 0, template_styles)
+
+def template_row_cells(layout, sheet, row_index, template_styles):
+    """Returns the cells of one template row, ready to append to a write-only sheet."""
+    row = [None] * layout.max_column
+    for column, value, style_key in layout.rows.get(row_index, []):
+        new_cell = WriteOnlyCell(sheet, value=value)
+        if style_key is not None:
+            new_cell._style = copy(template_styles[style_key])
+        row[column - 1] = new_cell
+    return row
+
+def write_spooled_sheet(sheet, column_plan, spool, layout, template_styles, first_row=5):
+    """
+    Writes a whole write-only sheet, from top to bottom: the template rows above
+    first_row, the spooled data rows (newest first), then the rest of the template.
+    The result matches what write_rows_to_sheet gives on a copy of the template.
+    """
+    copy_template_layout(layout, sheet, spool.count, template_styles, first_row)
+    for row_index in range(1, first_row):
+        sheet.append(template_row_cells(layout, sheet, row_index, template_styles))
+
+    border_style = get_cell_style(sheet.parent, True, False)
+    width = max([ROW_BORDER_COLUMNS[-1]] + [col_idx for column, col_idx, style in column_plan])
+    for offset, (record, values) in enumerate(iter_spooled_rows(spool, column_plan)):
+        print(f"Writing data from '{record['Source File']}' to sheet '{sheet.title}', row {first_row + offset}...")
+        row = [None] * width
+        for col_idx in ROW_BORDER_COLUMNS:
+            cell = WriteOnlyCell(sheet)
+            cell._style = copy(border_style)
+            row[col_idx - 1] = cell
+        for (column, col_idx, style), value in zip(column_plan, values):
+            cell = WriteOnlyCell(sheet, value=value)
+            cell._style = copy(style)
+            row[col_idx - 1] = cell
+        sheet.append(row)
+
+    for row_index in range(first_row, layout.max_row + 1):
+        sheet.append(template_row_cells(layout, sheet, row_index, template_styles))
+
+def get_template_layout(template_path):
+    """Returns the TemplateLayout of PLANTILLA.xlsx (see template_cache.py). Raises RunError if it cannot be read."""
+    try:
+        return load_template_layout(template_path)
+    except Exception as e:
+        print(f"Error loading template: {e}")
+        raise RunError("Template Error", f"Error loading 'PLANTILLA.xlsx': {e}")
+
+def create_workbook_write_only(all_data, output_filename, template_path, write_plan):
+    """
+    MODE 1, fast path: builds a new workbook with openpyxl's write_only mode.
+    Each BATEA sheet is streamed to disk as it is written, with the template's
+    rows, styles, widths and merged cells reproduced around the data,
+    so memory stays flat however many rows the run creates.
+    Returns the workbook (to be saved with save_output_workbook) and the records written.
+    """
+    print(f"Creating new file '{output_filename}' from template...")
+
+    layout = get_template_layout(template_path)
+    header_map = layout.header_map()
+
+    workbook = Workbook(write_only=True)
+
+    def create_spooled_sheet(title):
+        print(f"Creating sheet '{title}'...")
+        sheet = workbook.create_sheet(title=title)
+        column_plan = compile_column_plan(sheet.title, header_map, write_plan, workbook_cell_style(workbook))
+        return sheet, column_plan, RecordSpool()
+
+    # BATEA -> (sheet, column plan, spooled records)
+    spools = SheetRegistry({}, create_spooled_sheet)
+    written = []
     try:
-        # --- NEW: Remove the template sheet before saving ---
+        for chunk in iter_chunks(all_data, WRITE_CHUNK_SIZE):
+            # Group data by BATEA
+            data_by_batea = {}
+            for row in chunk:
+                batea = row.get('BATEA', 'UNKNOWN_BATEA').strip()
+                if not batea:
+                    batea = 'UNKNOWN_BATEA'
+                data_by_batea.setdefault(batea, []).append(row)
+
+            for batea_name, batea_data in data_by_batea.items():
+                entry = spools.get_or_create(batea_name)
+                if entry is None:
+                    for row in batea_data:
+                        print(f"Skipping PDF '{row['Source File']}': no sheet can be named after its BATEA.")
+                    continue
+                entry[2].add(batea_data)
+                written.extend(index_entry(row) for row in batea_data)
+
+        # Template styles, registered in the new workbook once for all the sheets
+        template_styles = register_template_styles(layout, workbook)
+
+        for sheet, column_plan, spool in spools.values():
+            write_spooled_sheet(sheet, column_plan, spool, layout, template_styles)
+    finally:
+        for sheet, column_plan, spool in spools.values():
+            spool.close()
+
+    return workbook, written
+
+def save_output_workbook(workbook, output_filename):
+    """
+    Removes the internal TEMPLATE sheet and saves the workbook, through a
+    temporary file, so a crash while saving never leaves a half-written workbook.
+    Raises RunError if it cannot be saved.
+    """
+    temp_path = output_filename + ".tmp"
+    try:
+        # Remove the template sheet before saving
         if "TEMPLATE" in workbook.sheetnames:
             print("Removing internal 'TEMPLATE' sheet...")
             del workbook["TEMPLATE"]
-        # --- END NEW ---
 
-        workbook.save(output_filename)
+        workbook.save(temp_path)
+        os.replace(temp_path, output_filename)
         print(f"\nSuccess! Data saved to '{output_filename}'")
-    except PermissionError:
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise_save_error(output_filename, e)
+    finally:
+        workbook.close()
+
+def raise_save_error(output_filename, error):
+    """Reports an error saving the workbook and raises it as a RunError."""
+    if isinstance(error, PermissionError):
         print(f"\nError: Could not save '{output_filename}'.")
         print("Please make sure the file is not open in Excel.")
-    except Exception as e:
-        print(f"\nError saving Excel file: {e}")
+        raise RunError("Permission Error", f"Could not save '{output_filename}'.\nPlease make sure the file is not open in Excel.")
+    print(f"\nError saving Excel file: {error}")
+    raise RunError("Save Error", f"An error occurred while saving the Excel file: {error}")
+
+def export_to_excel(all_data, output_filename, template_path, write_plan, write_only=True, patch_updates=True,
+                    backup_settings=None):
+    """
+    Writes the records to output_filename, updating it if it exists or creating
+    it from the template otherwise, with the columns of the write plan
+    (see compile_write_plan). all_data can be a list or a stream of records
+    (see stream_records): the workbook is opened as soon as the first record
+    arrives and written while the rest are still being extracted.
+    New files are built with the write-only fast path unless write_only is False,
+    and existing ones are patched in place unless patch_updates is False.
+    An existing workbook is probed first (see probe_workbook): records it already
+    holds are not written again, and if it holds them all it is left untouched.
+    Otherwise it is backed up (see backups.py, with backup_settings) on a
+    background thread while the rest of the records are extracted.
+    Returns the records that are now in the workbook (written or already there),
+    or None if there were no records at all.
+    Raises RunError when the workbook cannot be opened, created or saved.
+    """
+    records = iter(all_data)
+    first_record = next(records, None)
+    if first_record is None:
+        return None
+    records = chain([first_record], records)
+
+    if os.path.exists(output_filename):
+        present = []
+        probe = probe_workbook(output_filename, write_plan) if any(column.key for column in write_plan) else None
+        if probe is not None:
+            records = skip_present_records(records, probe, present)
+            first_record = next(records, None)
+            if first_record is None:
+                print(f"Every record is already in '{output_filename}'. Nothing to write.")
+                return present
+            records = chain([first_record], records)
+
+        print(f"File '{output_filename}' exists. Will update it.")
+        backup = BackupJob(output_filename, backup_settings)
+        try:
+            if patch_updates:
+                written = update_workbook_in_place(records, output_filename, template_path, write_plan, backup)
+            else:
+                written = update_with_openpyxl(records, output_filename, template_path, write_plan, backup)
+        finally:
+            backup.wait()
+        return present + written
+
+    if write_only:
+        workbook, written = create_workbook_write_only(records, output_filename, template_path, write_plan)
+    else:
+        workbook, written = create_workbook(records, output_filename, template_path, write_plan)
+    save_output_workbook(workbook, output_filename)
+    return written
+
+# --- Other Output Formats ---
+
+# Records converted and written at a time by the other sinks: nothing is shifted,
+# so bigger chunks only mean fewer, larger conversions and Parquet row groups
+SINK_CHUNK_SIZE = 10000
+
+def get_output_format(config, output_format=None):
+    """
+    Returns the output format: output_format (from the command line) if given,
+    else the config's "output_format" (default "excel").
+    Raises RunError if it is unknown, or is "parquet" without pyarrow installed.
+    """
+    if output_format is None:
+        output_format = config.get('output_format', "excel")
+    if output_format not in OUTPUT_FORMATS:
+        message = f"Unknown 'output_format' '{output_format}' (expected one of: {', '.join(OUTPUT_FORMATS)})."
+        print(f"Error: {message}")
+        raise RunError("Config Error", message)
+    if output_format == "parquet" and not parquet_available():
+        message = "Parquet output needs the 'pyarrow' package. Install it with 'pip install pyarrow'."
+        print(f"Error: {message}")
+        raise RunError("Config Error", message)
+    return output_format
+
+def export_to_sink(all_data, output_path, output_format, write_plan):
+    """
+    Writes the records to a CSV, Parquet or SQLite output (see sinks.py), a
+    chunk at a time as they arrive, with the columns and types of the write plan.
+    Returns the records written, or None if there were no records at all.
+    Raises RunError when the output cannot be written.
+    """
+    records = iter(all_data)
+    first_record = next(records, None)
+    if first_record is None:
+        return None
+
+    print(f"Writing to '{output_path}' ({output_format})...")
+    written = []
+    try:
+        sink = open_sink(output_format, output_path, write_plan)
+        try:
+            for chunk in iter_chunks(chain([first_record], records), SINK_CHUNK_SIZE):
+                typed_columns = [convert_column([row.get(column.field, "") for row in chunk], column)
+                                 for column in write_plan]
+                sink.write(chunk, list(zip(*typed_columns)) if typed_columns else [()] * len(chunk))
+                written.extend(index_entry(row) for row in chunk)
+        finally:
+            sink.close()
+    except SinkError as e:
+        print(f"\nError: {e}")
+        raise RunError("Output Error", str(e))
+
+    print(f"\nSuccess! {len(written)} record(s) saved to '{output_path}'")
+    return written
+
+# --- Record Store ---
+
+def open_workbook_store(output_filename, output_format, config):
+    """
+    Opens the record store of an Excel output (see record_store.py).
+    Returns None for the other formats, when "record_store" is false in the
+    config, or when the store cannot be opened. Records an earlier run stored
+    but did not get into the workbook (it stopped in the Excel stage) are reported.
+    """
+    if output_format != "excel" or not config.get('record_store', True):
+        return None
+    store = open_record_store(output_filename)
+    if store is not None and os.path.exists(output_filename):
+        pending = sum(store.pending_bateas().values())
+        if pending:
+            print(f"Resuming: {pending} record(s) stored by an earlier run have not reached '{output_filename}' yet.")
+    return store
+
+def materialize_workbook(store, output_filename, template_path, write_plan, config, new_records=(),
+                         written_index=None, progress=None):
+    """
+    Builds the workbook from its record store: the records not built into it
+    yet are written with export_to_excel, so only the sheets of their BATEAs
+    change, and are then marked as built. new_records (e.g. a stream_records
+    stream) are stored as they arrive (see RecordStore.tee, with written_index
+    as the records already built) and written in the same pass, after the
+    pending ones, so the workbook is written while they are still extracted.
+    progress is told when the records run out (the "write" stage).
+    Returns the records that are now in the workbook, or None if there was nothing to build.
+    Raises RunError as export_to_excel does; the records then stay pending for the next build.
+    """
+    last_id = store.last_pending_id()
+    if last_id is not None:
+        pending = store.pending_bateas()
+        print(f"Building {sum(pending.values())} stored record(s) into '{output_filename}' "
+              f"(sheet(s): {', '.join(pending)})...")
+    stored_records = store.tee(new_records, written_index or {})
+    with contextlib.closing(stored_records):
+        records = chain(store.iter_pending(last_id) if last_id is not None else [], stored_records,
+                        report_stage(progress, "write"))
+        written = export_to_excel(records, output_filename, template_path, write_plan,
+                                  config.get('write_only_output', True), config.get('patch_updates', True),
+                                  get_backup_settings(config))
+    if store.added:
+        print(f"Stored {store.added} new record(s) in '{store.path}'.")
+    last_id = store.last_pending_id()
+    if last_id is not None:
+        store.mark_built(last_id)
+    if written is None:
+        print(f"'{output_filename}' is up to date with '{store.path}'.")
+    return written
+
+def report_stage(progress, stage):
+    """Generator that yields nothing: chained after a record stream, it reports the next stage when the stream ends."""
+    if progress is not None:
+        progress(ProgressEvent(stage, 0, 0, None))
+    yield from ()
+
+def export_records(all_data, output_filename, output_format, template_path, write_plan, config, store=None,
+                   written_index=None, progress=None):
+    """
+    Sends the records to the output of the chosen format: the Excel workbook
+    (see export_to_excel, with the config's Excel options) or another sink
+    (see export_to_sink). Returns and raises as those do.
+    With a record store, the records are stored as they arrive (those in
+    written_index as already built) and written to the workbook in the same
+    pass (see materialize_workbook). The end of the records is reported to
+    progress as the "write" stage.
+    """
+    if store is not None:
+        written = materialize_workbook(store, output_filename, template_path, write_plan, config, all_data,
+                                       written_index, progress)
+        # Records that were all in the workbook already still count as data
+        return [] if written is None and store.added else written
+    if output_format == "excel":
+        return export_to_excel(chain(all_data, report_stage(progress, "write")), output_filename, template_path,
+                               write_plan, config.get('write_only_output', True), config.get('patch_updates', True),
+                               get_backup_settings(config))
+    return export_to_sink(all_data, output_filename, output_format, write_plan)
+
+# --- Pipeline ---
+
+# What run_pipeline returns. 'status' is "ok", "cancelled" (the records
+# extracted before the cancel were written), "nothing_to_do" (every PDF is
+# already in the output) or "no_data" (no PDF could be extracted); 'written'
+# the records now in the output (see export_records), or None; 'files' counts
+# the PDFs seen, skipped (already in the output), extracted and failed;
+# 'timings' the seconds spent in each stage (see run_pipeline).
+PipelineResult = namedtuple("PipelineResult", ["status", "written", "files", "timings"])
+
+def stream_folders(batches, fields, jobs, engine, cache, progress=None, cancel=None):
+    """Chains the record streams (see stream_records) of several input folders: [(folder, pdf_files, pdf_hashes)]."""
+    for input_folder, pdf_files, pdf_hashes in batches:
+        if not pdf_files:
+            continue
+        if cancel is not None and cancel.is_set():
+            return
+        records = stream_records(input_folder, pdf_files, fields, jobs, engine, cache, pdf_hashes,
+                                 progress=progress, cancel=cancel)
+        with contextlib.closing(records):
+            yield from records
+
+def meter_records(records, files, timings):
+    """
+    Passes the extracted records on to the writer, counting them in
+    files["extracted"] and adding the time the writer waits for each to timings["extract"].
+    """
+    records = iter(records)
+    while True:
+        start = time.perf_counter()
+        try:
+            record = next(records)
+        except StopIteration:
+            return
+        finally:
+            timings["extract"] += time.perf_counter() - start
+        files["extracted"] += 1
+        yield record
+
+def run_pipeline(inputs, output_filename, output_format, template_path, write_plan, config, jobs=None,
+                 use_cache=True, build_only=False, progress=None, cancel=None):
+    """
+    The run itself, shared by main(), the GUI and batch mode once the output
+    and its format are known: skips the PDFs of inputs, [(input folder, pdf_files)],
+    that are already in the output, extracts the others and writes the output
+    as the records come in (see stream_records and export_records), then
+    updates the written index. progress and cancel go to stream_records.
+    build_only writes the workbook from its record store without extracting.
+    The timings are "scan" (hashing the PDFs), "extract" (the time the writer
+    spent waiting for extracted records), "write" (the rest of the output:
+    the two overlap, so they add up to the time from first PDF to saved output)
+    and "index".
+    Returns a PipelineResult. Raises RunError when the output cannot be written.
+    """
+    files = {"seen": 0, "skipped": 0, "extracted": 0, "failed": 0}
+    timings = {}
+    store = open_workbook_store(output_filename, output_format, config)
+    if build_only and store is None:
+        message = "--build-only needs Excel output with the record store enabled."
+        print(f"Error: {message}")
+        raise RunError("Config Error", message)
+
+    try:
+        # --- Skip the albaranes the output (or its record store) already holds ---
+        start = time.perf_counter()
+        if progress is not None:
+            progress(ProgressEvent("scan", 0, sum(len(pdf_files) for input_folder, pdf_files in inputs), None))
+        written_index = load_written_index(output_filename)
+        known_hashes = set(written_index if store is None else store.known_hashes())
+        batches = []
+        for input_folder, pdf_files in inputs:
+            pdf_hashes = hash_pdf_files(input_folder, pdf_files)
+            new_files, new_hashes = select_new_pdfs(pdf_files, pdf_hashes, known_hashes)
+            known_hashes.update(pdf_hash for pdf_hash in new_hashes if pdf_hash)
+            files["seen"] += len(pdf_files)
+            files["skipped"] += len(pdf_files) - len(new_files)
+            batches.append((input_folder, new_files, new_hashes))
+        timings["scan"] = time.perf_counter() - start
+
+        to_extract = sum(len(pdf_files) for input_folder, pdf_files, pdf_hashes in batches)
+        if not to_extract and (store is None or store.last_pending_id() is None):
+            print(f"Every PDF is already in '{output_filename}'. Nothing to do.")
+            return PipelineResult("nothing_to_do", None, files, timings)
+
+        # --- Extract and write the output, as the records come in ---
+        cache = open_extraction_cache(config) if use_cache and to_extract else None
+        records = stream_folders(batches, config['extraction_fields'], jobs, get_extraction_engine(config), cache,
+                                 progress, cancel)
+        timings["extract"] = 0.0
+        start = time.perf_counter()
+        try:
+            with contextlib.closing(records):
+                written = export_records(meter_records(records, files, timings), output_filename, output_format,
+                                         template_path, write_plan, config, store, written_index, progress)
+        finally:
+            if cache is not None:
+                cache.close()
+        timings["write"] = time.perf_counter() - start - timings["extract"]
+        cancelled = cancel is not None and cancel.is_set()
+        if not cancelled:
+            files["failed"] = to_extract - files["extracted"]
+
+        if written is None:
+            print("No data was successfully extracted from any PDF.")
+            return PipelineResult("no_data", None, files, timings)
+
+        start = time.perf_counter()
+        add_to_written_index(written_index, written)
+        save_written_index(output_filename, written_index)
+        timings["index"] = time.perf_counter() - start
+        return PipelineResult("cancelled" if cancelled else "ok", written, files, timings)
+    finally:
+        if store is not None:
+            store.close()
+
+def parse_jobs(value):
+    """argparse type for --jobs: a positive number of worker processes."""
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a number")
+    if jobs < 1:
+        raise argparse.ArgumentTypeError("the number of jobs must be at least 1")
+    return jobs
+
+def parse_args(argv=None):
+    """Parses the command line options."""
+    parser = argparse.ArgumentParser(description="Extract data from PDF albaranes into an Excel workbook.")
+    parser.add_argument("-j", "--jobs", type=parse_jobs, default=get_default_jobs(),
+                        help="number of worker processes used to extract the PDFs (default: number of CPU cores)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="extract every PDF again instead of using the extraction cache")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="empty the extraction cache and exit")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, dest="output_format",
+                        help="output format (default: 'output_format' in config.json, or excel)")
+    parser.add_argument("--build-only", action="store_true",
+                        help="build the workbook from its record store, without extracting any PDF")
+    parser.add_argument("--startup-time", action="store_true",
+                        help="report the startup time and the import time of each module loaded on demand, and exit")
+    return parser.parse_args(argv)
+
+def main():
+    """Main execution function."""
+    args = parse_args()
+    if args.startup_time:
+        # code_base itself is this script, already loaded
+        print_startup_report(time.perf_counter() - STARTED, module_names=("pymupdf", "pandas"))
+        return
+    print("Starting PDF processing...")
+    
+    # We need to find the config file, whether running as .py or .exe
+    config_path = get_resource_path('config.json')
+    config = load_config(config_path)
+    
+    if config is None:
+        input("Press Enter to exit.")
+        return
+
+    if args.clear_cache:
+        clear_extraction_cache(config)
+        return
+
+    try:
+        write_plan = compile_write_plan(config)
+        output_format = get_output_format(config, args.output_format)
+    except RunError:
+        input("Press Enter to exit.")
+        return
+
+    if args.build_only and (output_format != "excel" or not config.get('record_store', True)):
+        print("Error: --build-only needs Excel output with the record store enabled.")
+        input("Press Enter to exit.")
+        return
+
+    input_folder = "input_pdfs"
+    if args.build_only:
+        pdf_files = []
+    else:
+        if not setup_directories(input_folder):
+            input("Press Enter to exit.")
+            return
+
+        pdf_files = list_pdf_files(input_folder)
+
+        if not pdf_files:
+            print(f"No PDF files found in '{input_folder}'.")
+            input("Press Enter to exit.")
+            return
+
+        print(f"Found {len(pdf_files)} PDF(s) to process...")
+
+    # --- Get Template and Output File Paths ---
+    template_path = get_resource_path('PLANTILLA.xlsx')
+    if output_format == "excel" and not os.path.exists(template_path):
+        print(f"Error: Template file 'PLANTILLA.xlsx' not found.")
+        print("Please make sure it is in the same directory as the .exe")
+        input("Press Enter to exit.")
+        return
+
+    # Asked before extracting, so the PDFs already in the workbook are not even opened
+    if output_format == "excel":
+        output_filename = input("Enter the name for the output Excel file (e.g., 'datos.xlsx'): ")
+    else:
+        output_filename = input(f"Enter the name for the {output_format} output (e.g., 'datos'): ")
+    output_filename = get_output_path(output_filename, output_format)
+
+    try:
+        result = run_pipeline([] if args.build_only else [(input_folder, pdf_files)], output_filename, output_format,
+                              template_path, write_plan, config, args.jobs, use_cache=not args.no_cache,
+                              build_only=args.build_only)
+    except RunError:
+        input("Press Enter to exit.")
+        return
 
-    workbook.close()
-    print("Processing finished.")
+    # Otherwise run_pipeline has said why nothing was written
+    if result.status == "ok":
+        print("Processing finished.")
     input("Press Enter to exit.")
 
 if __name__ == "__main__":
+    # Needed for the worker processes of the frozen (PyInstaller) build
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
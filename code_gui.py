@@ -1,19 +1,23 @@
+import time
+# Taken before the other imports, for the startup time budget
+STARTED = time.perf_counter()
+
 import os
 import json
-import pymupdf
-import fitz  # This is the PyMuPDF library
-import pandas as pd
 import sys
-from openpyxl import load_workbook
-from openpyxl.utils.exceptions import InvalidFileException
-from openpyxl.styles import Font, Border, Fill, Protection, Alignment, Side
-import shutil
-import datetime
 
 # --- GUI Imports ---
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
+import queue
 import threading
+import multiprocessing
+
+# The shared extraction and Excel logic (code_base, with PyMuPDF, pandas and
+# openpyxl behind it) is imported by run_main_logic, so the window shows up
+# without waiting for it (see startup.py).
+from extract_cache import clear_extraction_cache
+from startup import check_startup_budget, print_startup_report
 
 # -------------------------------------------------------------------
 # --- ALL YOUR ORIGINAL HELPER FUNCTIONS (UNCHANGED) ---
@@ -42,177 +46,88 @@ def load_config(config_path):
         return None
     # We remove the setup_directories function as the user will provide the path.
 
-def extract_data_from_pdf(pdf_path, fields):
-    """
-    Extracts data from a single PDF based on the fields defined in the config.
-    """
-    try:
-        doc = fitz.open(pdf_path)
-    except Exception as e:
-        print(f"Error opening {pdf_path}: {e}")
-        return None
-
-    extracted_data = {}
-    for field in fields:
-        try:
-            page_num = field['page']
-            rect_coords = field['rect']
-            
-            if page_num >= doc.page_count:
-                print(f"Warning: Page {page_num} out of range for {pdf_path}. Skipping field '{field['name']}'.")
-                extracted_data[field['name']] = ""
-                continue
-                
-            page = doc.load_page(page_num)
-            rect = fitz.Rect(rect_coords[0], rect_coords[1], rect_coords[2], rect_coords[3])
-            text = page.get_text("text", clip=rect).strip()
-            text = text.replace('\n', ' ').replace('\r', ' ')
-            extracted_data[field['name']] = text
-        except Exception as e:
-            print(f"Error processing field '{field['name']}' in {pdf_path}: {e}")
-            extracted_data[field['name']] = "ERROR"
-
-    doc.close()
-    return extracted_data
-
-# --- Excel Helper Functions (UNCHANGED) ---
-
-def copy_sheet_properties(source_sheet, target_sheet):
-    """
-    Manually copies cell values, styles, dimensions, and merged cells
-    from source_sheet to target_sheet (which must be in different workbooks).
-    """
-    print(f"Copying properties from '{source_sheet.title}' to '{target_sheet.title}'...")
-    
-    # 1. Copy cell values and styles
-    for row in source_sheet.iter_rows():
-        for cell in row:
-            new_cell = target_sheet.cell(row=cell.row, column=cell.column, value=cell.value)
-            if cell.has_style:
-                try:
-                    new_cell.font = Font(name=cell.font.name, size=cell.font.size, bold=cell.font.bold, italic=cell.font.italic, vertAlign=cell.font.vertAlign, underline=cell.font.underline, strike=cell.font.strike, color=cell.font.color)
-                    new_cell.border = Border(left=cell.border.left, right=cell.border.right, top=cell.border.top, bottom=cell.border.bottom, diagonal=cell.border.diagonal, diagonal_direction=cell.border.diagonal_direction, outline=cell.border.outline, start=cell.border.start, end=cell.border.end)
-                    new_cell.number_format = cell.number_format
-                    new_cell.protection = Protection(locked=cell.protection.locked, hidden=cell.protection.hidden)
-                    new_cell.alignment = Alignment(horizontal=cell.alignment.horizontal, vertical=cell.alignment.vertical, text_rotation=cell.alignment.text_rotation, wrap_text=cell.alignment.wrap_text, shrink_to_fit=cell.alignment.shrink_to_fit, indent=cell.alignment.indent)
-                except Exception as e:
-                    print(f"Warning: Could not copy style for cell {cell.coordinate}. Error: {e}")
-
-    # 2. Copy column dimensions
-    for col_letter, dim in source_sheet.column_dimensions.items():
-        if dim.width: target_sheet.column_dimensions[col_letter].width = dim.width
-        target_sheet.column_dimensions[col_letter].hidden = dim.hidden
-
-    # 3. Copy row dimensions
-    for row_index, dim in source_sheet.row_dimensions.items():
-        if dim.height: target_sheet.row_dimensions[row_index].height = dim.height
-        target_sheet.row_dimensions[row_index].hidden = dim.hidden
-
-    # 4. Copy merged cells
-    for merge_range in source_sheet.merged_cells.ranges:
-        target_sheet.merge_cells(str(merge_range))
-    
-    print(f"Finished copying properties to '{target_sheet.title}'.")
-
-def get_header_map(sheet, header_row=4):
-    """
-    Reads the header row and returns a dictionary mapping
-    header names to column indices. e.g. {'FECHA': 1, 'BATEA': 3}
-    """
-    header_map = {}
-    for cell in sheet[header_row]:
-        if cell.value:
-            header_name = str(cell.value).strip()
-            header_map[header_name] = cell.column
-    return header_map
-
-def write_data_to_sheet(sheet, header_map, data_row, target_row):
-    """
-    Writes a single PDF's data (data_row) to the specified sheet
-    at the target_row, using the header_map to find correct columns.
-    """
-    sheet.insert_rows(target_row)
-    black_font = Font(color="000000")
-    thin_border_side = Side(border_style="thin", color="000000")
-    thin_border = Border(left=thin_border_side, right=thin_border_side, top=thin_border_side, bottom=thin_border_side)
-
-    for col_idx in range(1, 15): 
-        cell = sheet.cell(row=target_row, column=col_idx)
-        cell.border = thin_border
-    
-    field_to_header_map = {
-        "FECHA": "FECHA", "BATEA": "BATEA", "EMPRESA": "EMPRESA",
-        "NIF EMPRESA": "NIF EMPRESA", "KG BRUTOS": "KG BRUTOS",
-        "DESCUENTO": "DESCUENTO", "KG NETOS": "KG NETOS"
-    }
-
-    for field_name, header_name in field_to_header_map.items():
-        if header_name in header_map:
-            col_idx = header_map[header_name]
-            value_to_write = data_row.get(field_name, "")
-            
-            try:
-                numeric_value = float(value_to_write)
-                cell = sheet.cell(row=target_row, column=col_idx, value=numeric_value)
-                cell.font = black_font
-            except (ValueError, TypeError):
-                cell = sheet.cell(row=target_row, column=col_idx, value=data_row.get(field_name, ""))
-                cell.font = black_font
-        else:
-            print(f"Warning: Header '{header_name}' not found in sheet '{sheet.title}'. Skipping data.")
-
-def get_or_create_sheet(workbook, batea_name, template_sheet_name="TEMPLATE"):
-    """
-    Tries to find a sheet with batea_name. If not found,
-    copies the internal 'TEMPLATE' sheet and renames it.
-    """
-    if batea_name in workbook.sheetnames:
-        return workbook[batea_name]
-    else:
-        print(f"Sheet '{batea_name}' not found. Creating it from '{template_sheet_name}'...")
-        
-        if template_sheet_name not in workbook.sheetnames:
-            print(f"CRITICAL ERROR: Template sheet '{template_sheet_name}' not found in the workbook.")
-            return None 
-            
-        template_sheet = workbook[template_sheet_name]
-        
-        if not hasattr(template_sheet, 'parent') or template_sheet.parent != workbook:
-            print(f"CRITICAL ERROR: The template sheet '{template_sheet_name}' is not a valid worksheet.")
-            return None
-            
-        new_sheet = workbook.copy_worksheet(template_sheet)
-        new_sheet.title = batea_name
-        return new_sheet
-
 # -------------------------------------------------------------------
 # --- NEW GUI APPLICATION CLASS ---
 # -------------------------------------------------------------------
 
-class TextRedirector:
-    """A helper class to redirect stdout/stderr to a Tkinter Text widget."""
-    def __init__(self, widget):
+# How often the log widget catches up with what was printed, in milliseconds
+LOG_FLUSH_INTERVAL_MS = 100
+# Lines kept in the log widget: older ones are dropped, so a long run does not
+# make it grow without end
+LOG_MAX_LINES = 5000
+# How often the progress panel is refreshed during a run, in milliseconds
+PROGRESS_INTERVAL_MS = 250
+
+# What the progress panel shows for each stage of the pipeline (see code_base.ProgressEvent)
+STAGE_NAMES = {
+    "scan": "Checking which PDFs are new...",
+    "extract": "Extracting PDFs",
+    "write": "Writing the output...",
+}
+
+def format_duration(seconds):
+    """Formats a number of seconds as H:MM:SS, or M:SS under an hour."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class QueuedTextRedirector:
+    """
+    Redirects stdout/stderr to a Tkinter Text widget. write() only queues the
+    text, from any thread; the Tk loop drains the queue every interval_ms and
+    inserts everything that arrived since in one go, so a flood of prints
+    costs one widget update per interval instead of one event each.
+    The widget keeps the last max_lines lines.
+    """
+    def __init__(self, widget, interval_ms=LOG_FLUSH_INTERVAL_MS, max_lines=LOG_MAX_LINES):
         self.widget = widget
+        self.interval_ms = interval_ms
+        self.max_lines = max_lines
+        self._pending = queue.SimpleQueue()
+        self.widget.after(self.interval_ms, self.drain)
 
     def write(self, s):
-        # Ensure GUI updates happen on the main thread
-        self.widget.after(0, self.append_text, s)
+        if s:
+            self._pending.put(s)
+
+    def flush(self):
+        pass  # Required for file-like object
+
+    def drain(self):
+        """Runs on the Tk loop: inserts the queued text, then schedules the next drain."""
+        chunks = []
+        while True:
+            try:
+                chunks.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if chunks:
+                self.append_text("".join(chunks))
+            self.widget.after(self.interval_ms, self.drain)
+        except tk.TclError:
+            pass  # The window has been closed
+
+    def append_text(self, text):
+        # Lines that would be dropped right away are never inserted
+        if text.count("\n") > self.max_lines:
+            text = "\n".join(text.split("\n")[-self.max_lines - 1:])
 
-    def append_text(self, s):
         self.widget.config(state="normal")
-        self.widget.insert(tk.END, s)
+        self.widget.insert(tk.END, text)
+        # 'end-1c' is on the last line, which is empty once the text ends with a newline
+        excess = int(self.widget.index("end-1c").split(".")[0]) - 1 - self.max_lines
+        if excess > 0:
+            self.widget.delete("1.0", f"{excess + 1}.0")
         self.widget.see(tk.END)
         self.widget.config(state="disabled")
 
-    def flush(self):
-        pass  # Required for file-like object
-
 
 class App:
     def __init__(self, root):
         self.root = root
         self.root.title("PDF to Excel Extractor")
-        self.root.geometry("700x500") # Width x Height
+        self.root.geometry("700x620") # Width x Height
 
         self.root.resizable(False, False)
 
@@ -246,9 +161,47 @@ class App:
         self.excel_button = ttk.Button(self.excel_frame, text="Browse", width=10, command=self.browse_excel_file)
         self.excel_button.pack(side=tk.LEFT)
 
-        # --- 3. Start Button ---
-        self.start_button = ttk.Button(self.main_frame, text="Start Processing", command=self.start_processing_thread)
-        self.start_button.pack(pady=10, fill="x")
+        # --- Options: number of extraction workers ---
+        self.options_frame = ttk.Frame(self.main_frame)
+        self.options_frame.pack(fill="x", expand=False, pady=(5, 0))
+
+        ttk.Label(self.options_frame, text="Worker processes:").pack(side=tk.LEFT)
+        # One per CPU core, as code_base.get_default_jobs (not imported yet)
+        default_jobs = os.cpu_count() or 1
+        self.jobs_var = tk.IntVar(value=default_jobs)
+        self.jobs_spinbox = ttk.Spinbox(self.options_frame, from_=1, to=max(64, default_jobs),
+                                        textvariable=self.jobs_var, width=5)
+        self.jobs_spinbox.pack(side=tk.LEFT, padx=(5, 0))
+
+        self.clear_cache_button = ttk.Button(self.options_frame, text="Clear Cache", command=self.clear_cache)
+        self.clear_cache_button.pack(side=tk.RIGHT)
+
+        # --- 3. Start / Cancel Buttons ---
+        self.buttons_frame = ttk.Frame(self.main_frame)
+        self.buttons_frame.pack(pady=10, fill="x")
+
+        self.start_button = ttk.Button(self.buttons_frame, text="Start Processing", command=self.start_processing_thread)
+        self.start_button.pack(side=tk.LEFT, fill="x", expand=True)
+
+        self.cancel_button = ttk.Button(self.buttons_frame, text="Cancel", width=12, state="disabled",
+                                        command=self.cancel_processing)
+        self.cancel_button.pack(side=tk.LEFT, padx=(5, 0))
+
+        # --- Progress Panel ---
+        self.progress_frame = ttk.LabelFrame(self.main_frame, text="Progress", padding="10")
+        self.progress_frame.pack(fill="x", expand=False, pady=5)
+
+        self.stage_var = tk.StringVar(value="Idle")
+        ttk.Label(self.progress_frame, textvariable=self.stage_var).pack(anchor="w")
+        self.progress_bar = ttk.Progressbar(self.progress_frame, mode="determinate")
+        self.progress_bar.pack(fill="x", pady=(5, 5))
+        self.stats_var = tk.StringVar(value="")
+        ttk.Label(self.progress_frame, textvariable=self.stats_var).pack(anchor="w")
+
+        # Latest ProgressEvent from the pipeline (set from the worker threads, shown by update_progress)
+        self.progress_event = None
+        self.extract_started = None
+        self.cancel_event = threading.Event()
 
         # --- 4. Log/Status Output ---
         self.log_frame = ttk.LabelFrame(self.main_frame, text="Log", padding="10")
@@ -258,12 +211,28 @@ class App:
         self.status_text.pack(fill="both", expand=True)
         
         # --- Redirect stdout/stderr to the text widget ---
-        self.redirector = TextRedirector(self.status_text)
+        self.redirector = QueuedTextRedirector(self.status_text)
         sys.stdout = self.redirector
         sys.stderr = self.redirector
         
         print("Ready. Please select your folders and files.")
 
+        # Runs once the window is on screen
+        self.root.after_idle(self.report_startup_time)
+
+    def report_startup_time(self):
+        """
+        Checks the time the window took to appear against the budget. With
+        --startup-time, also measures the deferred imports (in the background,
+        so the window stays responsive) and reports them in the log.
+        """
+        startup_seconds = time.perf_counter() - STARTED
+        if "--startup-time" in sys.argv:
+            threading.Thread(target=print_startup_report, args=(startup_seconds, "Opening the window"),
+                             daemon=True).start()
+        else:
+            check_startup_budget(startup_seconds, "Opening the window")
+
     def browse_pdf_folder(self):
         """Opens a dialog to select the PDF input folder."""
         folder_selected = filedialog.askdirectory()
@@ -285,6 +254,19 @@ class App:
             self.excel_file_path.set(file_selected)
             print(f"Excel file set to: {file_selected}")
 
+    def clear_cache(self):
+        """Empties the extraction cache, so every PDF is read again on the next run."""
+        config = load_config(get_resource_path('config.json'))
+        if config is None:
+            messagebox.showerror("Config Error", "Failed to load 'config.json'. Check the log for details.")
+            return
+        if not messagebox.askyesno("Clear Cache", "Remove all cached extraction results?"):
+            return
+        if clear_extraction_cache(config):
+            messagebox.showinfo("Clear Cache", "The extraction cache has been cleared.")
+        else:
+            messagebox.showerror("Clear Cache", "Could not clear the extraction cache. Check the log for details.")
+
     def start_processing_thread(self):
         """Validates input and starts the main logic in a new thread."""
         pdf_path = self.pdf_folder_path.get()
@@ -299,8 +281,26 @@ class App:
             messagebox.showerror("Error", f"The selected PDF folder does not exist:\n{pdf_path}")
             return
 
+        try:
+            jobs = int(self.jobs_var.get())
+            if jobs < 1:
+                raise ValueError
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Error", "The number of worker processes must be a whole number of at least 1.")
+            return
+
         # Disable button to prevent double-clicks
         self.start_button.config(state="disabled", text="Processing...")
+        self.cancel_button.config(state="normal", text="Cancel")
+
+        # Reset the progress panel, then refresh it until the run is over
+        self.cancel_event = threading.Event()
+        self.progress_event = None
+        self.extract_started = None
+        self.stage_var.set("Starting...")
+        self.stats_var.set("")
+        self.progress_bar.config(value=0, maximum=1)
+        self.root.after(PROGRESS_INTERVAL_MS, self.update_progress)
         
         # Clear the log
         self.status_text.config(state="normal")
@@ -310,19 +310,57 @@ class App:
         # Run the main logic in a separate thread
         self.processing_thread = threading.Thread(
             target=self.run_main_logic,
-            args=(pdf_path, excel_path),
+            args=(pdf_path, excel_path, jobs),
             daemon=True
         )
         self.processing_thread.start()
 
-    def run_main_logic(self, input_folder, output_filename):
+    def report_progress(self, event):
+        """Progress callback of the pipeline: only keeps the event (called from the worker threads)."""
+        if event.stage == "extract" and event.done == 0:
+            self.extract_started = time.perf_counter()
+        self.progress_event = event
+
+    def update_progress(self):
+        """Shows the latest progress event: stage, PDFs done, throughput and time left. Runs on the Tk loop."""
+        event = self.progress_event
+        if event is not None:
+            stage = STAGE_NAMES.get(event.stage, event.stage)
+            if self.cancel_event.is_set():
+                stage = "Cancelling: finishing the PDFs in progress and saving what is done..."
+            self.stage_var.set(stage)
+            if event.stage == "extract":
+                self.progress_bar.config(maximum=max(event.total, 1), value=event.done)
+                elapsed = time.perf_counter() - self.extract_started
+                stats = f"{event.done} of {event.total} PDF(s)"
+                if event.done and elapsed > 0:
+                    rate = event.done / elapsed
+                    stats += f"  |  {rate:.1f} PDF/s  |  about {format_duration((event.total - event.done) / rate)} left"
+                self.stats_var.set(stats)
+            elif event.stage == "write":
+                self.progress_bar.config(maximum=1, value=1)
+        if self.processing_thread.is_alive():
+            self.root.after(PROGRESS_INTERVAL_MS, self.update_progress)
+
+    def cancel_processing(self):
+        """
+        Asks the run to stop: the PDFs being extracted are finished, the worker
+        pool is shut down, and everything extracted so far is still saved.
+        """
+        self.cancel_event.set()
+        self.cancel_button.config(state="disabled", text="Cancelling...")
+        print("Cancelling... The PDFs in progress are finished and everything extracted so far is saved.")
+
+    def run_main_logic(self, input_folder, output_filename, jobs=None):
         """
         This is your original 'main()' function, refactored to run as a
         method and provide feedback to the GUI.
         """
         try:
             print("Starting PDF processing...")
-            
+            from code_base import (list_pdf_files, compile_write_plan, get_output_format, run_pipeline, RunError)
+            from sinks import get_output_path
+
             config_path = get_resource_path('config.json')
             config = load_config(config_path)
             
@@ -330,9 +368,14 @@ class App:
                 messagebox.showerror("Config Error", "Failed to load 'config.json'. Check the log for details.")
                 return # Exit thread
 
-            all_data = []
-            
-            pdf_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.pdf')]
+            try:
+                write_plan = compile_write_plan(config)
+                output_format = get_output_format(config)
+            except RunError as e:
+                messagebox.showerror(e.title, str(e))
+                return
+
+            pdf_files = list_pdf_files(input_folder)
             
             if not pdf_files:
                 print(f"No PDF files found in '{input_folder}'.")
@@ -341,161 +384,35 @@ class App:
 
             print(f"Found {len(pdf_files)} PDF(s) to process...")
 
-            for filename in pdf_files:
-                pdf_path = os.path.join(input_folder, filename)
-                print(f"Processing '{filename}'...")
-                data = extract_data_from_pdf(pdf_path, config['extraction_fields'])
-                
-                if data:
-                    data["FECHA"] = data["FECHA"].split(" ")[0]
-                    data['Source File'] = filename
-                    all_data.append(data)
-
-            if not all_data:
-                print("No data was successfully extracted from any PDF.")
-                messagebox.showinfo("Finished", "Processing complete, but no data was extracted.")
-                return # Exit thread
-
-            print("Data extraction complete. Generating Excel file...")
-            
             template_path = get_resource_path('PLANTILLA.xlsx')
-            if not os.path.exists(template_path):
+            if output_format == "excel" and not os.path.exists(template_path):
                 print(f"Error: Template file 'PLANTILLA.xlsx' not found.")
                 messagebox.showerror("Template Error", "Template file 'PLANTILLA.xlsx' not found. Please make sure it is in the same directory as the application.")
                 return
-            
-            # --- Logic for creating or updating file ---
-            
-            if os.path.exists(output_filename):
-                # --- MODE 2: UPDATE EXISTING FILE ---
-                print(f"File '{output_filename}' exists. Will update it.")
-                
-                try:
-                    backup_dir = ".old"
-                    os.makedirs(backup_dir, exist_ok=True)
-                    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
-                    base_name, extension = os.path.splitext(output_filename)
-                    backup_filename = f"{base_name}_{timestamp}{extension}"
-                    backup_path = os.path.join(backup_dir, backup_filename)
-                    shutil.copy(output_filename, backup_path)
-                    print(f"Created backup of '{output_filename}' at '{backup_path}'")
-                except Exception as e:
-                    print(f"Warning: Could not create backup for '{output_filename}'. Error: {e}")
-                
-                try:
-                    workbook = load_workbook(output_filename)
-                except (InvalidFileException, FileNotFoundError):
-                    print(f"Error: Could not open '{output_filename}'. It might be corrupt or not a valid .xlsx file.")
-                    messagebox.showerror("File Error", f"Could not open '{output_filename}'. It might be corrupt or not a valid .xlsx file.")
-                    return
-                except Exception as e:
-                    print(f"Error loading workbook: {e}")
-                    messagebox.showerror("File Error", f"Error loading workbook: {e}")
-                    return
-                
-                template_sheet_name = "TEMPLATE"
-                if template_sheet_name not in workbook.sheetnames:
-                    print(f"Warning: '{template_sheet_name}' sheet not found in '{output_filename}'.")
-                    print("Attempting to create it from 'PLANTILLA.xlsx'...")
-                    
-                    try:
-                        if not os.path.exists(template_path):
-                             print(f"CRITICAL ERROR: 'PLANTILLA.xlsx' not found at {template_path}. Cannot create 'TEMPLATE' sheet.")
-                             messagebox.showerror("Template Error", f"CRITICAL ERROR: 'PLANTILLA.xlsx' not found at {template_path}. Cannot create 'TEMPLATE' sheet.")
-                             return
-
-                        template_wb = load_workbook(template_path)
-                        source_sheet = template_wb.active
-                        target_sheet = workbook.create_sheet(title=template_sheet_name)
-                        copy_sheet_properties(source_sheet, target_sheet)
-                        template_wb.close()
-                        print(f"Successfully created 'TEMPLATE' sheet in '{output_filename}'.")
-                    
-                    except Exception as e:
-                        print(f"CRITICAL ERROR: Failed to create 'TEMPLATE' sheet from 'PLANTILLA.xlsx'.")
-                        print(f"Error details: {e}")
-                        messagebox.showerror("Template Error", f"CRITICAL ERROR: Failed to create 'TEMPLATE' sheet from 'PLANTILLA.xlsx'.\n{e}")
-                        return
-                
-                for data_row in all_data:
-                    batea = data_row.get("BATEA", "").strip()
-                    if not batea:
-                        print(f"Warning: PDF '{data_row['Source File']}' has no BATEA. Skipping.")
-                        continue
-                    
-                    sheet = get_or_create_sheet(workbook, batea, template_sheet_name)
-                    
-                    if sheet is None:
-                        print(f"Skipping PDF '{data_row['Source File']}' due to missing template sheet.")
-                        continue
-                        
-                    header_map = get_header_map(sheet, header_row=4)
-                    target_row = 5            
-                    print(f"Writing data from '{data_row['Source File']}' to sheet '{batea}', row {target_row}...")
-                    write_data_to_sheet(sheet, header_map, data_row, target_row)
-
-            else:
-                # --- MODE 1: CREATE NEW FILE ---
-                print(f"Creating new file '{output_filename}' from template...")
-                
-                data_by_batea = {}
-                for row in all_data:
-                    batea = row.get('BATEA', 'UNKNOWN_BATEA').strip()
-                    if not batea:
-                        batea = 'UNKNOWN_BATEA'
-                    if batea not in data_by_batea:
-                        data_by_batea[batea] = []
-                    data_by_batea[batea].append(row)
-                
-                shutil.copy(template_path, output_filename)
-                
-                try:
-                    workbook = load_workbook(output_filename)
-                    template_sheet = workbook.active
-                    template_sheet_name = "TEMPLATE"
-                    template_sheet.title = template_sheet_name
-                except (InvalidFileException, FileNotFoundError):
-                    print(f"Error: Could not open the new file '{output_filename}'.")
-                    messagebox.showerror("File Error", f"Error: Could not open the new file '{output_filename}'.")
-                    return
-                except Exception as e:
-                    print(f"Error loading new workbook: {e}")
-                    messagebox.showerror("File Error", f"Error loading new workbook: {e}")
-                    return
-                
-                for batea_name, batea_data in data_by_batea.items():
-                    print(f"Creating sheet '{batea_name}'...")
-                    sheet = get_or_create_sheet(workbook, batea_name, template_sheet_name)
-                    
-                    if sheet is None:
-                        print(f"Skipping Batea '{batea_name}' due to missing template sheet.")
-                        continue
-                    
-                    header_map = get_header_map(sheet, header_row=4)
-                    
-                    target_row = 5
-                    for data_row in batea_data:
-                        print(f"Writing data from '{data_row['Source File']}' to sheet '{batea_name}', row {target_row}...")
-                        write_data_to_sheet(sheet, header_map, data_row, target_row)
-
-            # --- 4. Save and Exit ---
+
+            # The chosen file name, turned into a database or folder for the other formats
+            output_filename = get_output_path(output_filename, output_format)
+
+            # --- Skip what the output already holds, then extract and write it as the records come in ---
             try:
-                if "TEMPLATE" in workbook.sheetnames:
-                    print("Removing internal 'TEMPLATE' sheet...")
-                    del workbook["TEMPLATE"]
-
-                workbook.save(output_filename)
-                print(f"\nSuccess! Data saved to '{output_filename}'")
-                messagebox.showinfo("Success", f"Processing complete!\nData saved to '{output_filename}'")
-            except PermissionError:
-                print(f"\nError: Could not save '{output_filename}'.")
-                print("Please make sure the file is not open in Excel.")
-                messagebox.showerror("Permission Error", f"Could not save '{output_filename}'.\nPlease make sure the file is not open in Excel.")
-            except Exception as e:
-                print(f"\nError saving Excel file: {e}")
-                messagebox.showerror("Save Error", f"An error occurred while saving the Excel file: {e}")
-
-            workbook.close()
+                result = run_pipeline([(input_folder, pdf_files)], output_filename, output_format, template_path,
+                                      write_plan, config, jobs, progress=self.report_progress,
+                                      cancel=self.cancel_event)
+            except RunError as e:
+                messagebox.showerror(e.title, str(e))
+                return
+
+            if result.status == "nothing_to_do":
+                messagebox.showinfo("Finished", f"Every PDF is already in '{output_filename}'. Nothing to do.")
+                return
+            if result.status == "no_data":
+                messagebox.showinfo("Finished", "Processing complete, but no data was extracted.")
+                return # Exit thread
+            if result.status == "cancelled":
+                print("Processing cancelled.")
+                messagebox.showinfo("Cancelled", f"Processing was cancelled.\nThe PDFs extracted before it were saved to '{output_filename}'.")
+                return
+            messagebox.showinfo("Success", f"Processing complete!\nData saved to '{output_filename}'")
             print("Processing finished.")
 
         except Exception as e:
@@ -511,8 +428,10 @@ class App:
             self.root.after(0, self.enable_button)
 
     def enable_button(self):
-        """Helper to safely re-enable the start button from the main thread."""
+        """Helper to safely re-enable the start button (and disable Cancel) from the main thread."""
         self.start_button.config(state="normal", text="Start Processing")
+        self.cancel_button.config(state="disabled", text="Cancel")
+        self.stage_var.set("Cancelled" if self.cancel_event.is_set() else "Idle")
 
 
 # -------------------------------------------------------------------
@@ -520,6 +439,9 @@ class App:
 # -------------------------------------------------------------------
 
 if __name__ == "__main__":
+    # Needed for the worker processes of the frozen (PyInstaller) build
+    multiprocessing.freeze_support()
+
     # Restore original stdout/stderr on exit
     original_stdout = sys.stdout
     original_stderr = sys.stderr
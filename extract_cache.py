@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+
+# Folder of the program's caches inside the user's cache folder
+CACHE_FOLDER_NAME = "pdf_to_excel"
+
+def get_cache_folder():
+    """
+    Returns the per-user folder where the caches are kept: %LOCALAPPDATA% on
+    Windows, ~/Library/Caches on macOS, $XDG_CACHE_HOME or ~/.cache elsewhere.
+    It does not depend on the working directory, which is '/' or System32
+    when the GUI is started from Finder or Explorer.
+    """
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    elif sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, CACHE_FOLDER_NAME)
+
+# Default settings, overridden by the "extraction_cache" section of config.json.
+# A relative "path" is taken from the cache folder (see get_cache_folder)
+DEFAULT_CACHE_SETTINGS = {
+    "enabled": True,
+    "path": "extraction_cache.sqlite",
+    "max_entries": 100000,
+}
+
+def get_cache_settings(config):
+    """Returns the cache settings from the config, filled in with the defaults and the path made absolute."""
+    settings = dict(DEFAULT_CACHE_SETTINGS)
+    settings.update(config.get("extraction_cache", {}))
+    settings["path"] = os.path.join(get_cache_folder(), os.path.expanduser(settings["path"]))
+    return settings
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Returns the SHA-256 hex digest of a file's contents, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Bump when a change to the extraction code (code_base.extract_data_from_pdf and
+# what it calls) changes what is extracted from a PDF: the records cached by
+# the older code are then extracted again
+EXTRACTOR_VERSION = 2
+
+def hash_extraction_config(fields, engine):
+    """
+    Returns a hash of everything that changes what gets extracted from a PDF:
+    the extraction fields, the extraction engine and EXTRACTOR_VERSION.
+    """
+    key = json.dumps({"fields": fields, "engine": engine, "extractor": EXTRACTOR_VERSION}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class ExtractionCache:
+    """
+    On-disk cache of extracted records, stored in SQLite.
+    Each record is keyed by (SHA-256 of the PDF bytes, hash of the extraction config),
+    so a renamed PDF is still a hit and a config change invalidates everything.
+    Once more than max_entries records are stored, the least recently used ones are dropped.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_CACHE_SETTINGS["max_entries"]):
+        self.path = path
+        self.max_entries = max_entries
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # The extraction pipeline uses the cache from its producer thread (one thread at a time)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " pdf_hash TEXT NOT NULL,"
+            " config_hash TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (pdf_hash, config_hash))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_last_used ON records (last_used)")
+        self.connection.commit()
+
+    def get_many(self, pdf_hashes, config_hash):
+        """
+        Looks up several PDFs at once.
+        Returns a dict {pdf_hash: record} with the ones found in the cache,
+        and marks them as recently used.
+        """
+        found = {}
+        unique_hashes = list(dict.fromkeys(pdf_hashes))
+        # Stay well below SQLite's limit on query parameters
+        for start in range(0, len(unique_hashes), 500):
+            batch = unique_hashes[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"SELECT pdf_hash, data FROM records WHERE config_hash = ? AND pdf_hash IN ({placeholders})",
+                [config_hash] + batch,
+            )
+            for pdf_hash, data in rows:
+                found[pdf_hash] = json.loads(data)
+
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE records SET last_used = ? WHERE pdf_hash = ? AND config_hash = ?",
+                [(now, pdf_hash, config_hash) for pdf_hash in found],
+            )
+            self.connection.commit()
+        return found
+
+    def put_many(self, records, config_hash):
+        """Stores {pdf_hash: record} in the cache, then evicts the least recently used records over the limit."""
+        if not records:
+            return
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO records (pdf_hash, config_hash, data, last_used) VALUES (?, ?, ?, ?)",
+            [(pdf_hash, config_hash, json.dumps(record), now) for pdf_hash, record in records.items()],
+        )
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        """Deletes the least recently used records until at most max_entries are left."""
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM records").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM records WHERE rowid IN (SELECT rowid FROM records ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+
+    def count(self):
+        """Returns the number of records in the cache."""
+        return self.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def clear(self):
+        """Removes every record and gives the disk space back."""
+        self.connection.execute("DELETE FROM records")
+        self.connection.commit()
+        self.connection.execute("VACUUM")
+
+    def close(self):
+        self.connection.close()
+
+def open_extraction_cache(config):
+    """
+    Opens the extraction cache described in the config.
+    Returns None when the cache is disabled or cannot be opened,
+    so the run simply goes on without it.
+    """
+    settings = get_cache_settings(config)
+    if not settings["enabled"]:
+        return None
+    try:
+        return ExtractionCache(settings["path"], int(settings["max_entries"]))
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Warning: Could not open the extraction cache '{settings['path']}'. Error: {e}")
+        print("Continuing without the cache.")
+        return None
+
+def clear_extraction_cache(config):
+    """Empties the extraction cache described in the config. Returns True on success."""
+    settings = get_cache_settings(config)
+    if not os.path.exists(settings["path"]):
+        print(f"The extraction cache '{settings['path']}' is already empty.")
+        return True
+    try:
+        cache = ExtractionCache(settings["path"], int(settings["max_entries"]))
+        removed = cache.count()
+        cache.clear()
+        cache.close()
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Error: Could not clear the extraction cache '{settings['path']}'. Error: {e}")
+        return False
+    print(f"Cleared {removed} record(s) from the extraction cache '{settings['path']}'.")
+    return True
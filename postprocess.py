@@ -0,0 +1,114 @@
+import re
+import datetime
+
+# --- Typed Post-Processing ---
+# Turns the raw text extracted from the PDFs into typed Excel values,
+# one whole column at a time instead of one try/except per cell.
+# pandas, the slowest import of the program, is only loaded by the functions
+# that need it, when the first column is converted.
+
+COLUMN_TYPES = ("auto", "text", "number", "date", "nif")
+
+# Separators used by the albaranes: 1.234,56
+DEFAULT_DECIMAL_SEPARATOR = ","
+DEFAULT_THOUSANDS_SEPARATOR = "."
+# FECHA looks like '02/10/25 11:25:00'; only the date part is kept
+DEFAULT_DATE_FORMAT = "%d/%m/%y"
+# Shown in Excel when a date column has no number_format of its own
+DEFAULT_DATE_NUMBER_FORMAT = "dd/mm/yy"
+
+def _as_text_series(values):
+    """Puts the raw values in a Series of strings (None becomes "")."""
+    import pandas as pd
+    return pd.Series(["" if value is None else str(value) for value in values], dtype=object)
+
+def _keep_failures(parsed, raw, header, warn=True):
+    """
+    Returns the parsed values as a list, falling back to the original text
+    wherever a non-empty value could not be parsed (and reporting how many,
+    unless warn is False). Empty values stay empty.
+    """
+    is_empty = raw.str.strip() == ""
+    failed = parsed.isna() & ~is_empty
+    if warn and failed.any():
+        print(f"Warning: {int(failed.sum())} value(s) in column '{header}' could not be converted. Writing them as text.")
+    result = parsed.astype(object)
+    result[failed] = raw[failed]
+    result[is_empty] = None
+    return result.tolist()
+
+def parse_numbers(raw, decimal_separator=DEFAULT_DECIMAL_SEPARATOR, thousands_separator=DEFAULT_THOUSANDS_SEPARATOR):
+    """Parses a Series of locale-formatted numbers ('1.234,56') into floats, NaN where it fails."""
+    import pandas as pd
+    cleaned = raw.str.strip()
+    if thousands_separator:
+        cleaned = cleaned.str.replace(thousands_separator, "", regex=False)
+    if decimal_separator and decimal_separator != ".":
+        cleaned = cleaned.str.replace(decimal_separator, ".", regex=False)
+    return pd.to_numeric(cleaned, errors="coerce").astype(float)
+
+def parse_dates(raw, date_format=DEFAULT_DATE_FORMAT):
+    """Parses a Series of dates (ignoring anything after the first space) into datetime.date objects, NaN where it fails."""
+    import pandas as pd
+    first_token = raw.str.strip().str.split(" ").str[0]
+    parsed = pd.to_datetime(first_token, format=date_format, errors="coerce")
+    return parsed.dt.date.where(parsed.notna())
+
+def normalize_nifs(raw):
+    """Normalizes NIF/CIF numbers: upper case, without spaces, dots or dashes ('b-15584642' -> 'B15584642')."""
+    return raw.str.upper().str.replace(r"[\s.\-]", "", regex=True).tolist()
+
+def convert_column(values, column, warn=True):
+    """
+    Converts one column of raw extracted values into typed values, in one pass.
+    'column' is an OutputColumn of the write plan (see code_base.compile_write_plan).
+    Returns a list with one value per input value, ready to be written to Excel.
+    """
+    raw = _as_text_series(values)
+    if column.type == "text":
+        return raw.tolist()
+    if column.type == "nif":
+        return normalize_nifs(raw)
+    if column.type == "number":
+        parsed = parse_numbers(raw, column.decimal_separator, column.thousands_separator)
+        return _keep_failures(parsed, raw, column.header, warn)
+    if column.type == "date":
+        return _keep_failures(parse_dates(raw, column.date_format), raw, column.header, warn)
+
+    # "auto": numbers as numbers, anything else as it is (no warnings)
+    import pandas as pd
+    parsed = pd.to_numeric(raw.str.strip(), errors="coerce").astype(float)
+    result = parsed.astype(object)
+    not_numbers = parsed.isna()
+    result[not_numbers] = raw[not_numbers]
+    return result.tolist()
+
+def convert_sheet_column(values, column):
+    """
+    Brings one column of values read back from a sheet to what convert_column
+    gives for the same data, so rows written by any version of the tool (as
+    text or typed) compare equal to new records. Nothing is reported.
+    """
+    # A column repeats the same few values: each one is converted once
+    distinct = list(dict.fromkeys(values))
+    if column.type in ("text", "nif"):
+        converted = dict(zip(distinct, convert_column(distinct, column, warn=False)))
+        return [converted[value] for value in values]
+
+    # Numbers and dates are already typed: only the text cells are converted
+    texts = [value for value in distinct if value is None or isinstance(value, str)]
+    converted = dict(zip(texts, convert_column(texts, column, warn=False)))
+    for value in distinct:
+        if value in converted:
+            continue
+        if isinstance(value, datetime.datetime):
+            converted[value] = value.date() if column.type == "date" else value
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            converted[value] = float(value)
+        else:
+            converted[value] = value
+    return [converted[value] for value in values]
+
+def is_valid_date_format(date_format):
+    """Checks that a strftime-style date format contains at least one directive."""
+    return isinstance(date_format, str) and re.search(r"%[a-zA-Z]", date_format) is not None
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import sqlite3
+
+# --- Record Store ---
+# Every extracted record is kept in a SQLite database next to the workbook,
+# '<name>.records.sqlite', which is the system of record. The workbook is built
+# from it: each record remembers whether it has reached the workbook yet, so a
+# build only writes the records added since the last one, and only the sheets
+# of their BATEAs change (see code_base.materialize_workbook). New records are
+# written to the workbook as they are stored (see RecordStore.tee).
+
+# Records read from the store, or stored, at a time
+FETCH_SIZE = 500
+# Longest time extracted records wait before they are committed, so a crash or
+# a killed run loses at most this much extraction work
+CHECKPOINT_SECONDS = 1.0
+
+class RecordStore:
+    """
+    The records of one workbook, stored in SQLite with one row per PDF (keyed by
+    its SHA-256) and indexed by BATEA and by whether they have been built into
+    the workbook.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Records added by the last add() or tee()
+        self.added = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        # Write-ahead log: a commit is an append, so checkpointing often stays cheap
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " id INTEGER PRIMARY KEY,"
+            " pdf_hash TEXT UNIQUE,"
+            " source_file TEXT NOT NULL,"
+            " batea TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " built INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_batea ON records (batea)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_pending ON records (built, id)")
+        self.connection.commit()
+
+    def known_hashes(self):
+        """Returns the SHA-256 of every PDF already in the store."""
+        return {pdf_hash for (pdf_hash,) in self.connection.execute(
+            "SELECT pdf_hash FROM records WHERE pdf_hash IS NOT NULL")}
+
+    def add(self, records, built_hashes=()):
+        """
+        Stores the records (an iterable, consumed as it goes), committing every
+        FETCH_SIZE of them or every CHECKPOINT_SECONDS, whichever comes first.
+        If the iterable fails (e.g. the extraction stops with an error), the
+        records before the failure are committed before the error goes on.
+        Records whose PDF is in built_hashes (already in the workbook, e.g. from
+        its sidecar index) are stored as built.
+        Returns the number of records added.
+        """
+        for record in self.tee(records, built_hashes):
+            pass
+        return self.added
+
+    def tee(self, records, built_hashes=()):
+        """
+        Generator: stores the records as add() does, and yields each one it
+        added as not built, so the workbook can be written while the records
+        are still being extracted. Records already in the store, or stored as
+        built, are not yielded. Afterwards, self.added is the number of
+        records added. Closing the generator commits what it has stored.
+        """
+        self.added = 0
+        pending = 0
+        checkpoint = time.monotonic() + CHECKPOINT_SECONDS
+        try:
+            for record in records:
+                pdf_hash = record.get('Source Hash')
+                built = pdf_hash in built_hashes
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO records (pdf_hash, source_file, batea, data, built) VALUES (?, ?, ?, ?, ?)",
+                    (pdf_hash, record['Source File'], record.get('BATEA', "").strip(), json.dumps(record), int(built)))
+                pending += 1
+                if pending >= FETCH_SIZE or time.monotonic() >= checkpoint:
+                    self.connection.commit()
+                    pending = 0
+                    checkpoint = time.monotonic() + CHECKPOINT_SECONDS
+                if cursor.rowcount:
+                    self.added += 1
+                    if not built:
+                        yield record
+        finally:
+            self.connection.commit()
+
+    def pending_bateas(self):
+        """Returns {BATEA: number of records not built into the workbook yet}."""
+        return dict(self.connection.execute(
+            "SELECT batea, COUNT(*) FROM records WHERE built = 0 GROUP BY batea ORDER BY batea"))
+
+    def last_pending_id(self):
+        """Returns the id of the newest record not built yet, or None if there is none."""
+        return self.connection.execute("SELECT MAX(id) FROM records WHERE built = 0").fetchone()[0]
+
+    def iter_pending(self, last_id):
+        """Yields the records not built yet, up to last_id, oldest first, FETCH_SIZE at a time."""
+        cursor = self.connection.execute("SELECT data FROM records WHERE built = 0 AND id <= ? ORDER BY id",
+                                         (last_id,))
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            for (data,) in rows:
+                yield json.loads(data)
+
+    def mark_built(self, last_id):
+        """Marks the records up to last_id as built into the workbook."""
+        with self.connection:
+            self.connection.execute("UPDATE records SET built = 1 WHERE built = 0 AND id <= ?", (last_id,))
+
+    def reset_built(self):
+        """Marks every record as not built, so the next build writes them all (e.g. the workbook was deleted)."""
+        with self.connection:
+            self.connection.execute("UPDATE records SET built = 0 WHERE built = 1")
+
+    def close(self):
+        self.connection.close()
+
+def get_store_path(output_filename):
+    """Returns the path of the record store of a workbook, e.g. 'datos.records.sqlite'."""
+    base_name, _ = os.path.splitext(output_filename)
+    return base_name + ".records.sqlite"
+
+def open_record_store(output_filename):
+    """
+    Opens the record store of a workbook. If the workbook does not exist
+    (any more), every stored record is marked as not built, so the next build
+    recreates it in full.
+    Returns None if the store cannot be opened, so the run goes on writing the workbook directly.
+    """
+    path = get_store_path(output_filename)
+    try:
+        store = RecordStore(path)
+        if not os.path.exists(output_filename):
+            store.reset_built()
+        return store
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: Could not open the record store '{path}'. Error: {e}")
+        print("Continuing without it.")
+        return None
@@ -0,0 +1,290 @@
+import os
+import re
+import csv
+import sqlite3
+import datetime
+import importlib.util
+from collections import OrderedDict, Counter
+
+# --- Output Sinks ---
+# Besides the Excel workbook, the records can go to files meant for volume
+# and querying: CSV or Parquet files partitioned by BATEA and month, or a
+# table in a SQLite database. A sink receives the records a chunk at a time,
+# already converted with the write plan (see code_base.export_to_sink).
+
+OUTPUT_FORMATS = ("excel", "csv", "parquet", "sqlite")
+
+# One folder per BATEA and month ('VICTORIA/2025-10'). Not named the Hive way
+# ('BATEA=...'), which readers would turn into a second BATEA column
+PARTITION_FOLDER = os.path.join("{batea}", "{month}")
+UNKNOWN_MONTH = "unknown"
+# Partition files kept open at a time. Past this, the least recently written
+# one is finished (and opened again if more of its rows come), so a run over
+# many BATEAs and months stays under the open-file limit
+MAX_OPEN_PARTITIONS = 32
+INVALID_PATH_CHARACTERS_RE = re.compile(r'[\\/:*?"<>|=\x00-\x1f]')
+
+CSV_FILENAME = "albaranes.csv"
+SQLITE_TABLE = "albaranes"
+# Columns every sink adds after the write plan's
+SOURCE_COLUMNS = ("Source File", "Source Hash")
+
+class SinkError(Exception):
+    """Raised when a sink cannot be opened or written to."""
+
+def parquet_available():
+    """Checks whether pyarrow, needed for Parquet output, is installed."""
+    return importlib.util.find_spec("pyarrow") is not None
+
+def get_partition_value(text):
+    """Makes a BATEA usable as a folder name: forbidden characters become '_'."""
+    value = INVALID_PATH_CHARACTERS_RE.sub("_", text).strip().rstrip(".")
+    return value or "_"
+
+def get_month(value):
+    """Returns the 'YYYY-MM' of a converted date, or UNKNOWN_MONTH if it is not one."""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime("%Y-%m")
+    return UNKNOWN_MONTH
+
+class PartitionedSink:
+    """
+    Base of the sinks that write one file per BATEA and month. The month comes
+    from the first date column of the write plan; without one, everything
+    goes to an 'unknown' month. At most MAX_OPEN_PARTITIONS files are open at once.
+    """
+
+    def __init__(self, folder, write_plan):
+        self.folder = folder
+        self.write_plan = write_plan
+        self.headers = [column.header for column in write_plan] + list(SOURCE_COLUMNS)
+        self._date_position = next((position for position, column in enumerate(write_plan)
+                                    if column.type == "date"), None)
+        # Open partitions, least recently written first, and how many times each was opened
+        self._partitions = OrderedDict()
+        self._opened = Counter()
+        try:
+            os.makedirs(folder, exist_ok=True)
+        except OSError as e:
+            raise SinkError(f"Could not create the folder '{folder}': {e}")
+
+    def _partition_folder(self, key):
+        return os.path.join(self.folder, PARTITION_FOLDER.format(batea=key[0], month=key[1]))
+
+    def write(self, records, typed_rows):
+        """Writes a chunk: the records and their values converted with the write plan."""
+        rows_by_partition = {}
+        for record, values in zip(records, typed_rows):
+            month = get_month(values[self._date_position]) if self._date_position is not None else UNKNOWN_MONTH
+            key = (get_partition_value(record.get('BATEA', "").strip()), month)
+            rows_by_partition.setdefault(key, []).append(
+                list(values) + [record.get(name) for name in SOURCE_COLUMNS])
+
+        for key, rows in rows_by_partition.items():
+            folder = self._partition_folder(key)
+            partition = self._partitions.get(key)
+            if partition is None:
+                if len(self._partitions) >= MAX_OPEN_PARTITIONS:
+                    self._finish(*self._partitions.popitem(last=False))
+                try:
+                    os.makedirs(folder, exist_ok=True)
+                    partition = self._open_partition(folder, self._opened[key])
+                except OSError as e:
+                    raise SinkError(f"Could not write to '{folder}': {e}")
+                self._partitions[key] = partition
+                self._opened[key] += 1
+            else:
+                self._partitions.move_to_end(key)
+            try:
+                self._write_rows(partition, rows)
+            except OSError as e:
+                raise SinkError(f"Could not write to '{folder}': {e}")
+
+    def _finish(self, key, partition):
+        """Closes one partition file. Raises SinkError if it cannot be completed."""
+        try:
+            self._close_partition(partition)
+        except OSError as e:
+            raise SinkError(f"Could not finish the file in '{self._partition_folder(key)}': {e}")
+
+    def close(self):
+        """Finishes every partition file still open, then raises the first error, if any."""
+        partitions, self._partitions = self._partitions, OrderedDict()
+        error = None
+        for key, partition in partitions.items():
+            try:
+                self._finish(key, partition)
+            except SinkError as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+class CsvSink(PartitionedSink):
+    """
+    Appends the records to 'albaranes.csv' in each partition folder. Dates are
+    written as YYYY-MM-DD and numbers with a '.' decimal point, so the files
+    read back the same anywhere.
+    """
+
+    def _open_partition(self, folder, opened):
+        # A partition opened again is appended to, like one from an earlier run
+        path = os.path.join(folder, CSV_FILENAME)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, newline="", encoding="utf-8") as f:
+                existing_headers = next(csv.reader(f), [])
+            if existing_headers != self.headers:
+                raise SinkError(f"'{path}' was written with other columns. Move it away or export to a new folder.")
+            f = open(path, "a", newline="", encoding="utf-8")
+            writer = csv.writer(f)
+        else:
+            f = open(path, "w", newline="", encoding="utf-8")
+            writer = csv.writer(f)
+            writer.writerow(self.headers)
+        return f, writer
+
+    def _write_rows(self, partition, rows):
+        partition[1].writerows([[value.isoformat() if isinstance(value, datetime.date) else value
+                                 for value in row] for row in rows])
+
+    def _close_partition(self, partition):
+        partition[0].close()
+
+class ParquetSink(PartitionedSink):
+    """
+    Writes the records of the run to a new 'part-<timestamp>.parquet' file in
+    each partition folder, a row group per chunk; a partition finished early
+    (see MAX_OPEN_PARTITIONS) goes on in 'part-<timestamp>-1.parquet' and so on.
+    Every file has the same schema: number columns as doubles, date columns as
+    dates, the rest as text. Values that do not fit their column's type are left empty.
+    Needs pyarrow.
+    """
+
+    def __init__(self, folder, write_plan):
+        if not parquet_available():
+            raise SinkError("Parquet output needs the 'pyarrow' package. Install it with 'pip install pyarrow'.")
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        arrow_types = {"number": pyarrow.float64(), "date": pyarrow.date32()}
+        self._types = [arrow_types.get(column.type, pyarrow.string()) for column in write_plan]
+        self._types += [pyarrow.string()] * len(SOURCE_COLUMNS)
+        self._part_name = f"part-{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        self._dropped = {}
+        super().__init__(folder, write_plan)
+        self.schema = pyarrow.schema(list(zip(self.headers, self._types)))
+
+    def _fit(self, header, arrow_type, values):
+        """Returns the values of a column that match its type, the others as None (counted for the warning)."""
+        if arrow_type == self._pyarrow.float64():
+            accepted = (int, float)
+        elif arrow_type == self._pyarrow.date32():
+            accepted = datetime.date
+        else:
+            return [None if value is None else str(value) for value in values]
+        fitted = [value if isinstance(value, accepted) and not isinstance(value, bool) else None for value in values]
+        dropped = sum(1 for value, fit in zip(values, fitted) if value is not None and fit is None)
+        if dropped:
+            self._dropped[header] = self._dropped.get(header, 0) + dropped
+        return fitted
+
+    def _open_partition(self, folder, opened):
+        # A Parquet file cannot be appended to once closed: a reopened partition gets another part
+        part_name = f"{self._part_name}-{opened}.parquet" if opened else f"{self._part_name}.parquet"
+        return self._parquet.ParquetWriter(os.path.join(folder, part_name), self.schema)
+
+    def _write_rows(self, writer, rows):
+        columns = list(zip(*rows))
+        arrays = [self._pyarrow.array(self._fit(header, arrow_type, list(values)), type=arrow_type)
+                  for header, arrow_type, values in zip(self.headers, self._types, columns)]
+        writer.write_table(self._pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def _close_partition(self, writer):
+        writer.close()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for header, dropped in self._dropped.items():
+                print(f"Warning: {dropped} value(s) in column '{header}' do not fit its type. They are left empty in the Parquet files.")
+            self._dropped = {}
+
+def quote_identifier(name):
+    """Quotes a column name for SQLite ('KG BRUTOS' -> '"KG BRUTOS"')."""
+    return '"' + name.replace('"', '""') + '"'
+
+class SqliteSink:
+    """
+    Inserts the records into the 'albaranes' table of a SQLite database, with
+    one column per output column plus the source file and its SHA-256. A PDF
+    already in the table (same SHA-256) is not inserted again, and columns
+    added to the write plan since the table was created are added to it.
+    Dates are stored as YYYY-MM-DD text.
+    """
+
+    def __init__(self, path, write_plan):
+        self.path = path
+        self.headers = [column.header for column in write_plan] + list(SOURCE_COLUMNS)
+        folder = os.path.dirname(path)
+        try:
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.connection = sqlite3.connect(path)
+            sql_types = {"number": "REAL", "date": "TEXT", "text": "TEXT", "nif": "TEXT"}
+            column_types = [sql_types.get(column.type, "") for column in write_plan] + ["TEXT"] * len(SOURCE_COLUMNS)
+            definitions = ", ".join(f"{quote_identifier(header)} {sql_type}".strip()
+                                    for header, sql_type in zip(self.headers, column_types))
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {SQLITE_TABLE} ({definitions})")
+            existing = {row[1] for row in self.connection.execute(f"PRAGMA table_info({SQLITE_TABLE})")}
+            for header, sql_type in zip(self.headers, column_types):
+                if header not in existing:
+                    self.connection.execute(f"ALTER TABLE {SQLITE_TABLE} ADD COLUMN {quote_identifier(header)} {sql_type}")
+            self.connection.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {SQLITE_TABLE}_source_hash "
+                                    f"ON {SQLITE_TABLE} ({quote_identifier('Source Hash')})")
+            self.connection.commit()
+        except sqlite3.Error as e:
+            raise SinkError(f"Could not open the database '{path}': {e}")
+        self._insert = (f"INSERT OR IGNORE INTO {SQLITE_TABLE} ({', '.join(map(quote_identifier, self.headers))}) "
+                        f"VALUES ({', '.join('?' * len(self.headers))})")
+
+    def write(self, records, typed_rows):
+        """Inserts a chunk, in one transaction."""
+        rows = [[value.isoformat() if isinstance(value, datetime.date) else value for value in values]
+                + [record.get(name) for name in SOURCE_COLUMNS]
+                for record, values in zip(records, typed_rows)]
+        try:
+            with self.connection:
+                self.connection.executemany(self._insert, rows)
+        except sqlite3.Error as e:
+            raise SinkError(f"Could not write to the database '{self.path}': {e}")
+
+    def close(self):
+        self.connection.close()
+
+SINKS = {
+    "csv": CsvSink,
+    "parquet": ParquetSink,
+    "sqlite": SqliteSink,
+}
+
+def open_sink(output_format, output_path, write_plan):
+    """Opens the sink of an output format other than "excel". Raises SinkError if it cannot be opened."""
+    return SINKS[output_format](output_path, write_plan)
+
+def get_output_path(output_name, output_format):
+    """
+    Turns the output name typed by the user into the path of the output:
+    an .xlsx workbook, a .sqlite database, or a '<name>_csv' / '<name>_parquet'
+    folder (an .xlsx extension in the name is dropped).
+    """
+    base_name, extension = os.path.splitext(output_name)
+    if output_format == "excel":
+        return output_name if extension.lower() == ".xlsx" else output_name + ".xlsx"
+    if extension.lower() == ".xlsx":
+        output_name = base_name
+    if output_format == "sqlite":
+        base_name, extension = os.path.splitext(output_name)
+        return output_name if extension.lower() in (".sqlite", ".db") else output_name + ".sqlite"
+    suffix = "_" + output_format
+    return output_name if output_name.endswith(suffix) else output_name + suffix
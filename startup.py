@@ -0,0 +1,49 @@
+import sys
+import time
+import importlib
+
+# --- Startup Time ---
+# The heavy modules are only imported by the stage that needs them: code_base
+# when the GUI starts processing, PyMuPDF by the extraction and pandas by the
+# value conversion. '--startup-time' reports how long startup took and what
+# each of those imports costs once it happens.
+
+# Time the GUI window (or the CLI's first prompt) may take to appear, in seconds
+STARTUP_BUDGET_SECONDS = 1.0
+
+# Loaded on demand, in the order a run needs them
+DEFERRED_MODULES = ("code_base", "pymupdf", "pandas")
+
+def measure_imports(module_names=DEFERRED_MODULES):
+    """
+    Imports the modules one after the other. Returns [(name, seconds)], with
+    None for a module that was already loaded at startup. A module's time
+    leaves out whatever the modules before it in the list already loaded.
+    """
+    timings = []
+    for name in module_names:
+        if name in sys.modules:
+            timings.append((name, None))
+            continue
+        start = time.perf_counter()
+        importlib.import_module(name)
+        timings.append((name, time.perf_counter() - start))
+    return timings
+
+def check_startup_budget(startup_seconds, what="Startup", budget=STARTUP_BUDGET_SECONDS):
+    """Prints a warning if startup took longer than the budget. Returns True if it fit in it."""
+    if startup_seconds <= budget:
+        return True
+    print(f"Warning: {what} took {startup_seconds:.2f} s, over the budget of {budget:.1f} s. "
+          f"Run with --startup-time for details.")
+    return False
+
+def print_startup_report(startup_seconds, what="Startup", module_names=DEFERRED_MODULES):
+    """Prints the startup time against the budget, then measures and prints the deferred imports."""
+    print(f"{what} took {startup_seconds:.3f} s (budget {STARTUP_BUDGET_SECONDS:.1f} s).")
+    print("Import time of the modules loaded on demand:")
+    for name, seconds in measure_imports(module_names):
+        if seconds is None:
+            print(f"  {name:<12} already loaded at startup")
+        else:
+            print(f"  {name:<12} {seconds:.3f} s")
@@ -0,0 +1,149 @@
+import os
+import pickle
+from collections import namedtuple
+import openpyxl
+from openpyxl import load_workbook
+from openpyxl.styles.numbers import BUILTIN_FORMATS_MAX_SIZE
+
+from extract_cache import file_sha256, get_cache_folder
+
+# --- Template Cache ---
+# PLANTILLA.xlsx is parsed once and the parts of it the new sheets are built
+# from (see TemplateLayout) are pickled next to the extraction cache, in the
+# user's cache folder. Later runs unpickle them instead of parsing the xlsx
+# again, until the template's contents change.
+
+TEMPLATE_CACHE_PATH = os.path.join(get_cache_folder(), "template_cache.pickle")
+# Bump when the layout of the cache file changes
+TEMPLATE_CACHE_VERSION = 2
+
+# A cell or dimension style of the template, independent of any workbook:
+# the style objects themselves, the number format (a built-in format id, or
+# the format text for the others) and the name of its named style
+TemplateStyle = namedtuple("TemplateStyle", ["font", "fill", "border", "alignment", "protection",
+                                             "number_format", "named_style", "quote_prefix", "pivot_button"])
+
+# Dimension attributes that are not copied as they are: the style is kept
+# as a TemplateStyle, and the 'custom' flags follow from the width and height
+DIMENSION_SKIPPED_FIELDS = ("style", "s", "customFormat", "customWidth", "customHeight")
+
+class TemplateLayout:
+    """
+    What the new sheets take from the template's first sheet: its cells
+    (values and styles), column widths, row heights, merged cells and the
+    sheet-level properties (tab colour, page setup...). Holds no openpyxl
+    workbook, so it pickles to a few KB.
+    """
+
+    def __init__(self, sheet):
+        workbook = sheet.parent
+        self.title = sheet.title
+        self.max_row = sheet.max_row
+        self.max_column = sheet.max_column
+        self.styles = []
+        self._style_keys = {}
+
+        # {row: [(column, value, style key or None), ...]}, only the cells with a value or a style
+        self.rows = {}
+        for row in sheet.iter_rows():
+            for cell in row:
+                if cell.value is None and not cell.has_style:
+                    continue
+                style_key = self._add_style(workbook, cell._style) if cell.has_style else None
+                self.rows.setdefault(cell.row, []).append((cell.column, cell.value, style_key))
+
+        # [(letter or row, {attribute: value}, style key or None), ...]
+        self.column_dimensions = [(letter, self._dimension_fields(dim), self._dimension_style(workbook, dim))
+                                  for letter, dim in sheet.column_dimensions.items()]
+        self.row_dimensions = [(row_index, self._dimension_fields(dim), self._dimension_style(workbook, dim))
+                               for row_index, dim in sheet.row_dimensions.items()]
+        self.merged_cells = [merge_range.coord for merge_range in sheet.merged_cells.ranges]
+
+        self.sheet_properties = sheet.sheet_properties
+        self.sheet_format = sheet.sheet_format
+        self.page_margins = sheet.page_margins
+        self.page_setup = sheet.page_setup
+        self.print_options = sheet.print_options
+        # page_setup points back to its sheet: only its settings are kept
+        self.page_setup._parent = None
+        del self._style_keys
+
+    def _add_style(self, workbook, style):
+        """Returns the index in self.styles of a style array of the template, adding it the first time."""
+        key = self._style_keys.get(style)
+        if key is None:
+            if style.numFmtId >= BUILTIN_FORMATS_MAX_SIZE:
+                number_format = workbook._number_formats[style.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+            else:
+                number_format = style.numFmtId
+            named_style = workbook._named_styles[style.xfId].name if style.xfId < len(workbook._named_styles) else None
+            self.styles.append(TemplateStyle(
+                workbook._fonts[style.fontId], workbook._fills[style.fillId], workbook._borders[style.borderId],
+                workbook._alignments[style.alignmentId], workbook._protections[style.protectionId],
+                number_format, named_style, style.quotePrefix, style.pivotButton))
+            key = self._style_keys[style] = len(self.styles) - 1
+        return key
+
+    def _dimension_style(self, workbook, dim):
+        return self._add_style(workbook, dim._style) if dim.has_style else None
+
+    @staticmethod
+    def _dimension_fields(dim):
+        return {name: getattr(dim, name) for name in dim.__fields__ if name not in DIMENSION_SKIPPED_FIELDS}
+
+    def header_map(self, header_row=4):
+        """Returns {header name: column index} for the header row, like code_base.get_header_map."""
+        return {str(value).strip(): column for column, value, style_key in self.rows.get(header_row, []) if value}
+
+def _read_template_cache(cache_path):
+    """Returns the cache file's contents, or None if there is no usable cache."""
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("version") != TEMPLATE_CACHE_VERSION \
+            or cached.get("openpyxl") != openpyxl.__version__:
+        return None
+    return cached
+
+def _write_template_cache(cache_path, cached):
+    """Saves the cache file (through a temporary file). A failure only prints a warning."""
+    temp_path = cache_path + ".tmp"
+    try:
+        folder = os.path.dirname(cache_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(temp_path, "wb") as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Could not save the template cache '{cache_path}'. Error: {e}")
+
+def load_template_layout(template_path, cache_path=TEMPLATE_CACHE_PATH):
+    """
+    Returns the TemplateLayout of the template's first sheet. It comes from
+    the cache when the template has the size and SHA-256 it was cached with,
+    wherever it is: the frozen GUI unpacks PLANTILLA.xlsx to a new temporary
+    folder on every launch. Otherwise the template is parsed and the cache rebuilt.
+    Raises the errors of load_workbook if the template cannot be read.
+    """
+    size = os.path.getsize(template_path)
+    sha256 = file_sha256(template_path)
+    cached = _read_template_cache(cache_path)
+    if cached is not None and (cached["size"], cached["sha256"]) == (size, sha256):
+        return cached["layout"]
+
+    template_wb = load_workbook(template_path)
+    try:
+        layout = TemplateLayout(template_wb.active)
+    finally:
+        template_wb.close()
+    _write_template_cache(cache_path, {
+        "version": TEMPLATE_CACHE_VERSION,
+        "openpyxl": openpyxl.__version__,
+        "size": size,
+        "sha256": sha256,
+        "layout": layout,
+    })
+    return layout
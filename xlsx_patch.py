@@ -0,0 +1,685 @@
+import io
+import os
+import re
+import math
+import shutil
+import zipfile
+import datetime
+import posixpath
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, unescape
+
+from openpyxl.styles import Font, Border, Alignment, Protection
+from openpyxl.styles.fills import Fill
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_REVERSE, BUILTIN_FORMATS_MAX_SIZE, is_date_format
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.compat import safe_string
+from openpyxl.utils import get_column_letter, column_index_from_string, range_boundaries
+from openpyxl.utils.datetime import to_excel, from_excel, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+from openpyxl.xml.functions import tostring
+
+# --- Direct XLSX Patching ---
+# Adds rows to existing sheets by rewriting only their worksheet XML (and
+# styles.xml), copying every other part of the file through unchanged.
+# New text is written as inline strings, so sharedStrings.xml is never touched.
+# New sheets are copied in from a workbook written by openpyxl, and only
+# the package parts that list the sheets are rewritten for them.
+
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PACKAGE_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+CONTENT_TYPES_PATH = "[Content_Types].xml"
+WORKSHEET_TYPE = f"{REL_NS}/worksheet"
+WORKSHEET_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+
+# Bytes read at a time while a sheet is rewritten
+READ_SIZE = 1024 * 1024
+
+SHEET_DATA_RE = re.compile(r'<sheetData\b[^>]*?(/?)>')
+SHEET_DATA_END_RE = re.compile(r'\s*</sheetData>')
+ROW_RE = re.compile(r'\s*(<row\b[^>]*?(?:/>|>.*?</row>))', re.S)
+ROW_NUMBER_RE = re.compile(r'(<row\b[^>]*?\br=")(\d+)(")')
+CELL_REF_RE = re.compile(r'(<c\b[^>]*?\br=")([A-Z]{1,3})(\d+)(")')
+CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+CELL_COLUMN_RE = re.compile(r'\br="([A-Z]{1,3})\d+"')
+CELL_TYPE_RE = re.compile(r'\bt="(\w+)"')
+CELL_STYLE_RE = re.compile(r'\bs="(\d+)"')
+VALUE_RE = re.compile(r'<v>(.*?)</v>', re.S)
+INLINE_TEXT_RE = re.compile(r'<t\b[^>]*?(?:/>|>(.*?)</t>)', re.S)
+FORMULA_RE = re.compile(r'<f[\s>/]')
+DIMENSION_RE = re.compile(r'(<dimension\b[^>]*?\bref=")([^"]+)(")')
+MERGE_CELL_RE = re.compile(r'(<mergeCell\b[^>]*?\bref=")([^"]+)(")')
+# Parts of a sheet that point at cells, which rows moving down would leave behind
+CELL_ANCHORED_RE = re.compile(r'<(conditionalFormatting|dataValidations|hyperlinks|autoFilter|tableParts|drawing|legacyDrawing)\b')
+# The style ids of a copied sheet: s="..." of cells and rows, style="..." of columns
+STYLED_TAG_RE = re.compile(r'(<(?:c|row)\b[^>]*?\bs="|<col\b[^>]*?\bstyle=")(\d+)(")')
+TAB_SELECTED_RE = re.compile(r'\s+tabSelected="(?:1|true)"')
+SHEET_ID_RE = re.compile(r'<sheet\b[^>]*?\bsheetId="(\d+)"')
+RELATIONSHIP_ID_RE = re.compile(r'<Relationship\b[^>]*?\bId="([^"]+)"')
+XML_ESCAPES = {'"': "&quot;"}
+XML_UNESCAPES = {"&quot;": '"', "&apos;": "'"}
+
+class PatchNotPossible(Exception):
+    """The workbook has something the patcher cannot update safely; use the full openpyxl update instead."""
+
+def _local_part(base_folder, target):
+    """Resolves a relationship target to the name of the zip member."""
+    if target.startswith("/"):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(base_folder, target))
+
+def _read_to_sheet_data(text, sheet_name):
+    """
+    Reads a sheet (a text stream) up to its <sheetData> tag.
+    Returns the text read so far and the match of the tag.
+    """
+    buffer = text.read(READ_SIZE)
+    match = SHEET_DATA_RE.search(buffer)
+    while match is None:
+        chunk = text.read(READ_SIZE)
+        if not chunk:
+            raise PatchNotPossible(f"'{sheet_name}' has no sheetData")
+        buffer += chunk
+        match = SHEET_DATA_RE.search(buffer)
+    return buffer, match
+
+def _xml_text(text):
+    """Unescapes the text of an XML element."""
+    return unescape(text, XML_UNESCAPES) if "&" in text else text
+
+def _style_or_none(style_class, element):
+    """Reads the alignment or protection of a cell format; None when it has none, or the default one."""
+    if element is None:
+        return None
+    style = style_class.from_tree(element)
+    return None if style == style_class() else style
+
+def _read_relationships(archive, rels_path, base_folder):
+    """Returns {relationship id: (type, zip member name)} for a .rels part."""
+    root = ET.fromstring(archive.read(rels_path))
+    relationships = {}
+    for rel in root.iter(f"{{{PACKAGE_REL_NS}}}Relationship"):
+        relationships[rel.get("Id")] = (rel.get("Type"), _local_part(base_folder, rel.get("Target")))
+    return relationships
+
+def _set_count(open_tag, count):
+    """Sets (or adds) the count="..." attribute of an XML start tag."""
+    if re.search(r'\bcount="\d+"', open_tag):
+        return re.sub(r'\bcount="\d+"', f'count="{count}"', open_tag, count=1)
+    return open_tag[:-1] + f' count="{count}">'
+
+def _append_to_section(xml, tag, children):
+    """Appends XML children to the <tag> section of styles.xml, keeping its count right."""
+    match = re.search(rf'<{tag}\b[^>]*?/?>', xml)
+    if match is None:
+        raise PatchNotPossible(f"styles.xml has no <{tag}> section")
+    open_tag = match.group(0)
+    count_match = re.search(r'\bcount="(\d+)"', open_tag)
+    if open_tag.endswith("/>"):
+        count = len(children)
+        section = _set_count(open_tag[:-2].rstrip() + ">", count) + "".join(children) + f"</{tag}>"
+        return xml[:match.start()] + section + xml[match.end():]
+    end = xml.find(f"</{tag}>", match.end())
+    if end == -1 or count_match is None:
+        raise PatchNotPossible(f"styles.xml has an unexpected <{tag}> section")
+    count = int(count_match.group(1)) + len(children)
+    return xml[:match.start()] + _set_count(open_tag, count) + xml[match.end():end] + "".join(children) + xml[end:]
+
+class XlsxPatcher:
+    """
+    Opens an existing .xlsx file to insert rows into some of its sheets, and
+    to add new sheets built elsewhere (see add_sheets).
+    Nothing is written until save(): then the sheets that gain rows are streamed
+    through and rewritten row by row, styles.xml gets the new cell styles, the
+    new sheets are copied in, and every other zip member is copied as it is.
+    Raises PatchNotPossible for layouts it does not handle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._inserts = {}
+        self._new_styles = {}
+        self._new_sheets = []
+        try:
+            self._open(path)
+        except (OSError, zipfile.BadZipFile, KeyError, ValueError, ET.ParseError) as e:
+            raise PatchNotPossible(f"cannot read the workbook ({e})")
+
+    def _open(self, path):
+        """Reads the parts needed to find the sheets and styles of the workbook."""
+        with zipfile.ZipFile(path) as archive:
+            root_rels = _read_relationships(archive, "_rels/.rels", "")
+            workbook_path = next((part for rel_type, part in root_rels.values()
+                                  if rel_type.endswith("/officeDocument")), None)
+            if workbook_path is None:
+                raise PatchNotPossible("no workbook part")
+            workbook_folder = posixpath.dirname(workbook_path)
+            rels_path = posixpath.join(workbook_folder, "_rels", posixpath.basename(workbook_path) + ".rels")
+            relationships = _read_relationships(archive, rels_path, workbook_folder)
+            self._workbook_path, self._rels_path = workbook_path, rels_path
+            self._part_names = set(archive.namelist())
+
+            workbook = ET.fromstring(archive.read(workbook_path))
+            workbook_pr = workbook.find(f"{{{MAIN_NS}}}workbookPr")
+            date1904 = workbook_pr is not None and workbook_pr.get("date1904") in ("1", "true")
+            self.epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+
+            self.sheet_paths = {}
+            for sheet in workbook.iter(f"{{{MAIN_NS}}}sheet"):
+                rel_type, part = relationships.get(sheet.get(f"{{{REL_NS}}}id"), ("", None))
+                if rel_type.endswith("/worksheet"):
+                    self.sheet_paths[sheet.get("name")] = part
+            self.sheetnames = list(self.sheet_paths)
+
+            self.styles_path = next((part for rel_type, part in relationships.values()
+                                     if rel_type.endswith("/styles")), None)
+            self.shared_strings_path = next((part for rel_type, part in relationships.values()
+                                             if rel_type.endswith("/sharedStrings")), None)
+            if self.styles_path is None:
+                raise PatchNotPossible("no styles part")
+            self._styles_xml = archive.read(self.styles_path).decode("utf-8")
+        self._read_styles()
+
+    # --- Styles ---
+
+    def _read_styles(self):
+        """Reads the fonts, fills, borders, number formats, named styles and cell formats already in styles.xml."""
+        root = ET.fromstring(self._styles_xml)
+        if root.tag != f"{{{MAIN_NS}}}styleSheet":
+            raise PatchNotPossible("unexpected styles.xml")
+
+        def section(tag):
+            element = root.find(f"{{{MAIN_NS}}}{tag}")
+            return list(element) if element is not None else []
+
+        self._fonts = [Font.from_tree(el) for el in section("fonts")]
+        self._fills = [Fill.from_tree(el) for el in section("fills")]
+        self._borders = [Border.from_tree(el) for el in section("borders")]
+        self._named_styles = {el.get("name"): int(el.get("xfId", 0)) for el in section("cellStyles")}
+        self._number_formats = {el.get("formatCode"): int(el.get("numFmtId")) for el in section("numFmts")}
+        format_codes = dict(BUILTIN_FORMATS)
+        format_codes.update({number_format_id: code for code, number_format_id in self._number_formats.items()})
+        self._cell_formats = {}
+        self._date_cell_formats = set()
+        for index, xf in enumerate(section("cellXfs")):
+            if is_date_format(format_codes.get(int(xf.get("numFmtId", 0)), "")):
+                self._date_cell_formats.add(str(index))
+            alignment = xf.find(f"{{{MAIN_NS}}}alignment")
+            protection = xf.find(f"{{{MAIN_NS}}}protection")
+            key = tuple(int(xf.get(name, 0)) for name in ("numFmtId", "fontId", "fillId", "borderId", "xfId"))
+            key += (_style_or_none(Alignment, alignment), _style_or_none(Protection, protection),
+                    xf.get("quotePrefix") in ("1", "true"), xf.get("pivotButton") in ("1", "true"))
+            self._cell_formats.setdefault(key, index)
+        self._cell_format_count = len(section("cellXfs"))
+        self._added = {"numFmts": [], "fonts": [], "fills": [], "borders": [], "cellXfs": []}
+
+    def _font_id(self, font):
+        if font in self._fonts:
+            return self._fonts.index(font)
+        self._fonts.append(font)
+        self._added["fonts"].append(tostring(font.to_tree()).decode("utf-8"))
+        return len(self._fonts) - 1
+
+    def _fill_id(self, fill):
+        if fill in self._fills:
+            return self._fills.index(fill)
+        self._fills.append(fill)
+        self._added["fills"].append(tostring(fill.to_tree()).decode("utf-8"))
+        return len(self._fills) - 1
+
+    def _border_id(self, border):
+        if border in self._borders:
+            return self._borders.index(border)
+        self._borders.append(border)
+        self._added["borders"].append(tostring(border.to_tree()).decode("utf-8"))
+        return len(self._borders) - 1
+
+    def _number_format_id(self, number_format):
+        if isinstance(number_format, int):
+            # Already a built-in format id
+            return number_format
+        if number_format in BUILTIN_FORMATS_REVERSE:
+            return BUILTIN_FORMATS_REVERSE[number_format]
+        if number_format not in self._number_formats:
+            new_id = max([BUILTIN_FORMATS_MAX_SIZE - 1] + list(self._number_formats.values())) + 1
+            self._number_formats[number_format] = new_id
+            self._added["numFmts"].append(f'<numFmt numFmtId="{new_id}" formatCode="{escape(number_format, XML_ESCAPES)}"/>')
+        return self._number_formats[number_format]
+
+    def add_cell_style(self, font=None, border=None, number_format=None):
+        """
+        Returns the cell format id (the s="..." of a cell) for a font, border and
+        number format, reusing a matching one from styles.xml when there is one.
+        """
+        return self.add_cell_format(font=font, border=border, number_format=number_format)
+
+    def add_cell_format(self, font=None, fill=None, border=None, number_format=None, alignment=None,
+                        protection=None, named_style=None, quote_prefix=False, pivot_button=False):
+        """
+        Returns the cell format id for a full cell style, like add_cell_style.
+        number_format is the format text or a built-in format id. A named_style
+        the workbook does not have falls back to 'Normal', as in code_base.register_template_styles.
+        """
+        # The defaults are what a cell format without these children means
+        alignment = None if alignment == Alignment() else alignment
+        protection = None if protection == Protection() else protection
+        key = (font, fill, border, number_format, alignment, protection, named_style, bool(quote_prefix), bool(pivot_button))
+        if key in self._new_styles:
+            return self._new_styles[key]
+        named_style_id = self._named_styles.get(named_style, 0)
+        font_id = self._font_id(font) if font is not None else 0
+        fill_id = self._fill_id(fill) if fill is not None else 0
+        border_id = self._border_id(border) if border is not None else 0
+        number_format_id = self._number_format_id(number_format) if number_format else 0
+        format_key = (number_format_id, font_id, fill_id, border_id, named_style_id,
+                      alignment, protection, bool(quote_prefix), bool(pivot_button))
+        if format_key not in self._cell_formats:
+            flags = "".join(f' {name}="1"' for name, used in (("quotePrefix", quote_prefix), ("pivotButton", pivot_button))
+                            if used)
+            applied = "".join(f' {name}="1"' for name, used in (("applyNumberFormat", number_format_id),
+                                                                ("applyFont", font_id), ("applyFill", fill_id),
+                                                                ("applyBorder", border_id),
+                                                                ("applyAlignment", alignment is not None),
+                                                                ("applyProtection", protection is not None)) if used)
+            children = "".join(tostring(style.to_tree()).decode("utf-8")
+                               for style in (alignment, protection) if style is not None)
+            xf = (f'<xf numFmtId="{number_format_id}" fontId="{font_id}" fillId="{fill_id}" '
+                  f'borderId="{border_id}" xfId="{named_style_id}"{flags}{applied}')
+            self._added["cellXfs"].append(f"{xf}>{children}</xf>" if children else f"{xf}/>")
+            self._cell_formats[format_key] = self._cell_format_count
+            self._cell_format_count += 1
+        self._new_styles[key] = self._cell_formats[format_key]
+        return self._new_styles[key]
+
+    def _patched_styles_xml(self):
+        """Returns styles.xml with the new entries appended, or None if nothing was added."""
+        if not any(self._added.values()):
+            return None
+        xml = self._styles_xml
+        if self._added["numFmts"] and re.search(r'<numFmts\b', xml) is None:
+            # numFmts is the first section of the stylesheet
+            start = re.search(r'<styleSheet\b[^>]*>', xml)
+            xml = xml[:start.end()] + '<numFmts count="0"/>' + xml[start.end():]
+        for tag in ("numFmts", "fonts", "fills", "borders", "cellXfs"):
+            if self._added[tag]:
+                xml = _append_to_section(xml, tag, self._added[tag])
+        return xml
+
+    # --- Reading ---
+
+    def _iter_rows(self, archive, sheet_name):
+        """Yields the XML of each row of a sheet, in order, reading the sheet bit by bit."""
+        with archive.open(self.sheet_paths[sheet_name]) as source:
+            text = io.TextIOWrapper(source, encoding="utf-8")
+            buffer, match = _read_to_sheet_data(text, sheet_name)
+            if match.group(1):
+                # <sheetData/>: no rows at all
+                return
+            pos = match.end()
+            while True:
+                # A row only matches once it is complete, so a row cut by the read is read again
+                row = ROW_RE.match(buffer, pos)
+                if row is not None:
+                    yield row.group(1)
+                    pos = row.end()
+                    continue
+                if SHEET_DATA_END_RE.match(buffer, pos):
+                    return
+                chunk = text.read(READ_SIZE)
+                if not chunk:
+                    return
+                buffer = buffer[pos:] + chunk
+                pos = 0
+
+    def _shared_strings(self, archive, indexes):
+        """Returns {index: text} for the given shared string indexes."""
+        if not indexes or self.shared_strings_path is None:
+            return {}
+        wanted, found, index = set(indexes), {}, 0
+        last_wanted = max(wanted)
+        text_tag, run_tag = f"{{{MAIN_NS}}}t", f"{{{MAIN_NS}}}r"
+        with archive.open(self.shared_strings_path) as source:
+            for event, element in ET.iterparse(source, events=("end",)):
+                if element.tag != f"{{{MAIN_NS}}}si":
+                    continue
+                if index in wanted:
+                    # Plain text is one <t>; rich text has a <t> per run (<r>). Phonetic hints (<rPh>) are left out.
+                    parts = [child.text or "" for child in element if child.tag == text_tag]
+                    parts += [run.findtext(text_tag, "") for run in element if run.tag == run_tag]
+                    found[index] = "".join(parts)
+                index += 1
+                element.clear()
+                if index > last_wanted:
+                    break
+        return found
+
+    def read_header_map(self, sheet_name, header_row=4):
+        """
+        Reads a sheet's header row without loading the sheet, and returns a dictionary
+        mapping header names to column indices, like get_header_map in code_base.
+        """
+        cells = self.read_cells(sheet_name, header_row, header_row).get(header_row, {})
+        return {str(value).strip(): column for column, value in cells.items() if value}
+
+    def read_cells(self, sheet_name, min_row, max_row=None, columns=None):
+        """
+        Reads the cells of a sheet from min_row to max_row (or to the end), only
+        in the given column indexes if any, without loading the sheet.
+        Returns {row number: {column index: value}} with the values typed as
+        openpyxl reads them: text, int or float, bool, and datetime for numbers
+        with a date format. Empty cells are left out.
+        """
+        try:
+            return self._read_cells(sheet_name, min_row, max_row, columns)
+        except (OSError, zipfile.BadZipFile, KeyError, ValueError, ET.ParseError) as e:
+            raise PatchNotPossible(f"cannot read the cells of '{sheet_name}' ({e})")
+
+    def _read_cells(self, sheet_name, min_row, max_row, columns):
+        wanted = set(columns) if columns is not None else None
+        column_indexes = {}
+        rows, shared = {}, []
+        with zipfile.ZipFile(self.path) as archive:
+            for row_xml in self._iter_rows(archive, sheet_name):
+                row_number = ROW_NUMBER_RE.search(row_xml)
+                if row_number is None:
+                    raise PatchNotPossible(f"a row of '{sheet_name}' has no number")
+                row_number = int(row_number.group(2))
+                if row_number < min_row:
+                    continue
+                if max_row is not None and row_number > max_row:
+                    break
+
+                values = {}
+                for attributes, content in CELL_RE.findall(row_xml):
+                    reference = CELL_COLUMN_RE.search(attributes)
+                    if reference is None:
+                        raise PatchNotPossible(f"a cell of '{sheet_name}' has no reference")
+                    letters = reference.group(1)
+                    if letters not in column_indexes:
+                        column_indexes[letters] = column_index_from_string(letters)
+                    column = column_indexes[letters]
+                    if wanted is not None and column not in wanted:
+                        continue
+                    cell_type = CELL_TYPE_RE.search(attributes)
+                    cell_type = cell_type.group(1) if cell_type is not None else "n"
+                    value = self._cell_value(cell_type, attributes, content or "")
+                    if value is None:
+                        continue
+                    if cell_type == "s":
+                        shared.append((values, column, value))
+                    values[column] = value
+                if values:
+                    rows[row_number] = values
+
+            texts = self._shared_strings(archive, [int(value) for values, column, value in shared])
+        for values, column, value in shared:
+            values[column] = texts.get(int(value), "")
+        return rows
+
+    def _cell_value(self, cell_type, attributes, content):
+        """Returns the value of a cell; for shared strings, the index of the string."""
+        if cell_type == "inlineStr":
+            return _xml_text("".join(t or "" for t in INLINE_TEXT_RE.findall(content)))
+        value = VALUE_RE.search(content)
+        if value is None:
+            return None
+        value = _xml_text(value.group(1))
+        if cell_type in ("s", "str", "e"):
+            return value
+        if cell_type == "b":
+            return value in ("1", "true")
+        number = float(value) if any(char in value for char in ".eE") else int(value)
+        style = CELL_STYLE_RE.search(attributes)
+        if style is not None and style.group(1) in self._date_cell_formats:
+            return from_excel(number, self.epoch)
+        return number
+
+    # --- Writing ---
+
+    def insert_rows(self, sheet_name, first_row, count, rows):
+        """
+        Schedules 'count' new rows to be inserted at first_row, pushing the
+        existing rows from first_row down (like openpyxl's insert_rows).
+        'rows' is an iterable (consumed during save) giving, from top to bottom,
+        the cells of each new row as (column index, value, cell format id).
+        """
+        if sheet_name not in self.sheet_paths:
+            raise PatchNotPossible(f"no sheet '{sheet_name}'")
+        self._inserts[self.sheet_paths[sheet_name]] = (sheet_name, first_row, count, rows)
+
+    def add_sheets(self, source_path, cell_formats):
+        """
+        Schedules every sheet of another .xlsx file, written by openpyxl's
+        write-only mode (inline strings, nothing linked to the sheets), to be
+        appended after the sheets of this workbook. cell_formats gives, for each
+        cell format id of that file, the id of the same format here (see add_cell_format).
+        """
+        source = XlsxPatcher(source_path)
+        taken = {name.casefold() for name in self.sheetnames}
+        taken.update(sheet_name.casefold() for sheet_name, *rest in self._new_sheets)
+        for sheet_name, source_part in source.sheet_paths.items():
+            source_rels = posixpath.join(posixpath.dirname(source_part), "_rels", posixpath.basename(source_part) + ".rels")
+            if source_rels in source._part_names:
+                raise PatchNotPossible(f"the new sheet '{sheet_name}' has linked parts")
+            if sheet_name.casefold() in taken:
+                raise PatchNotPossible(f"the workbook already has a sheet '{sheet_name}'")
+            taken.add(sheet_name.casefold())
+            self._new_sheets.append((sheet_name, source_path, source_part, cell_formats))
+
+    def _new_sheet_parts(self, archive):
+        """
+        Names the zip members of the new sheets and returns them as [(member, sheet)],
+        with the rewritten parts that list the sheets as {member: XML}:
+        the content types, workbook.xml and its relationships.
+        docProps/app.xml keeps its old list of sheet titles; Excel rebuilds it on save.
+        """
+        content_types = archive.read(CONTENT_TYPES_PATH).decode("utf-8")
+        workbook_xml = archive.read(self._workbook_path).decode("utf-8")
+        rels_xml = archive.read(self._rels_path).decode("utf-8")
+        workbook_folder = posixpath.dirname(self._workbook_path)
+
+        prefix = re.search(rf'\bxmlns:(\w+)="{re.escape(REL_NS)}"', workbook_xml)
+        id_attribute = f"{prefix.group(1)}:id" if prefix else f'xmlns:r="{REL_NS}" r:id'
+        sheet_id = max([0] + [int(found) for found in SHEET_ID_RE.findall(workbook_xml)])
+        relationship_ids = set(RELATIONSHIP_ID_RE.findall(rels_xml))
+        part_names = set(self._part_names)
+
+        members, overrides, sheets, relationships = [], [], [], []
+        sheet_number = len(self.sheetnames)
+        for new_sheet in self._new_sheets:
+            member = None
+            while member is None or member in part_names:
+                sheet_number += 1
+                member = posixpath.join(workbook_folder, "worksheets", f"sheet{sheet_number}.xml")
+            part_names.add(member)
+            number = len(relationship_ids) + 1
+            while f"rId{number}" in relationship_ids:
+                number += 1
+            relationship_id = f"rId{number}"
+            relationship_ids.add(relationship_id)
+            sheet_id += 1
+
+            members.append((member, new_sheet))
+            overrides.append(f'<Override PartName="/{member}" ContentType="{WORKSHEET_CONTENT_TYPE}"/>')
+            sheets.append(f'<sheet name="{escape(new_sheet[0], XML_ESCAPES)}" sheetId="{sheet_id}" '
+                          f'{id_attribute}="{relationship_id}"/>')
+            relationships.append(f'<Relationship Id="{relationship_id}" Type="{WORKSHEET_TYPE}" '
+                                 f'Target="{posixpath.relpath(member, workbook_folder or ".")}"/>')
+
+        def insert_before(xml, end_tag, parts):
+            end = xml.rfind(end_tag)
+            if end == -1:
+                raise PatchNotPossible(f"no {end_tag} to add the new sheets to")
+            return xml[:end] + "".join(parts) + xml[end:]
+
+        parts = {
+            CONTENT_TYPES_PATH: insert_before(content_types, "</Types>", overrides),
+            self._workbook_path: insert_before(workbook_xml, "</sheets>", sheets),
+            self._rels_path: insert_before(rels_xml, "</Relationships>", relationships),
+        }
+        return members, parts
+
+    @staticmethod
+    def _copy_sheet(target, source_path, source_part, cell_formats):
+        """Streams a new sheet in from its source file, moving its style ids to this workbook's."""
+        def new_style(match):
+            style_id = int(match.group(2))
+            if style_id >= len(cell_formats):
+                raise PatchNotPossible(f"'{source_part}' uses an unknown cell format ({style_id})")
+            return f"{match.group(1)}{cell_formats[style_id]}{match.group(3)}"
+
+        with zipfile.ZipFile(source_path) as archive, archive.open(source_part) as source:
+            text = io.TextIOWrapper(source, encoding="utf-8")
+            rest = ""
+            while True:
+                chunk = text.read(READ_SIZE)
+                buffer = rest + chunk
+                # Only whole tags are rewritten: the part after the last '>' waits for the next read
+                cut = buffer.rfind(">") + 1 if chunk else len(buffer)
+                buffer, rest = buffer[:cut], buffer[cut:]
+                # The sheet was the selected one of its own workbook, not of this one
+                buffer = TAB_SELECTED_RE.sub("", STYLED_TAG_RE.sub(new_style, buffer))
+                target.write(buffer.encode("utf-8"))
+                if not chunk:
+                    return
+
+    def _cell_xml(self, ref, value, style_id):
+        style = f' s="{style_id}"' if style_id else ""
+        if value is None or value == "":
+            return f'<c r="{ref}"{style}/>'
+        if isinstance(value, bool):
+            return f'<c r="{ref}"{style} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)) and not (isinstance(value, float) and not math.isfinite(value)):
+            return f'<c r="{ref}"{style}><v>{safe_string(value)}</v></c>'
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return f'<c r="{ref}"{style}><v>{safe_string(to_excel(value, self.epoch))}</v></c>'
+        text = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+        space = ' xml:space="preserve"' if text != text.strip() else ""
+        return f'<c r="{ref}"{style} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+
+    def _new_rows_xml(self, first_row, rows):
+        for offset, cells in enumerate(rows):
+            row_number = first_row + offset
+            parts = [f'<row r="{row_number}">']
+            for column, value, style_id in sorted(cells, key=lambda cell: cell[0]):
+                parts.append(self._cell_xml(f"{get_column_letter(column)}{row_number}", value, style_id))
+            parts.append("</row>")
+            yield "".join(parts)
+
+    def _rewrite_sheet(self, source, target, sheet_name, first_row, count, rows):
+        """Streams one sheet through, inserting the new rows and moving the ones below them down."""
+        text = io.TextIOWrapper(source, encoding="utf-8")
+
+        def write(part):
+            target.write(part.encode("utf-8"))
+
+        def shift_row(row_xml):
+            if FORMULA_RE.search(row_xml):
+                raise PatchNotPossible(f"'{sheet_name}' has formulas below row {first_row}")
+            row_xml = ROW_NUMBER_RE.sub(lambda m: f"{m.group(1)}{int(m.group(2)) + count}{m.group(3)}", row_xml, count=1)
+            return CELL_REF_RE.sub(lambda m: f"{m.group(1)}{m.group(2)}{int(m.group(3)) + count}{m.group(4)}", row_xml)
+
+        # Everything up to <sheetData>: just fix the dimension
+        buffer, match = _read_to_sheet_data(text, sheet_name)
+        write(DIMENSION_RE.sub(lambda m: m.group(1) + self._new_dimension(m.group(2), first_row, count) + m.group(3),
+                               buffer[:match.start()], count=1))
+
+        new_rows = self._new_rows_xml(first_row, rows)
+        if match.group(1):
+            # Empty sheet: <sheetData/>
+            write("<sheetData>")
+            for row_xml in new_rows:
+                write(row_xml)
+            write("</sheetData>")
+            pos = match.end()
+        else:
+            write(match.group(0))
+            pos = match.end()
+            inserted = False
+            while True:
+                row = ROW_RE.match(buffer, pos)
+                if row is not None:
+                    row_xml = row.group(1)
+                    row_number = ROW_NUMBER_RE.search(row_xml)
+                    if row_number is None:
+                        raise PatchNotPossible(f"a row of '{sheet_name}' has no number")
+                    if int(row_number.group(2)) >= first_row:
+                        if not inserted:
+                            for new_row in new_rows:
+                                write(new_row)
+                            inserted = True
+                        row_xml = shift_row(row_xml)
+                    write(row_xml)
+                    pos = row.end()
+                    continue
+                end = SHEET_DATA_END_RE.match(buffer, pos)
+                if end is not None:
+                    if not inserted:
+                        for new_row in new_rows:
+                            write(new_row)
+                    pos = end.start()
+                    break
+                chunk = text.read(READ_SIZE)
+                if not chunk:
+                    raise PatchNotPossible(f"'{sheet_name}' ends inside sheetData")
+                buffer = buffer[pos:] + chunk
+                pos = 0
+
+        # The rest of the sheet (merged cells, page setup...) is small
+        tail = buffer[pos:] + text.read()
+        if CELL_ANCHORED_RE.search(tail):
+            raise PatchNotPossible(f"'{sheet_name}' has formatting, links or objects tied to its cells")
+        write(MERGE_CELL_RE.sub(lambda m: m.group(1) + self._shift_range(m.group(2), first_row, count) + m.group(3), tail))
+
+    @staticmethod
+    def _shift_range(ref, first_row, count):
+        """Moves a cell range down by count rows if it starts at or below first_row."""
+        min_col, min_row, max_col, max_row = range_boundaries(ref)
+        if min_row < first_row:
+            return ref
+        return f"{get_column_letter(min_col)}{min_row + count}:{get_column_letter(max_col)}{max_row + count}"
+
+    @staticmethod
+    def _new_dimension(ref, first_row, count):
+        """Returns the sheet dimension after inserting count rows at first_row."""
+        min_col, min_row, max_col, max_row = range_boundaries(ref)
+        if max_row >= first_row:
+            max_row += count
+        max_row = max(max_row, first_row + count - 1)
+        return f"{get_column_letter(min_col)}{min(min_row, first_row)}:{get_column_letter(max_col)}{max_row}"
+
+    def save(self, output_path):
+        """
+        Writes the patched workbook to output_path, through a temporary file,
+        so the original is only replaced once the new one is complete.
+        """
+        styles_xml = self._patched_styles_xml()
+        temp_path = output_path + ".tmp"
+        try:
+            with zipfile.ZipFile(self.path) as source, \
+                    zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as target:
+                new_members, replaced = self._new_sheet_parts(source) if self._new_sheets else ([], {})
+                if styles_xml is not None:
+                    replaced[self.styles_path] = styles_xml
+                for info in source.infolist():
+                    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+                    new_info.compress_type = zipfile.ZIP_DEFLATED
+                    new_info.external_attr = info.external_attr
+                    if info.filename in replaced:
+                        target.writestr(new_info, replaced[info.filename].encode("utf-8"))
+                        continue
+                    with source.open(info) as member, target.open(new_info, "w", force_zip64=info.file_size > 1 << 30) as output:
+                        if info.filename in self._inserts:
+                            self._rewrite_sheet(member, output, *self._inserts[info.filename])
+                        else:
+                            shutil.copyfileobj(member, output, READ_SIZE)
+                for member, (sheet_name, source_path, source_part, cell_formats) in new_members:
+                    new_info = zipfile.ZipInfo(member, datetime.datetime.now().timetuple()[:6])
+                    new_info.compress_type = zipfile.ZIP_DEFLATED
+                    with target.open(new_info, "w", force_zip64=True) as output:
+                        self._copy_sheet(output, source_path, source_part, cell_formats)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise